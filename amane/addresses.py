@@ -0,0 +1,68 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+E-mail address normalization
+"""
+
+from email.utils import getaddresses
+import functools
+
+import email_normalize
+
+
+CACHE_SIZE = 10000
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _normalize(address):
+    try:
+        cleaned = email_normalize.normalize(address, resolve=False)
+    except Exception:
+        return None
+    if isinstance(cleaned, str):
+        return cleaned
+    return None
+
+
+def normalize(addresses):
+    """
+    Normalize e-mail addresses; invalid ones are dropped. Results are
+    cached since the same addresses appear in message after message.
+
+    :param addresses: e-mail addresses with or without display names
+    :type addresses: [str]
+    :return: normalized addresses
+    :rtype: set(str)
+    """
+    result = set()
+    for address in addresses:
+        cleaned = _normalize(address)
+        if cleaned is not None:
+            result.add(cleaned)
+    return result
+
+
+def parse(value):
+    """
+    Extract and normalize e-mail addresses in a header like To: and Cc:.
+    Commas in quoted display names don't split addresses.
+
+    :param value: header value
+    :type value: str
+    :return: normalized addresses
+    :rtype: set(str)
+    """
+    return normalize(addr for name, addr in getaddresses([value]) if addr)
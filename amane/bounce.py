@@ -0,0 +1,138 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Bounce tracking
+"""
+
+from datetime import datetime
+
+from amane import db
+
+
+# Scores added by a bounce
+HARD = 1.0
+SOFT = 0.25
+# A member is removed when the score of the address reaches this
+THRESHOLD = 3.0
+# Days in which a score decays by half
+HALF_LIFE = 7
+
+
+def _address(value):
+    # "rfc822; user@example.com" => "user@example.com"
+    addr_type, _, address = value.rpartition(";")
+    if addr_type and addr_type.strip().lower() != "rfc822":
+        return ""
+    return address.strip().strip("<>")
+
+
+def parse_dsn(message):
+    """
+    Extract failed recipients from a delivery status notification
+    (RFC 3464). A bounce without a delivery-status part is taken as a
+    failure of the recipients in its Original-Recipient header.
+
+    :param message: bounce message
+    :type message: email.message.Message
+    :return: (recipient, action, status) tuples
+    :rtype: [tuple]
+    """
+    result = []
+    for part in message.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        # The first block is per-message fields
+        for block in part.get_payload()[1:]:
+            recipient = block.get('Original-Recipient') or \
+                block.get('Final-Recipient')
+            if recipient is None:
+                continue
+            action = block.get('Action', "").strip().lower()
+            status = block.get('Status', "").strip()
+            if action not in ("failed", "delayed"):
+                continue
+            result.append((_address(str(recipient)), action, status))
+        return [_ for _ in result if _[0]]
+
+    for recipient in message.get('Original-Recipient', "").split(','):
+        address = _address(recipient)
+        if address:
+            result.append((address, "failed", ""))
+    return result
+
+
+def weight(action, status):
+    """
+    Score of a bounce; permanent failures weigh more than temporary ones
+
+    :param action: Action field of the DSN
+    :type action: str
+    :param status: Status field of the DSN, e.g. '5.1.1'
+    :type status: str
+    :rtype: float
+    """
+    if action == "failed" and not status.startswith("4"):
+        return HARD
+    return SOFT
+
+
+def decay(score, since, now, half_life=HALF_LIFE):
+    """
+    Decay a score by the time elapsed in whole hours, so that bounces
+    arriving together add up exactly
+
+    :param score: score at since
+    :type score: float
+    :param since: time of the score
+    :type since: datetime
+    :param now: current time
+    :type now: datetime
+    :keyword half_life: days in which a score decays by half
+    :type half_life: float
+    :rtype: float
+    """
+    days = max((now - since).total_seconds(), 0) // 3600 / 24
+    return score * 0.5 ** (days / half_life)
+
+
+def record(address, ml_name, action, status, threshold=THRESHOLD,
+           half_life=HALF_LIFE):
+    """
+    Add a bounce to the score of an address
+
+    :param address: bouncing e-mail address
+    :type address: str
+    :param ml_name: mailing list ID the bounce came for
+    :type ml_name: str
+    :param action: Action field of the DSN
+    :type action: str
+    :param status: Status field of the DSN
+    :type status: str
+    :keyword threshold: score to remove the address from the ML
+    :type threshold: float
+    :keyword half_life: days in which a score decays by half
+    :type half_life: float
+    :return: the address should be removed from the ML or not
+    :rtype: bool
+    """
+    now = datetime.now()
+    score = weight(action, status)
+    bounce = db.get_bounce(address)
+    if bounce is not None:
+        score += decay(bounce['score'], bounce['updated'], now, half_life)
+    remove = score >= threshold
+    db.update_bounce(address, ml_name, score, status, removed=remove)
+    return remove
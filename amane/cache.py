@@ -0,0 +1,102 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process caches
+"""
+
+import collections
+import threading
+import time
+
+
+TTL = 60
+SIZE = 10000
+
+_MISSING = object()
+
+
+class TTLCache(object):
+    """
+    Thread-safe mapping whose entries expire ttl seconds after they are
+    stored. The oldest entries are evicted when more than size entries
+    are stored.
+    """
+
+    def __init__(self, ttl=TTL, size=SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Aquire a cached value
+
+        :param key: key of the entry
+        :type key: hashable
+        :keyword default: value to return if not cached or expired
+        :return: cached value or default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def put(self, key, value=True):
+        """
+        Store a value
+
+        :param key: key of the entry
+        :type key: hashable
+        :keyword value: value to store
+        :rtype: None
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        """
+        Remove an entry if cached
+
+        :param key: key of the entry
+        :type key: hashable
+        :rtype: None
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries
+
+        :rtype: None
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
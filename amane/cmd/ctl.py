@@ -18,7 +18,6 @@ Manager CLI
 """
 
 import click
-import email_normalize
 import logging
 import os
 import pbr.version
@@ -27,28 +26,18 @@ import sys
 import yaml
 
 
+from amane import addresses
 from amane import const
 from amane import db
 from amane import log
+from amane import ratelimit
+from amane import template
 
 
 CONFIG_FILE = "/etc/amane/amane.conf"
 ERROR_RETURN = 'amane-error'
 
 
-def normalize(addresses):
-    logging.debug(addresses)
-    result = []
-    for address in addresses:
-        try:
-            cleaned = email_normalize.normalize(address, resolve=False)
-            if isinstance(cleaned, str):
-                result.append(cleaned)
-        except:
-            pass
-    return set(result)
-
-
 @click.group()
 @click.option('--config-file', metavar='CONF',
               envvar='AMANE_CONFIG_FILE', type=click.File('r'),
@@ -61,7 +50,7 @@ def cli(ctx, config_file, debug):
     config = {}
     if config_file is None:
         config_file = open(CONFIG_FILE)
-    config = yaml.load(config_file.read())
+    config = yaml.safe_load(config_file.read())
     logging.debug("config: %s", config)
     log.setup(debug=debug)
     ctx.obj = {
@@ -110,9 +99,9 @@ def create_tenant(ctx, name, yamlfile, admin, charset, enable, disable,
                   closed_subject, closed_file):
     tenant_config = {}
     if yamlfile:
-        tenant_config = yaml.load(yamlfile.read())
+        tenant_config = yaml.safe_load(yamlfile.read())
     if len(admin) > 0:
-        tenant_config['admins'] = normalize(admin)
+        tenant_config['admins'] = addresses.normalize(admin)
     if charset is not None:
         tenant_config['charset'] = charset
     if enable is True:
@@ -152,6 +141,12 @@ def create_tenant(ctx, name, yamlfile, admin, charset, enable, disable,
     if closed_file is not None:
         tenant_config['closed_msg'] = closed_file.read()
 
+    try:
+        ratelimit.parse_limits(tenant_config.get('rate_limits'))
+    except (ValueError, TypeError, AttributeError) as e:
+        logging.error("invalid rate_limits: %s", e)
+        ctx.exit(1)
+
     logging.debug("tenant_name: %s", name)
     logging.debug("tenant_config: %s", tenant_config)
     config = ctx.obj['config']
@@ -197,9 +192,9 @@ def update_tenant(ctx, name, yamlfile, admin, charset, enable, disable,
         ctx.exit(1)
     tenant_config = {}
     if yamlfile:
-        tenant_config = yaml.load(yamlfile.read())
+        tenant_config = yaml.safe_load(yamlfile.read())
     if len(admin) > 0:
-        tenant_config['admins'] = normalize(admin)
+        tenant_config['admins'] = addresses.normalize(admin)
     if charset is not None:
         tenant_config['charset'] = charset
     if enable is True:
@@ -239,11 +234,19 @@ def update_tenant(ctx, name, yamlfile, admin, charset, enable, disable,
     if closed_file is not None:
         tenant_config['closed_msg'] = closed_file.read()
 
+    try:
+        ratelimit.parse_limits(tenant_config.get('rate_limits'))
+    except (ValueError, TypeError, AttributeError) as e:
+        logging.error("invalid rate_limits: %s", e)
+        ctx.exit(1)
+
     logging.debug("tenant_name: %s", name)
     logging.debug("tenant_config: %s", tenant_config)
     config = ctx.obj['config']
     db.init_db(config['db_url'],  config['db_name'])
     db.update_tenant(name, "CLI", **tenant_config)
+    template.setup(**config)
+    template.invalidate(name)
 
 
 @tenant.command('show', help='Show parameters of a tenant')
@@ -283,6 +286,81 @@ def delete_tenant(ctx, name):
         logging.error("tenant %s not found", name)
         ctx.exit(1)
     db.delete_tenant(name)
+    template.setup(**config)
+    template.invalidate(name)
+
+
+@cli.group('db', help='Database operations')
+@click.pass_context
+def database(ctx):
+    pass
+
+
+@database.command('ensure-indexes',
+                  help='Create indexes and show which queries use them')
+@click.pass_context
+def ensure_indexes(ctx):
+    config = ctx.obj['config']
+    db.init_db(config['db_url'],  config['db_name'], create_indexes=False)
+    for collection, names in sorted(db.ensure_indexes().items()):
+        print("%s: %s" % (collection, ", ".join(names)))
+    for name, indexes in db.explain_queries().items():
+        print("%s => %s" % (name, ", ".join(indexes)))
+
+
+@database.command('migrate-logs',
+                  help='Move ML logs into the ml_log collection')
+@click.pass_context
+def migrate_logs(ctx):
+    config = ctx.obj['config']
+    db.init_db(config['db_url'],  config['db_name'])
+    print("%d MLs migrated" % db.migrate_logs())
+
+
+@cli.group('queue', help='Outbound delivery queue operations')
+@click.pass_context
+def queue(ctx):
+    pass
+
+
+@queue.command('list', help='List queued messages; deferred ones by default')
+@click.option('--status', multiple=True,
+              type=click.Choice([const.MAIL_STATUS_QUEUED,
+                                 const.MAIL_STATUS_SENDING,
+                                 const.MAIL_STATUS_DEFERRED,
+                                 const.MAIL_STATUS_SENT,
+                                 const.MAIL_STATUS_FAILED]))
+@click.pass_context
+def list_queue(ctx, status):
+    config = ctx.obj['config']
+    db.init_db(config['db_url'],  config['db_name'])
+    if not status:
+        status = [const.MAIL_STATUS_QUEUED, const.MAIL_STATUS_SENDING,
+                  const.MAIL_STATUS_DEFERRED]
+    mails = db.find_mails({'status': {'$in': list(status)}},
+                          sortkey='next_try')
+    for mail in mails:
+        print("%(_id)s: %(status)s %(ml_name)s attempts=%(attempts)d "
+              "next_try=%(next_try)s error=%(error)s" % mail)
+        print("  %s" % ", ".join(mail['rcpttos']))
+
+
+@cli.command('bounces', help='List bouncing addresses, highest score first')
+@click.option('--ml', 'ml_name', metavar='ML_NAME',
+              help='Addresses bounced for this ML only')
+@click.pass_context
+def list_bounces(ctx, ml_name):
+    config = ctx.obj['config']
+    db.init_db(config['db_url'],  config['db_name'])
+    cond = {}
+    if ml_name:
+        cond['ml_names'] = ml_name
+    for bounce in db.find_bounces(cond, sortkey='score', reverse=True):
+        print("%(address)s: score=%(score).2f count=%(count)d "
+              "status=%(status)s updated=%(updated)s" % bounce)
+        print("  bounced: %s" % ", ".join(bounce['ml_names']))
+        if bounce.get('removed'):
+            print("  removed: %s" % ", ".join(bounce['removed']))
 
 
 if __name__ == '__main__':
@@ -21,11 +21,9 @@ import argparse
 from datetime import datetime, timedelta
 from email.message import Message
 from email.header import Header
-from jinja2 import Environment
 import logging
 import os
 import pbr.version
-import smtplib
 import sys
 import yaml
 
@@ -33,6 +31,8 @@ import yaml
 from amane import const
 from amane import db
 from amane import log
+from amane import relay
+from amane import template
 
 
 CONFIG_FILE = os.environ.get("AMANE_CONFIG_FILE", "/etc/amane/amane.conf")
@@ -52,9 +52,9 @@ def report_tenant_status(relay_host=None, relay_port=None,
                          report_subject=None, report_msg=None,
                          days_to_close=None, charset='utf8',
                          admins=None, domain=None, debug=False,
-                         **kwargs):
+                         tenant_name=None, relay_pool=None, **kwargs):
 
-    db.init_db(db_url, db_name)
+    db.init_db(db_url, db_name, create_indexes=False)
 
     new = db.find_mls({'status': const.STATUS_NEW}, sortkey='updated')
     new = [convert(_) for _ in new]
@@ -70,8 +70,7 @@ def report_tenant_status(relay_host=None, relay_port=None,
     closed = [convert(_) for _ in closed]
 
     params = dict(new=new, open=_open, orphaned=orphaned, closed=closed)
-    temp = Environment(newline_sequence='\r\n')
-    content = temp.from_string(report_msg).render(params)
+    content = template.render(tenant_name, 'report_msg', report_msg, params)
 
     # Format a report message
     _from = ERROR_RETURN + "@" + domain
@@ -87,12 +86,16 @@ def report_tenant_status(relay_host=None, relay_port=None,
     message.set_payload(content.encode(charset))
     message.set_charset(charset)
 
-    # Send the report to the relay host
-    relay = smtplib.SMTP(relay_host, relay_port)
-    if debug:
-        relay.set_debuglevel(1)
-    relay.sendmail(_from, admins, message.as_string())
-    relay.quit()
+    # Send the report to the relay host; a pool made here is closed
+    # after sending
+    own_pool = relay_pool is None
+    if own_pool:
+        relay_pool = relay.RelayPool(relay_host, relay_port, debug=debug)
+    try:
+        relay_pool.sendmail(_from, admins, message.as_string())
+    finally:
+        if own_pool:
+            relay_pool.close()
     logging.debug("Sent a report mail")
 
 
@@ -100,12 +103,20 @@ def report_status(relay_host=None, relay_port=None, db_url=None,
                   db_name=None, domain=None, debug=False, **kwargs):
 
     db.init_db(db_url, db_name)
+    template.setup(**kwargs)
+    relay_pool = relay.from_config(relay_host=relay_host,
+                                   relay_port=relay_port, debug=debug,
+                                   **kwargs)
 
     tenants = db.find_tenants({'status': const.TENANT_STATUS_ENABLED})
-    for tenant in tenants:
-        report_tenant_status(
-            relay_host=relay_host, relay_port=relay_port, db_url=db_url,
-            db_name=db_name, domain=domain, debug=debug, **tenant)
+    try:
+        for tenant in tenants:
+            report_tenant_status(
+                relay_host=relay_host, relay_port=relay_port, db_url=db_url,
+                db_name=db_name, domain=domain, debug=debug,
+                relay_pool=relay_pool, **tenant)
+    finally:
+        relay_pool.close()
 
 
 def main():
@@ -133,7 +144,7 @@ def main():
     log.setup(debug=opts.debug)
     logging.debug("args: %s", opts.__dict__)
 
-    config = yaml.load(opts.config_file)
+    config = yaml.safe_load(opts.config_file)
     for key, value in config.items():
         setattr(opts, key, value)
 
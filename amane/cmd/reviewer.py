@@ -22,18 +22,19 @@ from datetime import datetime, timedelta
 import email
 from email.message import Message
 from email.header import Header
-from jinja2 import Environment
 import logging
 import os
 import pbr.version
 import re
-import smtplib
 import sys
 import yaml
 
 from amane import const
 from amane import db
 from amane import log
+from amane import outbox
+from amane import relay
+from amane import template
 
 
 CONFIG_FILE = os.environ.get("AMANE_CONFIG_FILE", "/etc/amane/amane.conf")
@@ -50,6 +51,11 @@ class Reviewer(object):
         self.relay_port = relay_port
         self.at_domain = "@" + domain
         self.debug = debug
+        self.relay_pool = relay.from_config(
+            relay_host=relay_host, relay_port=relay_port, debug=debug,
+            **kwargs)
+        self.outbox = outbox.from_config(self.relay_pool, **kwargs)
+        template.setup(**kwargs)
 
         db.init_db(db_url, db_name)
         self.tenants = db.find_tenants({'status': const.TENANT_STATUS_ENABLED})
@@ -71,11 +77,11 @@ class Reviewer(object):
                 tenant_name = config['tenant_name']
                 days = config['days_to_close']
                 subject = config['closed_subject']
-                template = config['closed_msg']
+                template_name = 'closed_msg'
             elif new_status == const.STATUS_ORPHANED:
                 days = config['days_to_orphan']
                 subject = config['orphaned_subject']
-                template = config['orphaned_msg']
+                template_name = 'orphaned_msg'
             charset = config['charset']
 
             updated_after = datetime.now() - timedelta(days=days, hours=-1)
@@ -94,12 +100,13 @@ class Reviewer(object):
                     params = dict(ml_name=ml_name, ml_address=ml_address,
                                   new_ml_address=new_ml_address,
                                   subject=ml['status'])
-                    temp = Environment(newline_sequence='\r\n')
-                    content = temp.from_string(template).render(params)
+                    content = template.render(
+                        config['tenant_name'], template_name,
+                        config[template_name], params)
                     self.send_post(ml_name, subject, content, members, charset)
                     db.change_ml_status(ml_name, new_status, "reviewer")
-                except:
-                    pass
+                except Exception:
+                    logging.exception("Failed to notify %s", ml['ml_name'])
 
     def send_post(self, ml_name, subject, content, members, charset):
         """
@@ -123,19 +130,27 @@ class Reviewer(object):
         message = Message()
         message['To'] = message['Reply-To'] = _to
         message['From'] = message['Return-Path'] = _from
+        message['X-Loop'] = _to
+        message['List-Id'] = "<%s.%s>" % (ml_name, self.at_domain[1:])
         message['Subject'] = Header(subject, charset)
         message.set_payload(content.encode(charset))
         message.set_charset(charset)
 
-        # Send a post to the relay host
-        relay = smtplib.SMTP(self.relay_host, self.relay_port)
-        if self.debug:
-            relay.set_debuglevel(1)
-        relay.sendmail(_from, members, message.as_string())
-        relay.quit()
-        logging.info("Sent: ml_name=%s|mailfrom=%s|members=%s|",
-                     ml_name, _from, members)
-        db.log_post(ml_name, members, "reviewer")
+        # Send a post to the relay host; deferred ones are retried by
+        # amane_smtpd
+        delivery = self.outbox.send(ml_name, _from, members,
+                                    message.as_string())
+        logging.info("Sent: ml_name=%s|mailfrom=%s|members=%s|delivery=%s|",
+                     ml_name, _from, members, delivery)
+        db.log_post(ml_name, members, "reviewer", delivery=delivery)
+
+    def close(self):
+        """
+        Release connections to the relay host
+
+        :rtype: None
+        """
+        self.relay_pool.close()
 
 
 def main():
@@ -160,7 +175,7 @@ def main():
         print(pbr.version.VersionInfo('amane'))
         return 0
 
-    config = yaml.load(opts.config_file)
+    config = yaml.safe_load(opts.config_file)
     for key, value in config.items():
         setattr(opts, key, value)
 
@@ -170,6 +185,7 @@ def main():
     reviewer = Reviewer(**opts.__dict__)
     reviewer.notify(const.STATUS_ORPHANED, const.STATUS_CLOSED)
     reviewer.notify(const.STATUS_OPEN, const.STATUS_ORPHANED)
+    reviewer.close()
 
 
 if __name__ == '__main__':
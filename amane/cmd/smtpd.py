@@ -17,115 +17,1102 @@
 SMTP Handler; The Mailing List Manager
 """
 
+from aiosmtpd.lmtp import LMTP
+from aiosmtpd.smtp import SMTP
 import argparse
-import asyncore
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import email
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+from email.generator import BytesGenerator
+from email.header import Header, decode_header
+from email.message import Message
+from email.parser import BytesHeaderParser
 from email.mime.multipart import MIMEMultipart
-from email.header import Header, decode_header, make_header
-import email_normalize
-from jinja2 import Environment
+from email import policy
+import io
 import logging
 import os
 import pbr.version
 import re
-import smtpd
-import smtplib
+import signal
+import socket
+import stat
 import sys
+import time
 import yaml
 
+from amane import addresses
+from amane import bounce
+from amane import cache
 from amane import const
 from amane import db
 from amane import log
+from amane import metrics
+from amane import outbox
+from amane import prefork
+from amane import ratelimit
+from amane import registry
+from amane import relay
+from amane import spool
+from amane import template
 
 
 CONFIG_FILE = os.environ.get("AMANE_CONFIG_FILE", "/etc/amane/amane.conf")
 ERROR_SUFFIX = '-error'
-REMOVE_RFC822 = re.compile("rfc822;", re.I)
+END_OF_HEADERS = re.compile(rb"\r?\n\r?\n")
+MAX_THREADS = 32
+DUPLICATE_WINDOW = 86400
+DRAIN_TIMEOUT = 30
+DRAIN_POLL_INTERVAL = 0.1
+SNAPSHOT_TTL = 5
+PROTOCOL_SMTP = "smtp"
+PROTOCOL_LMTP = "lmtp"
+# compat32 keeps the headers which aren't rewritten as they are, while
+# email.policy.SMTP would refold all of them
+SMTP_POLICY = policy.compat32.clone(linesep="\r\n")
+ML_PROJECTION = {'_id': 0, 'tenant_name': 1, 'status': 1, 'members': 1}
+# Parameters of amane.conf which can't be changed by reloading it
+RESTART_KEYS = ["listen_address", "listen_port", "listen_socket", "protocol",
+                "db_url", "db_name", "spool_dir", "spool_workers",
+                "spool_retry_interval", "spool_max_retry_interval",
+                "spool_max_attempts", "max_threads"]
+# Parameters applied to a running server by reloading amane.conf
+RELOAD_KEYS = ["max_in_flight", "max_spool_depth", "max_outbox_depth",
+               "bounce_threshold", "bounce_half_life"]
 
 
-def normalize(addresses):
-    logging.debug(addresses)
-    result = []
-    for address in addresses:
-        try:
-            cleaned = email_normalize.normalize(address, resolve=False)
-            if isinstance(cleaned, str):
-                result.append(cleaned)
-        except:
-            pass
-    return set(result)
+def read_config(config_file):
+    """
+    Read amane.conf
+
+    :param config_file: path or file object of the configuration file
+    :type config_file: str
+    :return: parameters
+    :rtype: dict
+    """
+    if isinstance(config_file, str):
+        with open(config_file) as f:
+            return yaml.safe_load(f) or {}
+    return yaml.safe_load(config_file) or {}
+
+
+def get_header(message, name):
+    """
+    Aquire a decoded header value. Raw 8-bit values are read as UTF-8.
+
+    :param message: message object
+    :type message: email.message.Message
+    :param name: header name
+    :type name: str
+    :rtype: str
+    """
+    value = message.get(name, "")
+    try:
+        value = "".join(_decode(part, charset)
+                        for part, charset in decode_header(value))
+    except Exception:
+        value = str(value)
+    return value.strip()
+
+
+def _decode(part, charset):
+    if isinstance(part, str):
+        return part
+    try:
+        return part.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return part.decode('utf-8', errors='replace')
+
+
+def parse_headers(data):
+    """
+    Parse the header block of a message only; the body isn't read
+
+    :param data: message content
+    :type data: bytes
+    :rtype: email.message.Message
+    """
+    match = END_OF_HEADERS.search(data)
+    if match is not None:
+        data = data[:match.start()] + b"\n"
+    return BytesHeaderParser().parsebytes(data)
 
 
 def ensure_multipart(message, default_charset):
+    """
+    Wrap a single part message into a multipart one. The body is moved
+    into the first part as is, without being decoded.
+
+    :param message: message object
+    :type message: email.message.Message
+    :param default_charset: charset of a text body without one
+    :type default_charset: str
+    :rtype: email.message.Message
+    """
     if message.is_multipart():
         return message
 
     _message = MIMEMultipart()
+    part = Message()
     for header, value in message.items():
-        _message[header] = value
-    maintype = message.get_content_maintype()
-    subtype = message.get_content_subtype()
-    if maintype == "text":
-        charset = message.get_content_charset(default_charset)
-        content = message.get_payload(decode=True).decode(charset)
-        part = MIMEText(content, _charset=charset, _subtype=subtype)
-    elif maintype == "application":
-        content = message.get_payload(decode=True)
-        part = MIMEApplication(content, _subtype=subtype)
+        if header.lower().startswith('content-'):
+            part[header] = value
+        elif header.lower() != 'mime-version':
+            _message[header] = value
+    if part.get_content_maintype() == "text" and \
+            part.get_param('charset') is None:
+        part.set_param('charset', default_charset)
+    # get_payload() would decode 8-bit content; move the raw payload
+    part.set_payload(message._payload)
     _message.attach(part)
     return _message
 
 
-class AmaneSMTPServer(smtpd.SMTPServer):
+def bind_unix_socket(path):
+    """
+    Create a listening UNIX domain socket. A socket file left by a
+    previous run is removed.
+
+    :param path: path of the socket
+    :type path: str
+    :rtype: socket.socket
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen(100)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+def as_bytes(message):
+    """
+    Serialize a message for SMTP. Headers and parts which haven't been
+    altered are written as they were received.
+
+    :param message: message object
+    :type message: email.message.Message
+    :rtype: bytes
+    """
+    fp = io.BytesIO()
+    BytesGenerator(fp, mangle_from_=False, policy=SMTP_POLICY).flatten(
+        message)
+    return fp.getvalue()
+
+
+class MessageContext(object):
+    """
+    Snapshot of a ML taken once per inbound message. Changes made while
+    processing the message are kept here and written back by commit()
+    in a single update.
+    """
+
+    def __init__(self, ml_name, mailfrom, ml=None):
+        self.ml_name = ml_name
+        self.mailfrom = mailfrom
+        if ml is None:
+            ml = db.get_ml(ml_name, projection=ML_PROJECTION)
+        self.ml = ml
+        self.members = set(ml.get('members', [])) if ml else set()
+        # Set once processing the message has had side effects, after
+        # which it must not be processed again
+        self.started = False
+        self._status = None
+        self._add = set()
+        self._delete = set()
+        self._logs = []
+
+    @property
+    def status(self):
+        return self._status or (self.ml or {}).get('status')
+
+    def change_status(self, status):
+        self._status = status
+        self._logs.append({"op": const.OP_MAP[status], "by": self.mailfrom})
+
+    def add_members(self, members):
+        self.members |= members
+        self._add |= members
+        self._logs.append({"op": const.OP_ADD_MEMBERS, "by": self.mailfrom,
+                           "members": list(members)})
+
+    def del_members(self, members):
+        self.members -= members
+        self._delete |= members
+        self._logs.append({"op": const.OP_DEL_MEMBERS, "by": self.mailfrom,
+                           "members": list(members)})
+
+    def log_post(self, members, by, delivery=None):
+        log_dict = {"op": const.OP_POST, "by": by, "members": list(members)}
+        if delivery:
+            log_dict['delivery'] = delivery
+        self._logs.append(log_dict)
+
+    def commit(self):
+        """
+        Write the pending changes back to the database
+
+        :rtype: None
+        """
+        if self.ml is None or not self._logs:
+            return
+        db.update_ml(self.ml_name, self.mailfrom, status=self._status,
+                     add=self._add, delete=self._delete, logs=self._logs)
+        if self._add or self._delete:
+            template.invalidate_ml(self.ml_name)
+        self._status = None
+        self._add = set()
+        self._delete = set()
+        self._logs = []
+
+
+class JobCancelled(Exception):
+    """A job was cancelled before a thread picked it up"""
+
+
+class PartlyProcessed(Exception):
+    """
+    Processing a message failed after it had side effects. It isn't a
+    transient error, so the message isn't retried and posted twice.
+    """
+
+
+class AmaneHandler(object):
+    """
+    aiosmtpd handler; runs process_message() in a thread pool so that
+    blocking DB, template and relay operations don't stall the event loop.
+    In spool mode, messages are only stored in the spool before they are
+    acknowledged and spool workers process them later.
+    In LMTP mode, a status is replied for each accepted recipient; see
+    AmaneSMTPServer.recipient_statuses().
+    New transactions are refused with a temporary error while the server
+    is overloaded or shutting down. Sessions in a transaction, i.e.
+    between MAIL and the end of DATA, RSET, HELO, EHLO, QUIT or a lost
+    connection, are kept in server.transactions.
+    """
+
+    def __init__(self, server, executor):
+        self.server = server
+        self.executor = executor
+        # Messages whose jobs were cancelled are spooled here, since all
+        # threads of the executor may be busy
+        self.spool_executor = ThreadPoolExecutor()
+        # Jobs submitted to the executors and not finished yet
+        self.jobs = set()
+        self._cancelled = set()
+
+    async def run_job(self, func, *args, executor=None):
+        """
+        Run func(*args) in the thread pool
+
+        :param func: function to run
+        :type func: callable
+        :keyword executor: thread pool to use instead of the default one
+        :type executor: concurrent.futures.Executor
+        :return: return value of func
+        :raises JobCancelled: cancel_jobs() was called before a thread
+                              picked the job up
+        """
+        future = (executor or self.executor).submit(func, *args)
+        self.jobs.add(future)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if future in self._cancelled:
+                raise JobCancelled()
+            raise
+        finally:
+            self.jobs.discard(future)
+            self._cancelled.discard(future)
+
+    def cancel_jobs(self):
+        """
+        Cancel jobs waiting for a thread. Running ones can't be cancelled.
+
+        :return: number of cancelled jobs
+        :rtype: int
+        """
+        for future in list(self.jobs):
+            if future.cancel():
+                self._cancelled.add(future)
+        return len(self._cancelled)
+
+    async def wait_jobs(self, deadline=None):
+        """
+        Wait for the jobs to finish and their sessions to be replied
+
+        :keyword deadline: time.monotonic() value to give up at; no limit
+                           if None
+        :type deadline: float
+        :return: number of jobs left running
+        :rtype: int
+        """
+        while self.jobs and \
+                (deadline is None or time.monotonic() < deadline):
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        return len([_ for _ in self.jobs if not _.done()])
+
+    def shutdown(self):
+        """
+        Shut the thread pools down without waiting for running jobs
+
+        :rtype: None
+        """
+        self.executor.shutdown(wait=False)
+        self.spool_executor.shutdown(wait=False)
+
+    def end_transaction(self, session):
+        """
+        Forget the transaction of a session
+
+        :param session: aiosmtpd session
+        :type session: aiosmtpd.smtp.Session
+        :rtype: None
+        """
+        self.server.transactions.discard(session)
+
+    async def handle_HELO(self, server, session, envelope, hostname):
+        self.end_transaction(session)
+        session.host_name = hostname
+        return "250 %s" % server.hostname
+
+    async def handle_EHLO(self, server, session, envelope, hostname,
+                          responses):
+        self.end_transaction(session)
+        session.host_name = hostname
+        return responses
+
+    async def handle_RSET(self, server, session, envelope):
+        self.end_transaction(session)
+        return const.SMTP_STATUS_OK
+
+    async def handle_QUIT(self, server, session, envelope):
+        self.end_transaction(session)
+        return "221 Bye"
+
+    async def handle_MAIL(self, server, session, envelope, address,
+                          mail_options):
+        if self.server.draining:
+            return const.SMTP_STATUS_SHUTTING_DOWN
+        if self.server.overloaded():
+            return const.SMTP_STATUS_TRY_AGAIN_LATER
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        # MLs looked up for the recipients, reused for the message
+        envelope.snapshots = {}
+        self.server.transactions.add(session)
+        return const.SMTP_STATUS_OK
+
+    async def handle_RCPT(self, server, session, envelope, address,
+                          rcpt_options):
+        try:
+            ret = await self.run_job(self.server.check_recipient, address,
+                                     envelope.mail_from, envelope.snapshots)
+        except JobCancelled:
+            return const.SMTP_STATUS_SHUTTING_DOWN
+        except Exception:
+            logging.exception("Failed to check a recipient")
+            return const.SMTP_STATUS_LOCAL_ERROR
+        if ret:
+            return ret
+        envelope.rcpt_tos.append(address)
+        envelope.rcpt_options.extend(rcpt_options)
+        return const.SMTP_STATUS_OK
+
+    async def handle_DATA(self, server, session, envelope):
+        self.server.in_flight += 1
+        try:
+            status = await self._handle_DATA(session, envelope)
+        finally:
+            self.server.in_flight -= 1
+            self.end_transaction(session)
+        if self.server.protocol == PROTOCOL_LMTP:
+            return "\r\n".join(self.server.recipient_statuses(
+                envelope.rcpt_tos, envelope.content, status))
+        return status
+
+    async def _handle_DATA(self, session, envelope):
+        args = (session.peer, envelope.mail_from, envelope.rcpt_tos,
+                envelope.content, envelope.snapshots)
+        if self.server.spool is not None:
+            try:
+                ret = await self.run_job(self.server.spool_message, *args)
+            except JobCancelled:
+                # Shutting down; spool it off the event loop to be
+                # processed after the next start
+                try:
+                    ret = await self.run_job(self.server.spool_message,
+                                             *args,
+                                             executor=self.spool_executor)
+                except Exception:
+                    logging.exception("Failed to spool a message")
+                    return const.SMTP_STATUS_LOCAL_ERROR
+            except Exception:
+                logging.exception("Failed to spool a message")
+                return const.SMTP_STATUS_LOCAL_ERROR
+            return ret or const.SMTP_STATUS_OK
+        try:
+            ret = await self.run_job(self.server.process_message, *args)
+        except JobCancelled:
+            # Shutting down without a spool; the client keeps the message
+            # and retries
+            return const.SMTP_STATUS_SHUTTING_DOWN
+        except Exception:
+            logging.exception("Failed to process a message")
+            return const.SMTP_STATUS_LOCAL_ERROR
+        return ret or const.SMTP_STATUS_OK
+
+
+class AmaneSMTP(SMTP):
+    """SMTP protocol which ends the transaction of a lost connection"""
+
+    def connection_lost(self, error):
+        super().connection_lost(error)
+        self.event_handler.end_transaction(self.session)
+
+
+class AmaneLMTP(LMTP):
+    """LMTP protocol which ends the transaction of a lost connection"""
+
+    def connection_lost(self, error):
+        super().connection_lost(error)
+        self.event_handler.end_transaction(self.session)
+
+
+class AmaneSMTPServer(object):
 
     def __init__(self, listen_address=None, listen_port=None, relay_host=None,
                  relay_port=None, db_url=None, db_name=None, domain=None,
-                 debug=False, **kwargs):
+                 max_threads=MAX_THREADS,
+                 tenant_refresh_interval=registry.REFRESH_INTERVAL,
+                 counter_refresh_interval=registry.COUNTER_INTERVAL,
+                 negative_cache_ttl=cache.TTL, negative_cache_size=cache.SIZE,
+                 spool_dir=None, spool_workers=spool.WORKERS,
+                 spool_retry_interval=spool.RETRY_INTERVAL,
+                 spool_max_retry_interval=spool.MAX_RETRY_INTERVAL,
+                 spool_max_attempts=spool.MAX_ATTEMPTS,
+                 protocol=PROTOCOL_SMTP, listen_socket=None,
+                 max_in_flight=0, max_spool_depth=0, max_outbox_depth=0,
+                 metrics_interval=metrics.INTERVAL, rate_limits=None,
+                 rate_limit_size=ratelimit.SIZE,
+                 duplicate_window=DUPLICATE_WINDOW,
+                 duplicate_cache_size=cache.SIZE,
+                 bounce_threshold=bounce.THRESHOLD,
+                 bounce_half_life=bounce.HALF_LIFE, config_file=None,
+                 drain_timeout=DRAIN_TIMEOUT, debug=False, **kwargs):
 
+        if protocol not in (PROTOCOL_SMTP, PROTOCOL_LMTP):
+            raise ValueError("unknown protocol: %s" % protocol)
+        self.listen_address = listen_address
+        self.listen_port = listen_port
+        self.protocol = protocol
+        self.listen_socket = listen_socket
+        self.max_in_flight = max_in_flight
+        self.max_spool_depth = max_spool_depth
+        self.max_outbox_depth = max_outbox_depth
+        self.metrics_interval = metrics_interval
+        self.in_flight = 0
+        self.shedding = None
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        # Sessions in a transaction; see AmaneHandler
+        self.transactions = set()
+        self.rate_limits = ratelimit.parse_limits(rate_limits)
+        self.limiter = ratelimit.RateLimiter(size=rate_limit_size)
+        self.bounce_threshold = bounce_threshold
+        self.bounce_half_life = bounce_half_life
+        self.config_file = config_file
+        self.restart_params = dict(
+            listen_address=listen_address, listen_port=listen_port,
+            listen_socket=listen_socket, protocol=protocol, db_url=db_url,
+            db_name=db_name, spool_dir=spool_dir, spool_workers=spool_workers,
+            spool_retry_interval=spool_retry_interval,
+            spool_max_retry_interval=spool_max_retry_interval,
+            spool_max_attempts=spool_max_attempts, max_threads=max_threads)
         self.relay_host = relay_host
         self.relay_port = relay_port
         self.at_domain = "@" + domain
+        self.max_threads = max_threads
         self.debug = debug
+        self.relay_pool = relay.from_config(
+            relay_host=relay_host, relay_port=relay_port, debug=debug,
+            **kwargs)
+        self.outbox = outbox.from_config(self.relay_pool, **kwargs)
+        template.setup(**kwargs)
+        self.tenants = registry.TenantRegistry(
+            refresh_interval=tenant_refresh_interval,
+            on_change=template.invalidate,
+            counter_interval=counter_refresh_interval)
+        self.missing_mls = cache.TTLCache(ttl=negative_cache_ttl,
+                                          size=negative_cache_size)
+        # Message-IDs of recent posts keyed by (ML ID, Message-ID)
+        self.recent_posts = cache.TTLCache(ttl=duplicate_window,
+                                           size=duplicate_cache_size)
+        self.spool = None
+        self.spool_workers = None
+        if spool_dir:
+            self.spool = spool.Spool(spool_dir)
+            self.spool_workers = spool.Workers(
+                self.spool, self.process_message, size=spool_workers,
+                retry_interval=spool_retry_interval,
+                max_retry_interval=spool_max_retry_interval,
+                max_attempts=spool_max_attempts,
+                transient=spool.TRANSIENT_ERRORS + db.TRANSIENT_ERRORS)
 
         db.init_db(db_url, db_name)
 
-        return super().__init__((listen_address, listen_port), None)
+    def spool_message(self, peer, mailfrom, rcpttos, data, snapshots=None):
+        """
+        Store a received message into the spool and queue it for the
+        spool workers. The message is checked with its headers first,
+        so that one which would be rejected is refused in the SMTP
+        transaction instead of being spooled.
+
+        :param peer: client address
+        :type peer: tuple
+        :param mailfrom: envelope sender
+        :type mailfrom: str
+        :param rcpttos: envelope recipients
+        :type rcpttos: [str]
+        :param data: message content
+        :type data: bytes
+        :keyword snapshots: ML snapshots of the envelope; see lookup_ml()
+        :type snapshots: dict
+        :return: SMTP status to refuse the message or None
+        :rtype: str
+        """
+        ret = self.check_message(data, snapshots)
+        if ret:
+            return ret
+        name = self.spool.put(peer, mailfrom, rcpttos, data)
+        self.spool_workers.submit(name)
+
+    def overloaded(self):
+        """
+        Check the high-water marks of messages in processing, spooled
+        messages and queued outbound messages. Each mark is disabled if 0.
+        Starting and stopping shedding load are logged and refused
+        transactions are counted in the 'shed' metric.
+
+        :return: name of the exceeded mark or None
+        :rtype: str
+        """
+        reason = None
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            reason = "in_flight"
+        elif self.max_spool_depth and self.spool_workers is not None and \
+                self.spool_workers.backlog() >= self.max_spool_depth:
+            reason = "spool_depth"
+        elif self.max_outbox_depth and \
+                self.outbox.depth >= self.max_outbox_depth:
+            reason = "outbox_depth"
+        if reason != self.shedding:
+            if reason:
+                logging.warning("Shedding load: %s", reason)
+            else:
+                logging.info("Stopped shedding load: %s", self.shedding)
+            self.shedding = reason
+        if reason:
+            metrics.incr("shed")
+            metrics.incr("shed." + reason)
+        return reason
+
+    def log_metrics(self):
+        """
+        Write current metrics into the log
+
+        :rtype: None
+        """
+        metrics.gauge("in_flight", self.in_flight)
+        if self.spool_workers is not None:
+            metrics.gauge("spool_depth", self.spool_workers.backlog())
+        metrics.gauge("outbox_depth", self.outbox.depth)
+        metrics.log()
+
+    def serve_forever(self, reuse_port=False, recover_spool=True,
+                      sock=None):
+        """
+        Listen on listen_address:listen_port, or listen_socket if
+        specified, and serve SMTP or LMTP sessions until the event loop
+        is stopped or SIGTERM is received.
+        SIGTERM makes the server stop listening and refuse new
+        transactions, wait up to drain_timeout seconds for transactions
+        in progress and then stop. Received messages still waiting for a
+        thread by then are spooled, or refused temporarily without a
+        spool. Spooled and queued outbound messages which aren't finished
+        are left for the next start. Jobs still running at the deadline
+        are abandoned; the caller should exit without waiting for their
+        threads. A second SIGTERM stops the server immediately.
+        SIGHUP makes amane.conf and tenant configurations reloaded.
+
+        :keyword reuse_port: bind with SO_REUSEPORT to share the port with
+                             other worker processes
+        :type reuse_port: bool
+        :keyword recover_spool: recover spooled messages of crashed
+                                processes on start
+        :type recover_spool: bool
+        :keyword sock: listening UNIX domain socket shared with other
+                       worker processes
+        :type sock: socket.socket
+        :return: number of abandoned jobs
+        :rtype: int
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        handler = AmaneHandler(self, executor)
+        protocol = AmaneLMTP if self.protocol == PROTOCOL_LMTP else AmaneSMTP
+
+        def factory():
+            return protocol(handler, loop=loop)
+
+        socket_path = None
+        if self.listen_socket:
+            if sock is None:
+                sock = bind_unix_socket(self.listen_socket)
+                socket_path = self.listen_socket
+            server = loop.run_until_complete(
+                loop.create_unix_server(factory, sock=sock))
+            logging.info("Listening on %s (%s)",
+                         self.listen_socket, self.protocol)
+        else:
+            server = loop.run_until_complete(loop.create_server(
+                factory, host=self.listen_address, port=self.listen_port,
+                reuse_port=reuse_port or None))
+            logging.info("Listening on %s:%s (%s)", self.listen_address,
+                         self.listen_port, self.protocol)
+        deadline = None
+
+        def remaining():
+            if deadline is None:
+                return None
+            return max(deadline - time.monotonic(), 0)
+
+        def drain():
+            nonlocal deadline
+            if self.draining:
+                loop.stop()
+                return
+            self.draining = True
+            deadline = time.monotonic() + self.drain_timeout
+            server.close()
+            logging.info("Draining: transactions=%d|",
+                         len(self.transactions))
+            task = loop.create_task(self.wait_transactions(deadline))
+            task.add_done_callback(lambda task: loop.stop())
+
+        loop.add_signal_handler(signal.SIGTERM, drain)
+        loop.add_signal_handler(signal.SIGHUP, self.reload, executor)
+
+        def log_metrics():
+            self.log_metrics()
+            loop.call_later(self.metrics_interval, log_metrics)
+
+        if self.metrics_interval:
+            loop.call_later(self.metrics_interval, log_metrics)
+        if self.spool_workers is not None:
+            self.spool_workers.start(recover=recover_spool)
+        self.outbox.start()
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            # Messages waiting for a thread are spooled, or refused
+            # temporarily without a spool. Jobs are waited for until the
+            # deadline so that their sessions are replied.
+            handler.cancel_jobs()
+            abandoned = loop.run_until_complete(handler.wait_jobs(deadline))
+            if abandoned:
+                logging.warning("Abandoned %d jobs", abandoned)
+            handler.shutdown()
+            if self.spool_workers is not None:
+                self.spool_workers.stop(timeout=remaining())
+            self.outbox.stop(timeout=remaining())
+            self.relay_pool.close()
+            self.log_metrics()
+            loop.close()
+            logging.info("Stopped")
+            if socket_path is not None:
+                os.remove(socket_path)
+        return abandoned
+
+    async def wait_transactions(self, deadline):
+        """
+        Wait for the transactions in progress to finish
 
-    def process_message(self, peer, mailfrom, rcpttos, data):
-        message = email.message_from_string(data)
+        :param deadline: time.monotonic() value to give up at
+        :type deadline: float
+        :return: number of transactions left
+        :rtype: int
+        """
+        while self.transactions and time.monotonic() < deadline:
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        if self.transactions:
+            logging.warning("Gave up %d transactions",
+                            len(self.transactions))
+        return len(self.transactions)
+
+    def reload(self, executor=None):
+        """
+        Reload tenant configurations and amane.conf. Relay settings,
+        domain, log file, rate limits and load shedding thresholds take
+        effect without closing the listening socket. Sessions and
+        messages in progress are finished with the old relay pool, which
+        is closed when they return its connections.
 
-        from_str = message.get('From', "").strip()
-        to_str = message.get('To', "").strip()
-        cc_str = message.get('Cc', "").strip()
-        subject = message.get('Subject', "").strip()
+        :keyword executor: executor to close the old relay pool in, so
+                           that the event loop isn't blocked by relay hosts
+        :type executor: concurrent.futures.Executor
+        :rtype: None
+        """
+        self.tenants.invalidate()
+        if not self.config_file:
+            return
         try:
-            subject = str(make_header(decode_header(subject)))
-        except:
-            pass
+            config = read_config(self.config_file)
+            rate_limits = ratelimit.parse_limits(config.get('rate_limits'))
+            relay_pool = relay.from_config(**dict(config, debug=self.debug))
+        except Exception:
+            logging.exception("Failed to reload %s", self.config_file)
+            return
+
+        log.reopen(filename=config.get('log_file'), debug=self.debug)
+        old_pool = self.relay_pool
+        self.relay_pool = self.outbox.relay_pool = relay_pool
+        if executor is None:
+            old_pool.close()
+        else:
+            executor.submit(old_pool.close)
+        self.relay_host = relay_pool.relay_host
+        self.relay_port = relay_pool.relay_port
+        if config.get('domain'):
+            self.at_domain = "@" + config['domain']
+        self.rate_limits = rate_limits
+        for key in RELOAD_KEYS:
+            if key in config:
+                setattr(self, key, config[key])
+        for key in RESTART_KEYS:
+            if key in config and config[key] != self.restart_params[key]:
+                logging.warning("%s isn't changed until restarted", key)
+        logging.info("Reloaded %s: relay=%s:%s|domain=%s|",
+                     self.config_file, self.relay_host, self.relay_port,
+                     self.at_domain[1:])
+
+    def check_recipient(self, address, mailfrom=None, snapshots=None):
+        """
+        Check an envelope recipient before receiving the message.
+        Addresses of unknown MLs are refused. Closed MLs are accepted
+        here since a post to them may reopen them. Posts over the rate
+        limits are refused temporarily.
+
+        :param address: envelope recipient
+        :type address: str
+        :keyword mailfrom: envelope sender
+        :type mailfrom: str
+        :keyword snapshots: ML snapshots of the envelope to store the ML
+                            in; see lookup_ml()
+        :type snapshots: dict
+        :return: SMTP status to refuse the recipient or None
+        :rtype: str
+        """
+        address = address.lower()
+        if not address.endswith(self.at_domain.lower()):
+            return None
+        ml_name = address[:-len(self.at_domain)]
+        if ml_name.endswith(ERROR_SUFFIX):
+            return None
+        config = self.tenants.find_by_account(ml_name)
+        if config is not None:
+            return self.check_rate(mailfrom, None, config)
+        ml, status = self.lookup_ml(ml_name, projection=ML_PROJECTION)
+        if ml is None:
+            return status
+        if snapshots is not None:
+            snapshots[ml_name] = (time.monotonic(), ml)
+        return self.check_rate(mailfrom, ml_name,
+                               self.tenants.get(ml['tenant_name']))
+
+    def check_rate(self, mailfrom, ml_name, config):
+        """
+        Take a token from the rate limit buckets of the sender, the ML and
+        the tenant. Limits in the tenant override ones in amane.conf.
+
+        :param mailfrom: envelope sender
+        :type mailfrom: str
+        :param ml_name: ML ID or None for a new ML
+        :type ml_name: str
+        :param config: tenant configuration or None
+        :type config: dict
+        :return: SMTP status to refuse the post or None
+        :rtype: str
+        """
+        limits = self.rate_limits
+        if config and config.get('rate_limits'):
+            try:
+                limits = dict(limits, **ratelimit.parse_limits(
+                    config['rate_limits']))
+            except ValueError:
+                logging.exception("Invalid rate limits of %s",
+                                  config['tenant_name'])
+        if not limits:
+            return None
+        sender = None
+        if mailfrom:
+            sender = next(iter(addresses.normalize([mailfrom])),
+                          mailfrom.lower())
+        keys = {"sender": sender, "ml": ml_name,
+                "tenant": config and config['tenant_name']}
+        scope = self.limiter.acquire([
+            ((scope, keys[scope]), rate, burst)
+            for scope, (rate, burst) in limits.items() if keys[scope]])
+        if scope is None:
+            return None
+        logging.warning("Rate limited: %s=%s|", *scope)
+        metrics.incr("rate_limited")
+        metrics.incr("rate_limited." + scope[0])
+        return const.SMTP_STATUS_RATE_LIMITED
+
+    def lookup_ml(self, ml_name, projection=None, snapshots=None):
+        """
+        Aquire a ML, or the SMTP status to refuse a message for it if it
+        wasn't found. Names which can't exist, i.e. recently missed ones
+        and ones numbered beyond the tenant counter, are answered without
+        a database query. A name beyond the tenant counter is refused
+        temporarily unless the counter has just been reloaded, since the
+        ML may have been created by another process whose counter this
+        process hasn't loaded yet.
+        A ML looked up by check_recipient() for the same envelope within
+        SNAPSHOT_TTL seconds is reused without a database query.
+
+        :param ml_name: ML ID
+        :type ml_name: str
+        :keyword projection: fields to return
+        :type projection: dict
+        :keyword snapshots: ML snapshots of the envelope; (time.monotonic()
+                            value, ML object) keyed by ML name
+        :type snapshots: dict
+        :return: ML object and None, or None and SMTP status
+        :rtype: (dict, str)
+        """
+        if snapshots and ml_name in snapshots:
+            taken, ml = snapshots[ml_name]
+            if time.monotonic() - taken < SNAPSHOT_TTL:
+                return ml, None
+        if ml_name in self.missing_mls:
+            logging.error("No such ML: %s", ml_name)
+            return None, const.SMTP_STATUS_NO_SUCH_ML
+        position, reloaded = self.tenants.compare_counter(ml_name)
+        if position is not None and position > 0:
+            if not reloaded:
+                logging.warning("ML beyond the counter: %s", ml_name)
+                return None, const.SMTP_STATUS_TRY_AGAIN_LATER
+            logging.error("No such ML: %s", ml_name)
+            return None, const.SMTP_STATUS_NO_SUCH_ML
+        ml = db.get_ml(ml_name, projection=projection)
+        if ml is not None:
+            return ml, None
+        # A name equal to the counter may be created by another process
+        # soon, so it isn't cached
+        if position is None or position < 0:
+            self.missing_mls.put(ml_name)
+        logging.error("No such ML: %s", ml_name)
+        return None, const.SMTP_STATUS_NO_SUCH_ML
+
+    def is_looped(self, headers):
+        """
+        Check if a message carries the X-Loop stamp of our MLs
+
+        :param headers: message headers
+        :type headers: email.message.Message
+        :rtype: bool
+        """
+        at_domain = self.at_domain.lower()
+        return any(str(_).strip().lower().endswith(at_domain)
+                   for _ in headers.get_all('X-Loop', []))
+
+    def process_bounce(self, ml_name, message):
+        """
+        Score recipients in a bounce and remove members whose score
+        reached the threshold from the ML
+
+        :param ml_name: mailing list ID
+        :type ml_name: str
+        :param message: bounce message
+        :type message: email.message.Message
+        :rtype: None
+        """
+        failures = bounce.parse_dsn(message)
+        if len(failures) == 0:
+            logging.warning("No failed recipients in a bounce for %s",
+                            ml_name)
+            return
+        ml, _ = self.lookup_ml(ml_name, ML_PROJECTION)
+        if ml is None:
+            return
+        members = set(ml.get('members', []))
+        removed = set()
+        for recipient, action, status in failures:
+            metrics.incr("bounces")
+            address = list(addresses.normalize([recipient]) or
+                           [recipient])[0]
+            logging.error("not delivered to %s for %s: action=%s|status=%s|",
+                          address, ml_name, action, status)
+            # Ignore forged bounces for non-members
+            if address not in members:
+                continue
+            if bounce.record(address, ml_name, action, status,
+                             threshold=self.bounce_threshold,
+                             half_life=self.bounce_half_life):
+                removed.add(address)
+        if removed:
+            db.del_members(ml_name, removed, "bounce")
+            template.invalidate_ml(ml_name)
+            logging.warning("Removed bouncing members from %s: %s",
+                            ml_name, removed)
+            metrics.incr("bounce_removed", len(removed))
+
+    def route(self, to, cc):
+        """
+        Find the ML a message is posted to from its To: and Cc: addresses
+
+        :param to: addresses in To:
+        :type to: set(str)
+        :param cc: addresses in Cc:
+        :type cc: set(str)
+        :return: ML address and None, or None and SMTP status to refuse
+                 the message
+        :rtype: tuple
+        """
+        mls = [_ for _ in (to | cc) if _.endswith(self.at_domain)]
+        if len(mls) == 0:
+            logging.error("No ML specified")
+            return None, const.SMTP_STATUS_NO_ML_SPECIFIED
+        elif len(mls) > 1:
+            logging.error("Can't cross-post a message")
+            return None, const.SMTP_STATUS_CANT_CROSS_POST
+        return mls[0], None
+
+    def recipient_statuses(self, rcpttos, data, status):
+        """
+        Aquire LMTP replies for the envelope recipients of a message. A
+        message is routed to the single ML in its To: and Cc:, so the
+        status of the message is replied for that ML and addresses of
+        other domains. Other addresses of our domain among the recipients,
+        e.g. Bcc'd MLs, aren't posted to and are refused one by one.
+        Without a single ML, every recipient gets the status.
+
+        :param rcpttos: envelope recipients
+        :type rcpttos: [str]
+        :param data: message content
+        :type data: bytes
+        :param status: SMTP status of the message
+        :type status: str
+        :return: SMTP status for each recipient
+        :rtype: [str]
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8', errors='surrogateescape')
+        headers = parse_headers(data)
+        mls = [_ for _ in (addresses.parse(str(headers.get('To', ""))) |
+                           addresses.parse(str(headers.get('Cc', ""))))
+               if _.endswith(self.at_domain)]
+        at_domain = self.at_domain.lower()
+        statuses = []
+        for rcptto in rcpttos:
+            address = next(iter(addresses.normalize([rcptto])),
+                           rcptto.lower())
+            if len(mls) == 1 and address not in mls and \
+                    address.endswith(at_domain):
+                logging.error("Not in To: or Cc: %s", address)
+                statuses.append(const.SMTP_STATUS_NOT_ADDRESSED)
+            else:
+                statuses.append(status)
+        return statuses
+
+    def check_message(self, data, snapshots=None):
+        """
+        Check a message with its headers only, as process_message() does
+        before distributing it. Bounces, looped messages and requests for
+        new MLs are accepted.
+
+        :param data: message content
+        :type data: bytes
+        :keyword snapshots: ML snapshots of the envelope; see lookup_ml()
+        :type snapshots: dict
+        :return: SMTP status to refuse the message or None
+        :rtype: str
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8', errors='surrogateescape')
+        headers = parse_headers(data)
+        if self.is_looped(headers):
+            return None
+        ml_address, ret = self.route(
+            addresses.parse(str(headers.get('To', "")).strip()),
+            addresses.parse(str(headers.get('Cc', "")).strip()))
+        if ret:
+            return ret
+        ml_name = ml_address.replace(self.at_domain, "")
+        if ml_name.endswith(ERROR_SUFFIX) or \
+                self.tenants.find_by_account(ml_name) is not None:
+            return None
+        ml, status = self.lookup_ml(ml_name, projection=ML_PROJECTION,
+                                    snapshots=snapshots)
+        if ml is None:
+            return status
+        _from = str(headers.get('From', "")).strip()
+        mailfrom = list(addresses.parse(_from))[0]
+        command = get_header(headers, 'Subject').strip().lower()
+        ctx = MessageContext(ml_name, mailfrom, ml=ml)
+        return self.check_post(ctx, command)[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data, snapshots=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8', errors='surrogateescape')
+
+        # Routing decisions need headers only; the body is parsed once
+        # the message is accepted for distribution
+        headers = parse_headers(data)
+        # Headers with raw 8-bit characters come as Header objects
+        from_str = str(headers.get('From', "")).strip()
+        to_str = str(headers.get('To', "")).strip()
+        cc_str = str(headers.get('Cc', "")).strip()
+        subject = get_header(headers, 'Subject')
         command = subject.strip().lower()
         logging.info("Processing: from=%s|to=%s|cc=%s|subject=%s|",
                      from_str, to_str, cc_str, subject)
 
-        _from = normalize([from_str])
-        to = normalize(to_str.split(','))
-        cc = normalize(cc_str.split(','))
+        _from = addresses.parse(from_str)
+        to = addresses.parse(to_str)
+        cc = addresses.parse(cc_str)
 
         # Quick hack
         mailfrom = list(_from)[0]
 
+        # Drop replies of autoresponders to our posts silently; bouncing
+        # them would keep the loop going
+        if self.is_looped(headers):
+            logging.warning("Dropped a looped message: from=%s|to=%s|",
+                            from_str, to_str)
+            metrics.incr("looped")
+            return
+
         # Check cross-post
-        mls = [_ for _ in (to | cc) if _.endswith(self.at_domain)]
-        if len(mls) == 0:
-            logging.error("No ML specified")
-            return const.SMTP_STATUS_NO_ML_SPECIFIED
-        elif len(mls) > 1:
-            logging.error("Can't cross-post a message")
-            return const.SMTP_STATUS_CANT_CROSS_POST
+        ml_address, ret = self.route(to, cc)
+        if ret:
+            return ret
 
         # Aquire the ML name
-        ml_address = mls[0]
         ml_name = ml_address.replace(self.at_domain, "")
         params = dict(ml_name=ml_name, ml_address=ml_address,
                       mailfrom=mailfrom)
@@ -139,85 +1126,172 @@ class AmaneSMTPServer(smtpd.SMTPServer):
         # Is an error mail?
         if ml_name.endswith(ERROR_SUFFIX):
             ml_name = ml_name.replace(ERROR_SUFFIX, "")
-            error_str = REMOVE_RFC822.sub(
-                "", message.get('Original-Recipient', ""))
-            error = normalize(error_str.split(','))
-            if len(error) > 0 and len(ml_name) > 0:
-                logging.error("not delivered to %s for %s", error, ml_name)
+            if len(ml_name) > 0:
+                self.process_bounce(ml_name, email.message_from_bytes(data))
             return
 
-        # Aquire current tenants
-        tenants = db.find_tenants({"status": const.TENANT_STATUS_ENABLED})
+        # Drop a message delivered again by a retrying MTA. It is
+        # remembered only after being processed, even partly, so that a
+        # message refused temporarily can be retried
+        message_id = str(headers.get('Message-ID', "")).strip()
+        seen_key = (ml_name, message_id) if message_id else None
+        if seen_key is not None and seen_key in self.recent_posts:
+            logging.warning("Dropped a duplicate: ml_name=%s|message_id=%s|",
+                            ml_name, message_id)
+            metrics.incr("duplicates")
+            return
 
         # Want a new ML?
-        for config in tenants:
-            if ml_name == config['new_ml_account']:
-                tenant_name = config['tenant_name']
-                ml_name = config['ml_name_format'] % \
-                    db.increase_counter(config['tenant_name'])
-                members = (to | cc | _from) - config['admins']
-                db.create_ml(tenant_name, ml_name, subject, members, mailfrom)
+        config = self.tenants.find_by_account(ml_name)
+        if config is not None:
+            tenant_name = config['tenant_name']
+            counter = db.increase_counter(tenant_name)
+            self.tenants.update_counter(tenant_name, counter)
+            ml_name = config['ml_name_format'] % counter
+            self.missing_mls.discard(ml_name)
+            members = (to | cc | _from) - config['admins']
+            ctx = MessageContext(ml_name, mailfrom, ml={
+                'tenant_name': tenant_name, 'status': const.STATUS_NEW,
+                'members': members})
+            # The counter is taken; processing the message again would
+            # create another ML
+            ctx.started = True
+            with self.processing(ctx, seen_key):
+                db.create_ml(tenant_name, ml_name, subject, members,
+                             mailfrom)
                 ml_address = ml_name + self.at_domain
                 params = dict(ml_name=ml_name, ml_address=ml_address,
                               mailfrom=mailfrom, members=members)
-                message = ensure_multipart(message, config['charset'])
-                self.send_message(config, ml_name, message, mailfrom, params,
-                                  config['welcome_msg'], 'Welcome.txt')
-                return
+                message = ensure_multipart(email.message_from_bytes(data),
+                                           config['charset'])
+                self.send_message(config, ctx, message, params,
+                                  'welcome_msg', 'Welcome.txt')
+            if seen_key is not None:
+                self.recent_posts.put(seen_key)
+            return
 
         # Post a message to an existing ML
+        ml, status = self.lookup_ml(ml_name, projection=ML_PROJECTION,
+                                    snapshots=snapshots)
+        if ml is None:
+            return status
+        ctx = MessageContext(ml_name, mailfrom, ml=ml)
+        with self.processing(ctx, seen_key):
+            ret = self.process_post(ctx, data, command, params, cc)
+        if ret is None and seen_key is not None:
+            self.recent_posts.put(seen_key)
+        return ret
+
+    @contextlib.contextmanager
+    def processing(self, ctx, seen_key):
+        """
+        Commit the changes in ctx after processing a message, even if it
+        failed. A message which failed after it had side effects is
+        remembered as seen and PartlyProcessed is raised instead of the
+        error, so that neither the spool workers nor the client retry it.
 
+        :param ctx: ML snapshot of the message
+        :type ctx: MessageContext
+        :param seen_key: ML name and Message-ID of the message or None
+        :type seen_key: tuple
+        :raises PartlyProcessed: the message failed after side effects
+        """
+        try:
+            try:
+                yield
+            finally:
+                ctx.commit()
+        except Exception as e:
+            if not ctx.started:
+                raise
+            if seen_key is not None:
+                self.recent_posts.put(seen_key)
+            raise PartlyProcessed(ctx.ml_name) from e
+
+    def check_post(self, ctx, command):
+        """
+        Check a post to an existing ML before it is accepted
+
+        :param ctx: ML snapshot of the message
+        :type ctx: MessageContext
+        :param command: lowercased subject
+        :type command: str
+        :return: tenant configuration and SMTP status to refuse the post
+                 or None
+        :rtype: tuple
+        """
         # Check ML exists
-        ml = db.get_ml(ml_name)
-        if ml is None:
-            logging.error("No such ML: %s", ml_name)
-            return const.SMTP_STATUS_NO_SUCH_ML
+        if ctx.ml is None:
+            logging.error("No such ML: %s", ctx.ml_name)
+            return None, const.SMTP_STATUS_NO_SUCH_ML
 
         # Set config variable
-        for config in tenants:
-            if ml['tenant_name'] == config['new_ml_account']:
-                break
-        else:
-            if config is None:
-                logging.error("No such tenant: %s", ml['tenant_name'])
-                return const.SMTP_STATUS_NO_SUCH_TENANT
-
-        message = ensure_multipart(message, config['charset'])
+        config = self.tenants.get(ctx.ml['tenant_name'])
+        if config is None:
+            logging.error("No such tenant: %s", ctx.ml['tenant_name'])
+            return None, const.SMTP_STATUS_NO_SUCH_TENANT
 
         # Checking whether the sender is one of the ML members
-        members = db.get_members(ml_name)
-        if mailfrom not in (members | config['admins']):
+        if ctx.mailfrom not in (ctx.members | config['admins']):
             logging.error("Non-member post")
-            return const.SMTP_STATUS_NOT_MEMBER
+            return config, const.SMTP_STATUS_NOT_MEMBER
+
+        # Check ML status
+        if ctx.status == const.STATUS_CLOSED and command != "reopen":
+            logging.error("ML is closed: %s", ctx.ml_name)
+            return config, const.SMTP_STATUS_CLOSED_ML
+        return config, None
+
+    def process_post(self, ctx, data, command, params, cc):
+        """
+        Process a post to an existing ML
+
+        :param ctx: ML snapshot of the message
+        :type ctx: MessageContext
+        :param data: the posted message
+        :type data: bytes
+        :param command: lowercased subject
+        :type command: str
+        :param params: template variables
+        :type params: dict
+        :param cc: cc'd addresses except the ML itself
+        :type cc: set(str)
+        :return: SMTP status or None
+        :rtype: str
+        """
+        ml_name = ctx.ml_name
+        mailfrom = ctx.mailfrom
+
+        config, ret = self.check_post(ctx, command)
+        if ret:
+            return ret
 
         # Update parameters
+        members = set(ctx.members)
         new_ml_address = config['new_ml_account'] + self.at_domain
-        params = dict(ml_name=ml_name, ml_address=ml_address,
-                      mailfrom=mailfrom, new_ml_address=new_ml_address,
-                      members=members)
+        params.update(new_ml_address=new_ml_address, members=members)
+        ml_status = ctx.status
 
-        # Check ML status
-        ml_status = ml['status']
-        if ml_status == const.STATUS_CLOSED:
-            if command == "reopen":
-                self.send_message(config, ml_name, message, mailfrom, params,
-                                  config['reopen_msg'], 'Reopen.txt')
-                db.change_ml_status(ml_name, const.STATUS_OPEN, mailfrom)
-                logging.info("reopened %s by %s", ml_name, mailfrom)
-                return
+        # Accepted; parse the whole message
+        message = ensure_multipart(email.message_from_bytes(data),
+                                   config['charset'])
 
-            logging.error("ML is closed: %s", ml_name)
-            return const.SMTP_STATUS_CLOSED_ML
+        if ml_status == const.STATUS_CLOSED:
+            self.send_message(config, ctx, message, params,
+                              'reopen_msg', 'Reopen.txt')
+            ctx.change_status(const.STATUS_OPEN)
+            logging.info("reopened %s by %s", ml_name, mailfrom)
+            return
 
         elif command == "close":
-            self.send_message(config, ml_name, message, mailfrom, params,
-                              config['goodbye_msg'], 'Goodbye.txt')
-            db.change_ml_status(ml_name, const.STATUS_CLOSED, mailfrom)
+            self.send_message(config, ctx, message, params,
+                              'goodbye_msg', 'Goodbye.txt')
+            ctx.change_status(const.STATUS_CLOSED)
             logging.info("closed %s by %s", ml_name, mailfrom)
             return
 
         if ml_status != const.STATUS_OPEN:
-            db.change_ml_status(ml_name, const.STATUS_OPEN, mailfrom)
+            ctx.change_status(const.STATUS_OPEN)
 
         # Remove admin members from cc
         cc -= config['admins']
@@ -227,41 +1301,40 @@ class AmaneSMTPServer(smtpd.SMTPServer):
         if command == "":
             if len(cc) > 0:
                 params['members'] = members - cc
-                self.send_message(config, ml_name, message, mailfrom, params,
-                                  config['remove_msg'], 'RemoveMembers.txt')
-                db.del_members(ml_name, cc, mailfrom)
+                self.send_message(config, ctx, message, params,
+                                  'remove_msg', 'RemoveMembers.txt')
+                ctx.del_members(cc)
                 logging.info("removed %s from %s", cc, ml_name)
             return
 
         # Checking Cc:
         if len(cc) > 0:
-            db.add_members(ml_name, cc, mailfrom)
+            ctx.add_members(cc)
             logging.info("added %s into %s", cc, ml_name)
-            members = db.get_members(ml_name)
-            params['members'] = members
-            self.send_message(config, ml_name, message, mailfrom, params,
-                              config['add_msg'], 'AddMembers.txt')
+            params['members'] = set(ctx.members)
+            self.send_message(config, ctx, message, params,
+                              'add_msg', 'AddMembers.txt')
             return
 
         # Attach readme and send the post
-        self.send_message(config, ml_name, message, mailfrom, params,
-                          config['readme_msg'], 'Readme.txt')
+        self.send_message(config, ctx, message, params,
+                          'readme_msg', 'Readme.txt')
 
-    def send_message(self, config, ml_name, message, mailfrom, params,
-                     template, filename, charset="utf-8"):
+    def send_message(self, config, ctx, message, params,
+                     template_name, filename, charset="utf-8"):
         try:
-            content = ""
-            if template:
-                temp = Environment(newline_sequence='\r\n')
-                content = temp.from_string(template).render(params)
-            part = MIMEText(content, _charset=charset)
-            part.set_param('name', filename)
+            part = template.render_part(
+                config['tenant_name'], template_name, config[template_name],
+                params, ctx.ml_name, filename, version=config.get('updated'),
+                charset=charset)
             message.attach(part)
         finally:
-            members = db.get_members(ml_name) | config['admins']
-            self.send_post(ml_name, message, mailfrom, members)
+            members = ctx.members | config['admins']
+            ctx.started = True
+            self.send_post(ctx.ml_name, message, ctx.mailfrom, members,
+                           ctx=ctx)
 
-    def send_post(self, ml_name, message, mailfrom, members):
+    def send_post(self, ml_name, message, mailfrom, members, ctx=None):
         """
         Send a post to the ML members
 
@@ -273,6 +1346,9 @@ class AmaneSMTPServer(smtpd.SMTPServer):
         :type mailfrom: str
         :param members: recipients
         :type members: set(str)
+        :keyword ctx: ML snapshot to record the post in; if omitted, the
+                      post is logged into the database immediately
+        :type ctx: MessageContext
         :rtype: None
         """
 
@@ -282,27 +1358,27 @@ class AmaneSMTPServer(smtpd.SMTPServer):
         del(message['To'])
         del(message['Reply-To'])
         del(message['Return-Path'])
+        del(message['List-Id'])
         message.add_header('To',  _to)
         message.add_header('Reply-To', _to)
         message.add_header('Return-Path', _from)
-        subject = message.get('Subject', '')
-        try:
-            subject = str(make_header(decode_header(subject)))
-        except:
-            pass
+        message.add_header('X-Loop', _to)
+        message.add_header('List-Id', "<%s.%s>" % (ml_name,
+                                                   self.at_domain[1:]))
+        subject = get_header(message, 'Subject')
         subject = re.sub(r"^(re:|\[%s\]|\s)*" % ml_name, "[%s] " % ml_name,
                          subject, flags=re.I)
         message.replace_header('Subject', Header(subject, 'iso-2022-jp'))
 
-        # Send a post to the relay host
-        relay = smtplib.SMTP(self.relay_host, self.relay_port)
-        if self.debug:
-            relay.set_debuglevel(1)
-        relay.sendmail(_from, members, message.as_string())
-        relay.quit()
-        logging.info("Sent: ml_name=%s|mailfrom=%s|members=%s|",
-                     ml_name, mailfrom, members)
-        db.log_post(ml_name, members, mailfrom)
+        # Send a post to the relay host; deferred ones are retried later
+        delivery = self.outbox.send(ml_name, _from, members,
+                                    as_bytes(message))
+        logging.info("Sent: ml_name=%s|mailfrom=%s|members=%s|delivery=%s|",
+                     ml_name, mailfrom, members, delivery)
+        if ctx is None:
+            db.log_post(ml_name, members, mailfrom, delivery=delivery)
+        else:
+            ctx.log_post(members, mailfrom, delivery=delivery)
 
 
 def main():
@@ -320,6 +1396,9 @@ def main():
                         help='cofiguration file',
                         type=argparse.FileType('r'),
                         default=CONFIG_FILE)
+    parser.add_argument('--workers',
+                        help='Number of worker processes',
+                        type=int)
 
     opts = parser.parse_args()
 
@@ -327,15 +1406,75 @@ def main():
         print(pbr.version.VersionInfo('amane'))
         return 0
 
-    config = yaml.load(opts.config_file)
+    workers = opts.workers
+    config = read_config(opts.config_file)
     for key, value in config.items():
         setattr(opts, key, value)
+    # Kept to be read again on SIGHUP
+    opts.config_file = getattr(opts.config_file, 'name', None)
+    opts.workers = workers or getattr(opts, 'workers', None) or 1
 
     log.setup(filename=opts.log_file, debug=opts.debug)
     logging.debug("args: %s", opts.__dict__)
 
+    if opts.workers > 1:
+        return serve_prefork(opts)
+
     server = AmaneSMTPServer(**opts.__dict__)
-    asyncore.loop()
+    if server.serve_forever():
+        # Threads of abandoned jobs would be joined on exit
+        logging.shutdown()
+        os._exit(1)
+
+
+def serve_prefork(opts):
+    """
+    Run AmaneSMTPServer in worker processes sharing the listening port
+    or UNIX domain socket
+
+    :param opts: parameters of AmaneSMTPServer
+    :type opts: argparse.Namespace
+    :return: exit code
+    :rtype: int
+    """
+    on_exit = None
+    spool_dir = getattr(opts, 'spool_dir', None)
+    if spool_dir:
+        _spool = spool.Spool(spool_dir)
+        _spool.recover()
+        on_exit = _spool.recover
+
+    # A UNIX domain socket can't be bound by each worker; share one
+    listen_socket = getattr(opts, 'listen_socket', None)
+    sock = bind_unix_socket(listen_socket) if listen_socket else None
+
+    def target():
+        # Each worker needs its own DB connection; create it after fork
+        server = AmaneSMTPServer(**opts.__dict__)
+        server.serve_forever(reuse_port=True, recover_spool=False, sock=sock)
+
+    def on_reload():
+        # Workers reload amane.conf by themselves; the ones restarted
+        # later are created with the new parameters
+        try:
+            config = read_config(opts.config_file)
+        except Exception:
+            logging.exception("Failed to reload %s", opts.config_file)
+            return
+        for key, value in config.items():
+            if key not in RESTART_KEYS:
+                setattr(opts, key, value)
+        log.reopen(filename=getattr(opts, 'log_file', None),
+                   debug=opts.debug)
+
+    supervisor = prefork.Supervisor(target, opts.workers, on_exit=on_exit,
+                                    on_reload=on_reload)
+    try:
+        return supervisor.run()
+    finally:
+        if sock is not None:
+            sock.close()
+            os.remove(listen_socket)
 
 
 if __name__ == '__main__':
@@ -24,12 +24,27 @@ STATUS_CLOSED = "closed"
 
 TENANT_STATUS_ENABLED = "enabled"
 TENANT_STATUS_DISABLED = "disabled"
+# Tenant parameters which older tenant documents may lack
+TENANT_OPTIONAL_KEYS = ["rate_limits"]
 
+MAIL_STATUS_QUEUED = "queued"
+MAIL_STATUS_SENDING = "sending"
+MAIL_STATUS_DEFERRED = "deferred"
+MAIL_STATUS_SENT = "sent"
+MAIL_STATUS_FAILED = "failed"
+
+SMTP_STATUS_OK = "250 OK"
+SMTP_STATUS_LOCAL_ERROR = "451 Local error in processing"
+SMTP_STATUS_TRY_AGAIN_LATER = "451 4.3.2 Try again later"
+SMTP_STATUS_RATE_LIMITED = "451 4.7.1 Rate limit exceeded"
+SMTP_STATUS_SHUTTING_DOWN = "421 4.3.2 Service shutting down"
 SMTP_STATUS_CLOSED_ML = "550 ML is closed"
 SMTP_STATUS_NO_SUCH_ML = "550 No such ML"
+SMTP_STATUS_NO_SUCH_TENANT = "550 No such tenant"
 SMTP_STATUS_NOT_MEMBER = "550 Not member"
 SMTP_STATUS_NO_ML_SPECIFIED = "550 No ML specified"
 SMTP_STATUS_CANT_CROSS_POST = "550 Can't cross-post a message"
+SMTP_STATUS_NOT_ADDRESSED = "550 ML isn't in To: or Cc:"
 
 OP_CREATE = "create"
 OP_UPDATE = "update"
@@ -18,7 +18,7 @@ Database handler
 """
 
 import copy
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import pymongo
 import time
@@ -28,8 +28,66 @@ from . import const
 
 DB = None
 
-
-def init_db(db_url, db_name):
+# Errors which may go away by retrying
+TRANSIENT_ERRORS = (pymongo.errors.ConnectionFailure,
+                    pymongo.errors.ExecutionTimeout)
+
+# Indexes for the queries below; (collection, keys, options)
+INDEXES = [
+    ('ml', [('ml_name', pymongo.ASCENDING)],
+     {'name': 'ml_name', 'unique': True}),
+    ('ml', [('tenant_name', pymongo.ASCENDING),
+            ('status', pymongo.ASCENDING),
+            ('updated', pymongo.ASCENDING)],
+     {'name': 'tenant_name_status_updated'}),
+    ('ml', [('status', pymongo.ASCENDING),
+            ('updated', pymongo.ASCENDING)],
+     {'name': 'status_updated'}),
+    ('ml_log', [('ml_name', pymongo.ASCENDING),
+                ('time', pymongo.ASCENDING)],
+     {'name': 'ml_name_time'}),
+    ('tenant', [('tenant_name', pymongo.ASCENDING)],
+     {'name': 'tenant_name', 'unique': True}),
+    ('tenant', [('new_ml_account', pymongo.ASCENDING)],
+     {'name': 'new_ml_account', 'unique': True}),
+    ('tenant', [('status', pymongo.ASCENDING)],
+     {'name': 'status'}),
+    ('outbox', [('status', pymongo.ASCENDING),
+                ('next_try', pymongo.ASCENDING)],
+     {'name': 'status_next_try'}),
+    ('bounce', [('address', pymongo.ASCENDING)],
+     {'name': 'address', 'unique': True}),
+]
+
+# Typical queries issued by this module; (name, collection, cond, sort)
+QUERIES = [
+    ('get_ml', 'ml', {'ml_name': ''}, None),
+    ('find_mls (reviewer)', 'ml',
+     {'tenant_name': '', 'status': const.STATUS_OPEN,
+      'updated': {'$lte': datetime.now()}},
+     [('updated', pymongo.ASCENDING)]),
+    ('find_mls (reporter)', 'ml', {'status': const.STATUS_OPEN},
+     [('updated', pymongo.ASCENDING)]),
+    ('mark_mls_orphaned', 'ml',
+     {'status': const.STATUS_OPEN, 'updated': {'$lt': datetime.now()}},
+     None),
+    ('get_logs', 'ml_log', {'ml_name': ''},
+     [('time', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+    ('get_tenant', 'tenant', {'tenant_name': ''}, None),
+    ('create_tenant', 'tenant', {'new_ml_account': ''}, None),
+    ('find_tenants', 'tenant', {'status': const.TENANT_STATUS_ENABLED},
+     None),
+    ('claim_mail', 'outbox',
+     {'status': {'$in': [const.MAIL_STATUS_QUEUED,
+                         const.MAIL_STATUS_DEFERRED,
+                         const.MAIL_STATUS_SENDING]},
+      'next_try': {'$lte': datetime.now()}},
+     [('next_try', pymongo.ASCENDING)]),
+    ('get_bounce', 'bounce', {'address': ''}, None),
+]
+
+
+def init_db(db_url, db_name, create_indexes=True):
     """
     Initialize DB object
 
@@ -37,11 +95,71 @@ def init_db(db_url, db_name):
     :type db_url: str
     :param db_name: Database name to use
     :type db_name: str
+    :keyword create_indexes: Create missing indexes or not
+    :type create_indexes: bool
     :rtype: None
     """
     global DB
     client = pymongo.MongoClient(db_url)
     DB = client[db_name]
+    if create_indexes:
+        try:
+            ensure_indexes()
+        except pymongo.errors.OperationFailure as e:
+            logging.error("Failed to create indexes: %s", e)
+
+
+def ensure_indexes():
+    """
+    Create indexes declared in INDEXES if missing
+    This is an idempotent operation.
+
+    :return: names of indexes per collection
+    :rtype: dict
+    """
+    result = {}
+    for collection, keys, options in INDEXES:
+        name = DB[collection].create_index(keys, **options)
+        result.setdefault(collection, []).append(name)
+    logging.debug("indexes: %s", result)
+    return result
+
+
+def _plan_indexes(plan):
+    result = set()
+    if isinstance(plan, list):
+        for i in plan:
+            result |= _plan_indexes(i)
+    elif isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            result.add('COLLSCAN')
+        if 'indexName' in plan:
+            result.add(plan['indexName'])
+        for value in plan.values():
+            result |= _plan_indexes(value)
+    return result
+
+
+def explain_queries():
+    """
+    Show indexes used by typical queries of this module
+
+    :return: index names (or COLLSCAN) keyed by query name
+    :rtype: dict
+    """
+    result = {}
+    for name, collection, cond, sort in QUERIES:
+        cursor = DB[collection].find(cond)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        result[name] = sorted(_plan_indexes(plan))
+    return result
+
+
+def _log(ml_name, log_dict):
+    log_dict = dict(log_dict, ml_name=ml_name, time=datetime.now())
+    DB.ml_log.insert_one(log_dict)
 
 
 def increase_counter(tenant_name):
@@ -117,6 +235,7 @@ def create_tenant(tenant_name, by, config):
         "orphaned_msg": config["orphaned_msg"],
         "closed_subject": config["closed_subject"],
         "closed_msg": config["closed_msg"],
+        "rate_limits": config.get("rate_limits", {}),
     }
     DB.tenant.insert_one(tenant_dict)
     logging.debug("Tenant %s created: %s", tenant_name, tenant_dict)
@@ -158,10 +277,10 @@ def update_tenant(tenant_name, by, **config):
         "config": config,
         "by": by,
     }
-    for key, value in config.items():
+    for key, value in list(config.items()):
         if key in ["tenant_name", "by", "created", "updated", "logs"]:
             continue
-        if key not in tenant:
+        if key not in tenant and key not in const.TENANT_OPTIONAL_KEYS:
             config.pop(key)
         if key == "admins":
             config[key] = list(value)
@@ -183,6 +302,9 @@ def delete_tenant(tenant_name):
     :type tenant_name: str
     :rtype: None
     """
+    ml_names = [_['ml_name'] for _ in
+                DB.ml.find({'tenant_name': tenant_name}, {'ml_name': 1})]
+    DB.ml_log.delete_many({'ml_name': {'$in': ml_names}})
     DB.ml.delete_many({'tenant_name': tenant_name})
     DB.tenant.delete_one({'tenant_name': tenant_name})
     if logging.root.level == logging.DEBUG:
@@ -205,7 +327,7 @@ def get_tenant(tenant_name):
     return tenant
 
 
-def find_tenants(cond, sortkey=None, reverse=False):
+def find_tenants(cond, sortkey=None, reverse=False, projection=None):
     """
     Aquire tenants with conditions
     This is an atomic operation.
@@ -216,22 +338,53 @@ def find_tenants(cond, sortkey=None, reverse=False):
     :type sortkey: str
     :keyword reverse: Reverse sort or not
     :type reverse: bool
+    :keyword projection: fields to include or exclude
+    :type projection: dict
     :return: tenant objects
     :rtype: [dict]
     """
     if sortkey:
         if reverse:
-            data = list(DB.tenant.find(cond, sort=[(sortkey, -1)]))
+            data = list(DB.tenant.find(cond, projection,
+                                       sort=[(sortkey, -1)]))
         else:
-            data = list(DB.tenant.find(cond, sort=[(sortkey, 1)]))
+            data = list(DB.tenant.find(cond, projection,
+                                       sort=[(sortkey, 1)]))
     else:
-        data = list(DB.tenant.find(cond))
+        data = list(DB.tenant.find(cond, projection))
 
     for i in data:
         i["admins"] = set(i["admins"])
     return data
 
 
+def get_tenant_versions(cond):
+    """
+    Aquire last updated times of tenants with conditions
+    This is an atomic operation.
+
+    :param cond: Conditions
+    :type cond: dict
+    :return: last updated times keyed by tenant ID
+    :rtype: dict
+    """
+    return {_['tenant_name']: _['updated']
+            for _ in DB.tenant.find(cond, {'tenant_name': 1, 'updated': 1})}
+
+
+def get_tenant_counters(cond):
+    """
+    Aquire current counters of tenants with conditions
+
+    :param cond: Conditions
+    :type cond: dict
+    :return: counters keyed by tenant ID
+    :rtype: dict
+    """
+    return {_['tenant_name']: _['counter']
+            for _ in DB.tenant.find(cond, {'tenant_name': 1, 'counter': 1})}
+
+
 def create_ml(tenant_name, ml_name, subject, members, by):
     """
     Create a new ML and register members into it
@@ -269,23 +422,25 @@ def create_ml(tenant_name, ml_name, subject, members, by):
         "updated": datetime.now(),
         "status": const.STATUS_NEW,
         "by": by,
-        "logs": [log_dict]
     }
     DB.ml.insert_one(ml_dict)
+    _log(ml_name, log_dict)
     logging.debug("created: %s", ml_dict)
 
 
-def get_ml(ml_name):
+def get_ml(ml_name, projection=None):
     """
     Aquire a ML
     This is an atomic operation.
 
     :param ml_name: ML ID
     :type ml_name: str
+    :keyword projection: fields to return
+    :type projection: dict
     :return: ML object
     :rtype: dict
     """
-    ml = DB.ml.find_one({'ml_name': ml_name})
+    ml = DB.ml.find_one({'ml_name': ml_name}, projection=projection)
     return ml
 
 
@@ -312,6 +467,19 @@ def find_mls(cond, sortkey=None, reverse=False):
         return DB.ml.find(cond)
 
 
+def _mark_mls(cond, status, log_dict):
+    ml_names = [_['ml_name'] for _ in DB.ml.find(cond, {'ml_name': 1})]
+    if len(ml_names) == 0:
+        return
+    cond = dict(cond, ml_name={'$in': ml_names})
+    DB.ml.update_many(cond, {'$set': {'status': status,
+                                      'updated': datetime.now(),
+                                      'by': log_dict['by']}})
+    now = datetime.now()
+    DB.ml_log.insert_many([dict(log_dict, ml_name=_, time=now)
+                           for _ in ml_names])
+
+
 def mark_mls_orphaned(last_updated, by):
     """
     Mark old MLs orphaned if they are updated before last_updated
@@ -328,12 +496,9 @@ def mark_mls_orphaned(last_updated, by):
         "op": const.OP_ORPHAN,
         "by": by,
     }
-    DB.ml.update_many({'status': const.STATUS_OPEN,
-                       'updated': {'$lt': last_updated}},
-                      {'$set': {'status': const.STATUS_ORPHANED,
-                                'updated': datetime.now(),
-                                'by': by},
-                       '$push': {'logs': log_dict}})
+    _mark_mls({'status': const.STATUS_OPEN,
+               'updated': {'$lt': last_updated}},
+              const.STATUS_ORPHANED, log_dict)
     result = DB.ml.find({'status': const.STATUS_ORPHANED})
     logging.debug("orphaned: %s", [_['ml_name'] for _ in result])
     return result
@@ -355,12 +520,9 @@ def mark_mls_closed(last_updated, by):
         "op": const.OP_CLOSE,
         "by": by,
     }
-    DB.ml.update_many({'status': const.STATUS_ORPHANED,
-                       'updated': {'$lt': last_updated}},
-                      {'$set': {'status': const.STATUS_CLOSED,
-                                'updated': datetime.now(),
-                                'by': by},
-                       '$push': {'logs': log_dict}})
+    _mark_mls({'status': const.STATUS_ORPHANED,
+               'updated': {'$lt': last_updated}},
+              const.STATUS_CLOSED, log_dict)
     result = DB.ml.find({'status': const.STATUS_CLOSED})
     logging.debug("closed: %s", [_['ml_name'] for _ in result])
     return result
@@ -385,16 +547,29 @@ def change_ml_status(ml_name, status, by):
     DB.ml.update_many({'ml_name': ml_name},
                       {'$set': {'status': status,
                                 'updated': datetime.now(),
-                                'by': by},
-                       '$push': {'logs': log_dict}})
+                                'by': by}})
+    _log(ml_name, log_dict)
     logging.debug("status changed: ml_name=%s|status=%s|by=%s",
                   ml_name, status, by)
 
 
+def _update_members(ml_name, update, log_dict):
+    update['$set'] = {'updated': datetime.now(), 'by': log_dict['by']}
+    ml = DB.ml.find_one_and_update(
+        {'ml_name': ml_name}, update, projection={'members': 1},
+        return_document=pymongo.ReturnDocument.AFTER)
+    if ml is None:
+        logging.error("ML %s not found", ml_name)
+        return None
+    _log(ml_name, log_dict)
+    logging.debug("after: %s", ml)
+    return set(ml.get('members', []))
+
+
 def add_members(ml_name, members, by):
     """
     Add e-mail addresses of new members into a ML
-    This ISN'T an atomic operation.
+    This is an atomic operation.
 
     :param ml_name: mailing list ID
     :type ml_name: str
@@ -402,57 +577,40 @@ def add_members(ml_name, members, by):
     :type members: set(str)
     :param by: sender's e-mail address
     :type by: str
-    :rtype: None
+    :return: members after the operation
+    :rtype: set(str)
     """
-    ml = DB.ml.find_one({'ml_name': ml_name})
-    logging.debug("before: %s", ml)
-    _members = set(ml.get('members', []))
-    _members |= members
     log_dict = {
         "op": const.OP_ADD_MEMBERS,
         "by": by,
         "members": list(members),
     }
-    DB.ml.find_one_and_update({'ml_name': ml_name},
-                              {'$set': {'members': list(_members),
-                                        'updated': datetime.now(),
-                                        'by': by},
-                               '$push': {'logs': log_dict}})
-    if logging.root.level == logging.DEBUG:
-        ml = DB.ml.find_one({'ml_name': ml_name})
-        logging.debug("after: %s", ml)
+    return _update_members(
+        ml_name, {'$addToSet': {'members': {'$each': list(members)}}},
+        log_dict)
 
 
 def del_members(ml_name, members, by):
     """
     Remove e-mail addresses of members from a ML
-    This ISN'T an atomic operation.
+    This is an atomic operation.
 
     :param ml_name: mailing list ID
     :type ml_name: str
-    :param members: e-mail addresses to add
+    :param members: e-mail addresses to remove
     :type members: set(str)
     :param by: sender's e-mail address
     :type by: str
-    :rtype: None
+    :return: members after the operation
+    :rtype: set(str)
     """
-    ml = DB.ml.find_one({'ml_name': ml_name})
-    logging.debug("before: %s", ml)
-    _members = set(ml.get('members', []))
-    _members -= members
     log_dict = {
         "op": const.OP_DEL_MEMBERS,
         "by": by,
         "members": list(members),
     }
-    DB.ml.find_one_and_update({'ml_name': ml_name},
-                              {'$set': {'members': list(_members),
-                                        'updated': datetime.now(),
-                                        'by': by},
-                               '$push': {'logs': log_dict}})
-    if logging.root.level == logging.DEBUG:
-        ml = DB.ml.find_one({'ml_name': ml_name})
-        logging.debug("after: %s", ml)
+    return _update_members(
+        ml_name, {'$pull': {'members': {'$in': list(members)}}}, log_dict)
 
 
 def get_members(ml_name):
@@ -471,7 +629,7 @@ def get_members(ml_name):
     return set(ml.get('members', []))
 
 
-def log_post(ml_name, members, by):
+def log_post(ml_name, members, by, delivery=None):
     """
     Append a log about sending a post to a ML
     This is an atomic operation.
@@ -482,6 +640,8 @@ def log_post(ml_name, members, by):
     :type members: set(str)
     :param by: sender's e-mail address
     :type by: str
+    :keyword delivery: numbers of recipients keyed by delivery status
+    :type delivery: dict
     :rtype: None
     """
     if logging.root.level == logging.DEBUG:
@@ -492,29 +652,296 @@ def log_post(ml_name, members, by):
         "by": by,
         "members": list(members),
     }
+    if delivery:
+        log_dict['delivery'] = delivery
     DB.ml.find_one_and_update({'ml_name': ml_name},
                               {'$set': {'updated': datetime.now(),
-                                        'by': by},
-                               '$push': {'logs': log_dict}})
+                                        'by': by}})
+    _log(ml_name, log_dict)
     if logging.root.level == logging.DEBUG:
         ml = DB.ml.find_one({'ml_name': ml_name})
         logging.debug("after: %s", ml)
 
 
-def get_logs(ml_name):
+def update_ml(ml_name, by, status=None, add=None, delete=None, logs=None):
+    """
+    Apply changes made while processing a message to a ML at once.
+    Status, members and the last update are altered in one update and
+    the logs are appended in one insert. Adding and removing members in
+    the same call isn't allowed since they touch the same field.
+
+    :param ml_name: mailing list ID
+    :type ml_name: str
+    :param by: sender's e-mail address
+    :type by: str
+    :keyword status: new status or None to keep it
+    :type status: str
+    :keyword add: e-mail addresses to add
+    :type add: set(str)
+    :keyword delete: e-mail addresses to remove
+    :type delete: set(str)
+    :keyword logs: operation logs to append
+    :type logs: [dict]
+    :rtype: None
     """
-    Show operation logs of a ML
+    if add and delete:
+        raise ValueError("can't add and remove members at once")
+    now = datetime.now()
+    update = {'$set': {'updated': now, 'by': by}}
+    if status is not None:
+        update['$set']['status'] = status
+    if add:
+        update['$addToSet'] = {'members': {'$each': list(add)}}
+    if delete:
+        update['$pull'] = {'members': {'$in': list(delete)}}
+    DB.ml.update_one({'ml_name': ml_name}, update)
+    if logs:
+        DB.ml_log.insert_many([dict(_, ml_name=ml_name, time=now)
+                               for _ in logs])
+    logging.debug("updated: ml_name=%s|update=%s|", ml_name, update)
+
+
+def get_logs(ml_name, skip=0, limit=0):
+    """
+    Show operation logs of a ML in chronological order
     This is an atomic operation.
 
     :param ml_name: mailing list ID
     :type ml_name: str
+    :keyword skip: number of logs to skip
+    :type skip: int
+    :keyword limit: maximum number of logs to return; 0 means no limit
+    :type limit: int
     :return: operation logs
     :rtype: list[dict]
     """
-    ml = DB.ml.find_one({'ml_name': ml_name})
-    if ml is None:
+    if DB.ml.count_documents({'ml_name': ml_name}, limit=1) == 0:
         return None
-    for log in ml['logs']:
+    logs = list(DB.ml_log.find({'ml_name': ml_name},
+                               {'_id': 0, 'ml_name': 0},
+                               sort=[('time', 1), ('_id', 1)],
+                               skip=skip, limit=limit))
+    for log in logs:
         if 'members' in log:
             log['members'] = set(log['members'])
-    return ml['logs']
+    return logs
+
+
+def migrate_logs():
+    """
+    Move operation logs embedded in ML objects to the ml_log collection.
+    Logs of a ML are copied before they are removed from it, so the
+    migration can be restarted safely.
+
+    :return: number of migrated MLs
+    :rtype: int
+    """
+    count = 0
+    for ml in DB.ml.find({'logs': {'$exists': True}},
+                         {'ml_name': 1, 'created': 1, 'logs': 1}):
+        ml_name = ml['ml_name']
+        DB.ml_log.delete_many({'ml_name': ml_name, 'migrated': True})
+        logs = [dict(_, ml_name=ml_name, time=ml['created'], migrated=True)
+                for _ in ml['logs']]
+        if logs:
+            DB.ml_log.insert_many(logs)
+        DB.ml.update_one({'_id': ml['_id']}, {'$unset': {'logs': ''}})
+        logging.debug("migrated %d logs of %s", len(logs), ml_name)
+        count += 1
+    return count
+
+
+def enqueue_mail(ml_name, mailfrom, rcpttos, message,
+                 status=const.MAIL_STATUS_QUEUED, error=None, next_try=None):
+    """
+    Store an outbound message into the delivery queue
+
+    :param ml_name: mailing list ID
+    :type ml_name: str
+    :param mailfrom: envelope sender
+    :type mailfrom: str
+    :param rcpttos: envelope recipients
+    :type rcpttos: set(str)
+    :param message: message to send
+    :type message: str
+    :keyword status: initial status; 'queued', 'deferred' or 'failed'
+    :type status: str
+    :keyword error: last delivery error
+    :type error: str
+    :keyword next_try: time to try delivery; now if omitted
+    :type next_try: datetime
+    :return: mail ID
+    :rtype: bson.objectid.ObjectId
+    """
+    now = datetime.now()
+    mail = {
+        "ml_name": ml_name,
+        "mailfrom": mailfrom,
+        "rcpttos": sorted(rcpttos),
+        "message": message,
+        "status": status,
+        "attempts": 0 if status == const.MAIL_STATUS_QUEUED else 1,
+        "error": error,
+        "next_try": next_try or now,
+        "created": now,
+        "updated": now,
+    }
+    DB.outbox.insert_one(mail)
+    logging.debug("queued: ml_name=%s|status=%s|", ml_name, status)
+    return mail['_id']
+
+
+def claim_mail(lease):
+    """
+    Take the next outbound message to deliver. The message is reserved
+    for lease seconds, after which it can be claimed again in case the
+    worker has died.
+    This is an atomic operation.
+
+    :param lease: seconds to reserve the message
+    :type lease: int
+    :return: mail object or None
+    :rtype: dict
+    """
+    now = datetime.now()
+    return DB.outbox.find_one_and_update(
+        {'status': {'$in': [const.MAIL_STATUS_QUEUED,
+                            const.MAIL_STATUS_DEFERRED,
+                            const.MAIL_STATUS_SENDING]},
+         'next_try': {'$lte': now}},
+        {'$set': {'status': const.MAIL_STATUS_SENDING,
+                  'next_try': now + timedelta(seconds=lease),
+                  'updated': now}},
+        sort=[('next_try', pymongo.ASCENDING)],
+        return_document=pymongo.ReturnDocument.AFTER)
+
+
+def finish_mail(mail_id, status, rcpttos=None, error=None, next_try=None):
+    """
+    Record the result of a delivery attempt. The message body is
+    discarded once it has been sent.
+    This is an atomic operation.
+
+    :param mail_id: mail ID
+    :type mail_id: bson.objectid.ObjectId
+    :param status: 'sent', 'deferred' or 'failed'
+    :type status: str
+    :keyword rcpttos: recipients left to retry
+    :type rcpttos: [str]
+    :keyword error: delivery error
+    :type error: str
+    :keyword next_try: time of the next attempt
+    :type next_try: datetime
+    :rtype: None
+    """
+    update = {'$set': {'status': status, 'error': error,
+                       'updated': datetime.now()},
+              '$inc': {'attempts': 1}}
+    if rcpttos is not None:
+        update['$set']['rcpttos'] = sorted(rcpttos)
+    if next_try is not None:
+        update['$set']['next_try'] = next_try
+    if status == const.MAIL_STATUS_SENT:
+        update['$unset'] = {'message': ""}
+    DB.outbox.update_one({'_id': mail_id}, update)
+    logging.debug("delivery finished: id=%s|status=%s|", mail_id, status)
+
+
+def find_mails(cond, sortkey=None, reverse=False):
+    """
+    Aquire outbound messages without their bodies
+    This is an atomic operation.
+
+    :param cond: Conditions
+    :type cond: dict
+    :keyword sortkey: sort pattern
+    :type sortkey: str
+    :keyword reverse: Reverse sort or not
+    :type reverse: bool
+    :return: mail objects
+    :rtype: [dict]
+    """
+    projection = {'message': 0}
+    if sortkey:
+        if reverse:
+            return DB.outbox.find(cond, projection, sort=[(sortkey, -1)])
+        else:
+            return DB.outbox.find(cond, projection, sort=[(sortkey, 1)])
+    else:
+        return DB.outbox.find(cond, projection)
+
+
+def count_mails(cond):
+    """
+    Count mails in the outbox with conditions
+
+    :param cond: Conditions
+    :type cond: dict
+    :return: number of mails
+    :rtype: int
+    """
+    return DB.outbox.count_documents(cond)
+
+
+def get_bounce(address):
+    """
+    Aquire the bounce record of an e-mail address
+    This is an atomic operation.
+
+    :param address: e-mail address
+    :type address: str
+    :return: bounce object or None
+    :rtype: dict
+    """
+    return DB.bounce.find_one({'address': address})
+
+
+def update_bounce(address, ml_name, score, status, removed=False):
+    """
+    Store the bounce score of an e-mail address
+    This is an atomic operation.
+
+    :param address: e-mail address
+    :type address: str
+    :param ml_name: mailing list ID the bounce came for
+    :type ml_name: str
+    :param score: new score
+    :type score: float
+    :param status: delivery status of the bounce
+    :type status: str
+    :keyword removed: the address is removed from the ML or not
+    :type removed: bool
+    :rtype: None
+    """
+    update = {'$set': {'score': score, 'status': status,
+                       'updated': datetime.now()},
+              '$inc': {'count': 1},
+              '$addToSet': {'ml_names': ml_name}}
+    if removed:
+        update['$addToSet']['removed'] = ml_name
+    DB.bounce.update_one({'address': address}, update, upsert=True)
+    logging.debug("bounce updated: address=%s|ml_name=%s|score=%s|",
+                  address, ml_name, score)
+
+
+def find_bounces(cond, sortkey=None, reverse=False):
+    """
+    Aquire bounce records with conditions
+    This is an atomic operation.
+
+    :param cond: Conditions
+    :type cond: dict
+    :keyword sortkey: sort pattern
+    :type sortkey: str
+    :keyword reverse: Reverse sort or not
+    :type reverse: bool
+    :return: bounce objects
+    :rtype: [dict]
+    """
+    if sortkey:
+        if reverse:
+            return DB.bounce.find(cond, sort=[(sortkey, -1)])
+        else:
+            return DB.bounce.find(cond, sort=[(sortkey, 1)])
+    else:
+        return DB.bounce.find(cond)
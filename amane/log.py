@@ -45,3 +45,21 @@ def setup(filename=None, debug=False):
         level = logging.INFO
 
     logging.basicConfig(filename=filename, format=format, level=level)
+
+
+def reopen(filename=None, debug=False):
+    """
+    Close the log file and open it again, e.g. after it's rotated or
+    another file is configured
+
+    :keyword filename: name of a log file
+    :type filename: str
+    :keyword debug: debug output
+    :type debug: bool
+    :rtype: None
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    setup(filename=filename, debug=debug)
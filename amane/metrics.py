@@ -0,0 +1,105 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process metrics
+"""
+
+import collections
+import logging
+import threading
+
+
+INTERVAL = 60
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and gauges of a process. They are written into
+    the log by log() in the same key=value| format as the other log
+    lines.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._gauges = {}
+
+    def incr(self, name, value=1):
+        """
+        Increase a counter
+
+        :param name: name of the counter
+        :type name: str
+        :keyword value: amount to add
+        :type value: int
+        :rtype: None
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def gauge(self, name, value):
+        """
+        Set a gauge
+
+        :param name: name of the gauge
+        :type name: str
+        :param value: current value
+        :type value: int
+        :rtype: None
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        """
+        Aquire current values of all counters and gauges
+
+        :return: values keyed by names
+        :rtype: dict
+        """
+        with self._lock:
+            ret = dict(self._counters)
+            ret.update(self._gauges)
+        return ret
+
+    def log(self):
+        """
+        Write current values into the log
+
+        :rtype: None
+        """
+        snapshot = self.snapshot()
+        logging.info("Metrics: %s|", "|".join(
+            "%s=%s" % (name, snapshot[name]) for name in sorted(snapshot)))
+
+    def clear(self):
+        """
+        Reset all counters and gauges
+
+        :rtype: None
+        """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+
+
+METRICS = Metrics()
+
+incr = METRICS.incr
+gauge = METRICS.gauge
+snapshot = METRICS.snapshot
+log = METRICS.log
+clear = METRICS.clear
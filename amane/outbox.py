@@ -0,0 +1,334 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Outbound delivery queue
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import smtplib
+import threading
+import time
+
+from amane import const
+from amane import db
+from amane import relay
+
+
+WORKERS = 2
+POLL_INTERVAL = 10
+RETRY_INTERVAL = 60
+MAX_RETRY_INTERVAL = 3600
+MAX_ATTEMPTS = 12
+LEASE = 600
+CHUNK_SIZE = 100
+SENDERS = relay.POOL_SIZE
+PENDING = [const.MAIL_STATUS_QUEUED, const.MAIL_STATUS_SENDING,
+           const.MAIL_STATUS_DEFERRED]
+
+
+def chunk_recipients(rcpttos, size=CHUNK_SIZE):
+    """
+    Split recipients into chunks of at most size addresses. Recipients
+    are grouped by their domains and a domain is split only when it has
+    more than size recipients by itself.
+
+    :param rcpttos: envelope recipients
+    :type rcpttos: set(str)
+    :keyword size: maximum number of recipients in a chunk; no limit if 0
+    :type size: int
+    :return: chunks of recipients
+    :rtype: [[str]]
+    """
+    by_domain = collections.defaultdict(list)
+    for rcptto in rcpttos:
+        by_domain[rcptto.rpartition("@")[2].lower()].append(rcptto)
+    chunks = []
+    chunk = []
+    for domain in sorted(by_domain):
+        rcpttos = sorted(by_domain[domain])
+        if size and len(chunk) + len(rcpttos) > size:
+            if chunk:
+                chunks.append(chunk)
+            chunk = []
+            while len(rcpttos) > size:
+                chunks.append(rcpttos[:size])
+                rcpttos = rcpttos[size:]
+        chunk.extend(rcpttos)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class Outbox(object):
+    """
+    Delivery via the relay host with a persistent retry queue.
+    A message is sent immediately and only stored in the outbox
+    collection when the delivery is deferred or has failed. Worker
+    threads retry deferred messages with exponential backoff until
+    they are sent or max_attempts is reached.
+    Recipients are split into chunks by chunk_recipients() and up to
+    senders chunks are delivered concurrently, each of them in its own
+    relay session and retried on its own.
+    depth is the number of queued messages, updated by the worker threads
+    on each poll.
+    """
+
+    def __init__(self, relay_pool, workers=WORKERS,
+                 poll_interval=POLL_INTERVAL, retry_interval=RETRY_INTERVAL,
+                 max_retry_interval=MAX_RETRY_INTERVAL,
+                 max_attempts=MAX_ATTEMPTS, chunk_size=CHUNK_SIZE,
+                 senders=SENDERS):
+        self.relay_pool = relay_pool
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self.chunk_size = chunk_size
+        self.senders = senders
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.depth = 0
+
+    def _deliver(self, mailfrom, rcpttos, message):
+        """
+        Try to send a message once
+
+        :return: status, recipients to retry, error and number of
+                 recipients refused permanently
+        :rtype: tuple
+        """
+        try:
+            refused = self.relay_pool.sendmail(mailfrom, rcpttos, message)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except smtplib.SMTPResponseException as e:
+            error = "%d %s" % (e.smtp_code, e.smtp_error)
+            if e.smtp_code >= 500:
+                return const.MAIL_STATUS_FAILED, [], error, len(rcpttos)
+            return const.MAIL_STATUS_DEFERRED, list(rcpttos), error, 0
+        except (smtplib.SMTPException, OSError) as e:
+            return const.MAIL_STATUS_DEFERRED, list(rcpttos), repr(e), 0
+
+        refused = refused or {}
+        for rcptto, (code, resp) in refused.items():
+            logging.warning("refused: %s: %d %s", rcptto, code, resp)
+        retry = [_ for _, (code, resp) in refused.items() if code < 500]
+        failed = len(refused) - len(retry)
+        if retry:
+            code, resp = refused[retry[0]]
+            return (const.MAIL_STATUS_DEFERRED, retry,
+                    "%d %s" % (code, resp), failed)
+        if refused and len(refused) == len(rcpttos):
+            return (const.MAIL_STATUS_FAILED, [], "all recipients refused",
+                    failed)
+        return const.MAIL_STATUS_SENT, [], None, failed
+
+    def _next_try(self, attempts):
+        interval = min(self.retry_interval * 2 ** (attempts - 1),
+                       self.max_retry_interval)
+        return datetime.now() + timedelta(seconds=interval)
+
+    def _send_chunk(self, ml_name, mailfrom, rcpttos, message):
+        """
+        Send a message to a chunk of recipients; queue it for retries if
+        the delivery is deferred
+
+        :return: numbers of recipients keyed by delivery status
+        :rtype: dict
+        """
+        status, retry, error, failed = self._deliver(
+            mailfrom, rcpttos, message)
+        if status == const.MAIL_STATUS_DEFERRED:
+            logging.warning("Deferred: ml_name=%s|error=%s|", ml_name, error)
+            db.enqueue_mail(ml_name, mailfrom, retry, message, status=status,
+                            error=error, next_try=self._next_try(1))
+        elif status == const.MAIL_STATUS_FAILED:
+            logging.error("Failed: ml_name=%s|error=%s|", ml_name, error)
+            db.enqueue_mail(ml_name, mailfrom, rcpttos, message,
+                            status=status, error=error)
+        return {const.MAIL_STATUS_SENT: len(rcpttos) - len(retry) - failed,
+                const.MAIL_STATUS_DEFERRED: len(retry),
+                const.MAIL_STATUS_FAILED: failed}
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.senders,
+                    thread_name_prefix="outbox-sender")
+            return self._executor
+
+    def send(self, ml_name, mailfrom, rcpttos, message):
+        """
+        Send a message; queue it for retries if the delivery is deferred.
+        Chunks of recipients are delivered concurrently.
+
+        :param ml_name: mailing list ID
+        :type ml_name: str
+        :param mailfrom: envelope sender
+        :type mailfrom: str
+        :param rcpttos: envelope recipients
+        :type rcpttos: set(str)
+        :param message: message to send
+        :type message: str
+        :return: numbers of recipients keyed by delivery status; 'sent',
+                 'deferred' or 'failed'
+        :rtype: dict
+        """
+        chunks = chunk_recipients(rcpttos, self.chunk_size)
+        if len(chunks) <= 1:
+            results = [self._send_chunk(ml_name, mailfrom, rcpttos, message)]
+        else:
+            futures = [self._get_executor().submit(
+                self._send_chunk, ml_name, mailfrom, chunk, message)
+                for chunk in chunks]
+            results = [_.result() for _ in futures]
+        ret = collections.Counter()
+        for result in results:
+            ret.update(result)
+        return {status: count for status, count in ret.items() if count}
+
+    def retry(self, mail):
+        """
+        Retry delivery of a queued message and record the result
+
+        :param mail: mail object claimed from the queue
+        :type mail: dict
+        :return: delivery status
+        :rtype: str
+        """
+        status, retry, error, _ = self._deliver(
+            mail['mailfrom'], mail['rcpttos'], mail['message'])
+        attempts = mail['attempts'] + 1
+        next_try = None
+        if status == const.MAIL_STATUS_DEFERRED:
+            if attempts >= self.max_attempts:
+                status = const.MAIL_STATUS_FAILED
+            else:
+                next_try = self._next_try(attempts)
+        logging.info("Retried: ml_name=%s|attempts=%d|status=%s|error=%s|",
+                     mail['ml_name'], attempts, status, error)
+        db.finish_mail(mail['_id'], status, rcpttos=retry or None,
+                       error=error, next_try=next_try)
+        return status
+
+    def process_queue(self):
+        """
+        Retry queued messages which are due
+
+        :return: number of processed messages
+        :rtype: int
+        """
+        count = 0
+        while not self._stopped.is_set():
+            mail = db.claim_mail(LEASE)
+            if mail is None:
+                break
+            try:
+                self.retry(mail)
+            except Exception:
+                logging.exception("Failed to retry %s", mail['_id'])
+            count += 1
+        return count
+
+    def refresh_depth(self):
+        """
+        Count messages waiting in the queue
+
+        :return: number of queued messages
+        :rtype: int
+        """
+        self.depth = db.count_mails({'status': {'$in': PENDING}})
+        return self.depth
+
+    def start(self):
+        """
+        Start worker threads
+
+        :rtype: None
+        """
+        self._stopped.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name="outbox-worker-%d" % i,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Stop worker threads after their current messages. A message not
+        finished in time is claimed again when its lease expires.
+
+        :keyword timeout: seconds to wait for the current messages; no
+                          limit if None
+        :type timeout: float
+        :rtype: None
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(deadline - time.monotonic(), 0))
+            if thread.is_alive():
+                logging.warning("%s didn't finish in time", thread.name)
+        self._threads = []
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=timeout is None)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.process_queue()
+                self.refresh_depth()
+            except Exception:
+                logging.exception("Failed to process the outbox")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+def from_config(relay_pool, outbox_workers=WORKERS,
+                outbox_poll_interval=POLL_INTERVAL,
+                outbox_retry_interval=RETRY_INTERVAL,
+                outbox_max_retry_interval=MAX_RETRY_INTERVAL,
+                outbox_max_attempts=MAX_ATTEMPTS,
+                outbox_chunk_size=CHUNK_SIZE, outbox_senders=SENDERS,
+                **kwargs):
+    """
+    Create an Outbox from amane.conf parameters
+
+    :param relay_pool: connection pool to the relay host
+    :type relay_pool: amane.relay.RelayPool
+    :rtype: Outbox
+    """
+    return Outbox(relay_pool, workers=outbox_workers,
+                  poll_interval=outbox_poll_interval,
+                  retry_interval=outbox_retry_interval,
+                  max_retry_interval=outbox_max_retry_interval,
+                  max_attempts=outbox_max_attempts,
+                  chunk_size=outbox_chunk_size, senders=outbox_senders)
@@ -0,0 +1,116 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Pre-fork worker process supervisor
+"""
+
+import logging
+import os
+import signal
+import time
+
+
+RESTART_DELAY = 1
+
+
+class Supervisor(object):
+    """
+    Run target() in worker processes and restart the ones which exited
+    unexpectedly. SIGTERM and SIGINT stop the workers with SIGTERM and
+    SIGHUP is forwarded to them. on_exit(pid) is called for each worker
+    which exited unexpectedly before it is restarted. on_reload() is
+    called on SIGHUP before it is forwarded.
+    """
+
+    def __init__(self, target, workers, on_exit=None, on_reload=None,
+                 restart_delay=RESTART_DELAY):
+        self.target = target
+        self.workers = workers
+        self.on_exit = on_exit
+        self.on_reload = on_reload
+        self.restart_delay = restart_delay
+        self.children = {}
+        self.stopping = False
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+                self.target()
+                code = 0
+            except BaseException:
+                logging.exception("worker %d died", index)
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        logging.info("started worker %d: pid=%d", index, pid)
+        return pid
+
+    def kill(self, signum):
+        """
+        Send a signal to all workers
+
+        :param signum: signal number
+        :type signum: int
+        :rtype: None
+        """
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _handle_signal(self, signum, frame):
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            logging.info("stopping workers")
+            self.stopping = True
+            self.kill(signal.SIGTERM)
+        else:
+            if self.on_reload:
+                self.on_reload()
+            self.kill(signum)
+
+    def run(self):
+        """
+        Start workers and supervise them until all of them have stopped
+
+        :return: exit code
+        :rtype: int
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._handle_signal)
+        for index in range(self.workers):
+            self._spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            logging.error("worker %d (pid=%d) exited: status=%d",
+                          index, pid, status)
+            if self.on_exit:
+                self.on_exit(pid)
+            time.sleep(self.restart_delay)
+            if not self.stopping:
+                self._spawn(index)
+        logging.info("all workers stopped")
+        return 0
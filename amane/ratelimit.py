@@ -0,0 +1,96 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Token bucket rate limiter
+"""
+
+import collections
+import threading
+import time
+
+
+SIZE = 100000
+SCOPES = ("sender", "ml", "tenant")
+
+
+def parse_limits(rate_limits):
+    """
+    Validate rate limits given in amane.conf or a tenant document, e.g.
+    {'sender': {'rate': 10, 'burst': 20}, 'tenant': {'rate': 600}}.
+    rate is the number of messages per minute and burst, which defaults
+    to rate, is the number of messages accepted at once.
+
+    :param rate_limits: limits keyed by scope
+    :type rate_limits: dict
+    :return: (rate, burst) tuples keyed by scope
+    :rtype: dict
+    """
+    result = {}
+    for scope, limit in (rate_limits or {}).items():
+        if scope not in SCOPES:
+            raise ValueError("unknown rate limit scope: %s" % scope)
+        if not limit or not limit.get('rate'):
+            continue
+        rate = float(limit['rate'])
+        burst = float(limit.get('burst', rate))
+        if rate < 0 or burst < 1:
+            raise ValueError("invalid rate limit for %s: %s" % (scope, limit))
+        result[scope] = (rate, burst)
+    return result
+
+
+class RateLimiter(object):
+    """
+    Token buckets keyed by arbitrary hashable keys. A bucket starts full
+    with burst tokens and is refilled at rate tokens per minute. Buckets
+    used least recently are dropped when more than size buckets are kept;
+    they start full again when used next.
+    """
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+
+    def acquire(self, limits):
+        """
+        Take a token from each bucket, or none of them if any bucket is
+        empty
+
+        :param limits: (key, rate, burst) tuples
+        :type limits: [tuple]
+        :return: key of the empty bucket or None if acquired
+        :rtype: hashable
+        """
+        now = time.monotonic()
+        with self._lock:
+            taken = []
+            for key, rate, burst in limits:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    tokens = burst
+                else:
+                    tokens, last = bucket
+                    tokens = min(burst, tokens + (now - last) * rate / 60)
+                if tokens < 1:
+                    return key
+                taken.append((key, tokens - 1))
+            for key, tokens in taken:
+                self._buckets.pop(key, None)
+                self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return None
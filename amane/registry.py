@@ -0,0 +1,249 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process tenant registry
+"""
+
+import functools
+import logging
+import re
+import threading
+import time
+
+from amane import const
+from amane import db
+
+
+REFRESH_INTERVAL = 5
+COUNTER_INTERVAL = 1
+
+_CONVERSION = re.compile(r"(%%|%0?[0-9]*d)")
+
+
+@functools.lru_cache(maxsize=256)
+def name_pattern(ml_name_format):
+    """
+    Compile ml_name_format into a regular expression matching the ML
+    names made by it. The number is captured as the first group.
+
+    :param ml_name_format: format of ML names, e.g. "ml-%06d"
+    :type ml_name_format: str
+    :return: compiled pattern or None if the format isn't supported
+    :rtype: re.Pattern
+    """
+    pattern = []
+    numbers = 0
+    for i, part in enumerate(_CONVERSION.split(ml_name_format)):
+        if i % 2 == 0:
+            if "%" in part:
+                return None
+            pattern.append(re.escape(part))
+        elif part == "%%":
+            pattern.append("%")
+        else:
+            pattern.append(r"([0-9]+)")
+            numbers += 1
+    if numbers != 1:
+        return None
+    return re.compile("".join(pattern), re.I)
+
+
+class TenantRegistry(object):
+    """
+    Cache of enabled tenants keyed by tenant_name and new_ml_account.
+    The 'updated' stamps of tenants are polled at most every
+    refresh_interval seconds and only changed tenants are reloaded.
+    on_change is called with the name of each cached tenant which has
+    been updated or removed.
+    ML counters of tenants are cached separately and reloaded at most
+    every counter_interval seconds when a ML name beyond them is looked
+    up.
+    """
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL, on_change=None,
+                 counter_interval=COUNTER_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.on_change = on_change
+        self.counter_interval = counter_interval
+        self._lock = threading.Lock()
+        self._by_name = {}
+        self._by_account = {}
+        self._checked = None
+        self._counter_lock = threading.Lock()
+        self._counters = {}
+        self._counted = None
+
+    def _expired(self):
+        return self._checked is None or \
+            time.monotonic() - self._checked >= self.refresh_interval
+
+    def invalidate(self):
+        """
+        Force reloading on the next lookup
+
+        :rtype: None
+        """
+        self._checked = None
+
+    def refresh(self, force=False):
+        """
+        Reload changed tenants if the poll interval has passed. While a
+        thread is reloading, other threads keep using the current data.
+
+        :keyword force: reload regardless of the poll interval
+        :type force: bool
+        :rtype: None
+        """
+        if not force and not self._expired():
+            return
+        if not self._lock.acquire(blocking=force or self._checked is None):
+            return
+        stale = []
+        try:
+            if not force and not self._expired():
+                return
+            self._checked = time.monotonic()
+            enabled = {'status': const.TENANT_STATUS_ENABLED}
+            versions = db.get_tenant_versions(enabled)
+            by_name = {name: tenant for name, tenant in self._by_name.items()
+                       if name in versions}
+            changed = [name for name, updated in versions.items()
+                       if name not in by_name or
+                       by_name[name]['updated'] != updated]
+            if changed:
+                cond = dict(enabled, tenant_name={'$in': changed})
+                for tenant in db.find_tenants(cond, projection={'logs': 0}):
+                    by_name[tenant['tenant_name']] = tenant
+                logging.debug("reloaded tenants: %s", changed)
+            stale = [name for name in self._by_name
+                     if name not in versions or name in changed]
+            self._by_name = by_name
+            self._by_account = {_['new_ml_account']: _
+                                for _ in by_name.values()}
+        finally:
+            self._lock.release()
+        if self.on_change:
+            for name in stale:
+                self.on_change(name)
+
+    def get(self, tenant_name):
+        """
+        Aquire an enabled tenant by its name
+
+        :param tenant_name: Tenant ID
+        :type tenant_name: str
+        :return: Tenant information or None
+        :rtype: dict
+        """
+        self.refresh()
+        return self._by_name.get(tenant_name)
+
+    def find_by_account(self, new_ml_account):
+        """
+        Aquire an enabled tenant by its account to create new MLs
+
+        :param new_ml_account: account name without the domain part
+        :type new_ml_account: str
+        :return: Tenant information or None
+        :rtype: dict
+        """
+        self.refresh()
+        return self._by_account.get(new_ml_account)
+
+    def tenants(self):
+        """
+        Aquire all enabled tenants
+
+        :return: tenant objects
+        :rtype: [dict]
+        """
+        self.refresh()
+        return list(self._by_name.values())
+
+    def refresh_counters(self):
+        """
+        Reload ML counters of tenants if counter_interval has passed
+
+        :return: True if counters were reloaded
+        :rtype: bool
+        """
+        if self._counted is not None and \
+                time.monotonic() - self._counted < self.counter_interval:
+            return False
+        if not self._counter_lock.acquire(blocking=self._counted is None):
+            return False
+        try:
+            self._counted = time.monotonic()
+            enabled = {'status': const.TENANT_STATUS_ENABLED}
+            counters = db.get_tenant_counters(enabled)
+            for name, counter in self._counters.items():
+                if counters.get(name, 0) < counter:
+                    counters[name] = counter
+            self._counters = counters
+        finally:
+            self._counter_lock.release()
+        return True
+
+    def update_counter(self, tenant_name, counter):
+        """
+        Record a counter value obtained by this process
+
+        :param tenant_name: Tenant ID
+        :type tenant_name: str
+        :param counter: counter value
+        :type counter: int
+        :rtype: None
+        """
+        with self._counter_lock:
+            if self._counters.get(tenant_name, 0) < counter:
+                self._counters[tenant_name] = counter
+
+    def _compare_counters(self, numbers):
+        diffs = [number - self._counters[name]
+                 for name, number in numbers.items()
+                 if name in self._counters]
+        if len(diffs) < len(numbers):
+            return 0
+        return min(diffs)
+
+    def compare_counter(self, ml_name):
+        """
+        Compare the number in a ML name with the counter of the tenant
+        whose ml_name_format makes the name. Counters are reloaded only
+        if the number is beyond them, so looking up names which can't
+        exist doesn't make a query every time.
+
+        :param ml_name: ML ID
+        :type ml_name: str
+        :return: negative, zero or positive if the number is below, equal
+                 to or beyond the counter, or None if no tenant makes the
+                 name; and True if counters were reloaded for the name
+        :rtype: (int, bool)
+        """
+        numbers = {}
+        for tenant in self.tenants():
+            pattern = name_pattern(tenant['ml_name_format'])
+            match = pattern and pattern.fullmatch(ml_name)
+            if match:
+                numbers[tenant['tenant_name']] = int(match.group(1))
+        if not numbers:
+            return None, False
+        ret = self._compare_counters(numbers)
+        reloaded = False
+        if ret > 0 or self._counted is None:
+            reloaded = self.refresh_counters()
+            ret = self._compare_counters(numbers)
+        return ret, reloaded
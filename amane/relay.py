@@ -0,0 +1,164 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Relay host connection pool
+"""
+
+import collections
+import contextlib
+import logging
+import smtplib
+import threading
+import time
+
+
+POOL_SIZE = 4
+TIMEOUT = 30
+IDLE_TIMEOUT = 60
+
+
+class RelayPool(object):
+    """
+    A pool of persistent SMTP connections to the relay host.
+    Idle connections are checked with NOOP before reuse and replaced
+    transparently when the relay host has closed them. Once the pool is
+    closed, connections in use are closed when they are returned.
+    """
+
+    def __init__(self, relay_host, relay_port, size=POOL_SIZE,
+                 timeout=TIMEOUT, idle_timeout=IDLE_TIMEOUT, debug=False):
+        self.relay_host = relay_host
+        self.relay_port = relay_port
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.debug = debug
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = collections.deque()
+        self._closed = False
+
+    def _connect(self):
+        relay = smtplib.SMTP(self.relay_host, self.relay_port,
+                             timeout=self.timeout)
+        if self.debug:
+            relay.set_debuglevel(1)
+        logging.debug("connected to %s:%s", self.relay_host, self.relay_port)
+        return relay
+
+    def _close(self, relay):
+        try:
+            relay.quit()
+        except Exception:
+            try:
+                relay.close()
+            except Exception:
+                pass
+
+    def _is_alive(self, relay):
+        try:
+            return relay.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _get(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                relay, last_used = self._idle.pop()
+            if time.monotonic() - last_used > self.idle_timeout:
+                self._close(relay)
+            elif self._is_alive(relay):
+                return relay
+            else:
+                self._close(relay)
+        return self._connect()
+
+    def _put(self, relay):
+        with self._lock:
+            if not self._closed:
+                self._idle.append((relay, time.monotonic()))
+                return
+        self._close(relay)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool. A connection which raised an
+        exception isn't returned to the pool.
+
+        :rtype: smtplib.SMTP
+        """
+        self._slots.acquire()
+        try:
+            relay = self._get()
+            try:
+                yield relay
+            except Exception:
+                self._close(relay)
+                raise
+            self._put(relay)
+        finally:
+            self._slots.release()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Send a message via the relay host. If a pooled connection turns
+        out to be disconnected, retry once with a new connection.
+
+        :param from_addr: envelope sender
+        :type from_addr: str
+        :param to_addrs: envelope recipients
+        :type to_addrs: set(str)
+        :param msg: message to send
+        :type msg: str
+        :return: refused recipients
+        :rtype: dict
+        """
+        try:
+            with self.connection() as relay:
+                return relay.sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            logging.warning("relay host disconnected; reconnecting")
+            with self.connection() as relay:
+                return relay.sendmail(from_addr, to_addrs, msg)
+
+    def close(self):
+        """
+        Close all idle connections and stop pooling the ones in use
+
+        :rtype: None
+        """
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for relay, last_used in idle:
+            self._close(relay)
+
+
+def from_config(relay_host=None, relay_port=None, relay_pool_size=POOL_SIZE,
+                relay_timeout=TIMEOUT, relay_idle_timeout=IDLE_TIMEOUT,
+                debug=False, **kwargs):
+    """
+    Create a RelayPool from amane.conf parameters
+
+    :rtype: RelayPool
+    """
+    return RelayPool(relay_host, relay_port, size=relay_pool_size,
+                     timeout=relay_timeout, idle_timeout=relay_idle_timeout,
+                     debug=debug)
@@ -0,0 +1,391 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Durable inbound message spool
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+WORKERS = 4
+RETRY_INTERVAL = 60
+MAX_RETRY_INTERVAL = 3600
+MAX_ATTEMPTS = 12
+POLL_INTERVAL = 1
+# Errors which may go away by retrying, e.g. network errors
+TRANSIENT_ERRORS = (OSError,)
+
+_counter = itertools.count()
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _join(threads, timeout, message):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for thread in threads:
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(deadline - time.monotonic(), 0))
+        if thread.is_alive():
+            logging.warning(message, thread.name)
+
+
+class Spool(object):
+    """
+    Maildir-style message queue. A message is written into tmp/, synced
+    and renamed into new/ before it is acknowledged. A worker claims it by
+    renaming it into cur/ with its process ID appended and removes it when
+    processed. A message which failed temporarily is returned to new/ to
+    be retried, and one which failed permanently is moved into failed/
+    for inspection.
+    Each file holds the SMTP envelope as a JSON line followed by the raw
+    message.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.tmp_dir = os.path.join(spool_dir, "tmp")
+        self.new_dir = os.path.join(spool_dir, "new")
+        self.cur_dir = os.path.join(spool_dir, "cur")
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        for path in (self.tmp_dir, self.new_dir, self.cur_dir,
+                     self.failed_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def _owner(self, name):
+        # Process ID in the name made by _unique_name()
+        try:
+            return name.split(".")[1].split("_")[0]
+        except IndexError:
+            return None
+
+    def _unique_name(self):
+        return "%020d.%d_%d" % (time.time_ns(), os.getpid(), next(_counter))
+
+    def put(self, peer, mailfrom, rcpttos, data):
+        """
+        Store a received message durably
+
+        :param peer: client address
+        :type peer: tuple
+        :param mailfrom: envelope sender
+        :type mailfrom: str
+        :param rcpttos: envelope recipients
+        :type rcpttos: [str]
+        :param data: message content
+        :type data: bytes
+        :return: name of the spooled message
+        :rtype: str
+        """
+        name = self._unique_name()
+        envelope = json.dumps({"peer": peer, "mailfrom": mailfrom,
+                               "rcpttos": list(rcpttos)})
+        if isinstance(data, str):
+            data = data.encode('utf-8', errors='surrogateescape')
+        tmp_path = os.path.join(self.tmp_dir, name)
+        with open(tmp_path, "wb") as f:
+            f.write(envelope.encode() + b"\n")
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(self.new_dir, name))
+        _fsync_dir(self.new_dir)
+        logging.debug("spooled: %s", name)
+        return name
+
+    def pending(self):
+        """
+        Aquire names of messages waiting to be processed, oldest first
+
+        :rtype: [str]
+        """
+        return sorted(os.listdir(self.new_dir))
+
+    def recover(self, pid=None):
+        """
+        Return messages left in cur/ by a crashed process to new/ and
+        remove incomplete writes in tmp/, which were never acknowledged
+
+        :keyword pid: recover messages of this process only; all if None
+        :type pid: int
+        :return: names of messages waiting to be processed
+        :rtype: [str]
+        """
+        for name in os.listdir(self.tmp_dir):
+            if pid is None or self._owner(name) == str(pid):
+                os.remove(os.path.join(self.tmp_dir, name))
+        for entry in os.listdir(self.cur_dir):
+            name, _, owner = entry.rpartition(":")
+            if pid is None or owner == str(pid):
+                logging.warning("recovered: %s", name)
+                os.rename(os.path.join(self.cur_dir, entry),
+                          os.path.join(self.new_dir, name))
+        return self.pending()
+
+    def claim(self, name):
+        """
+        Take a message for processing
+
+        :param name: name of the spooled message
+        :type name: str
+        :return: path of the claimed message or None if already taken
+        :rtype: str
+        """
+        path = os.path.join(self.cur_dir, "%s:%d" % (name, os.getpid()))
+        try:
+            os.rename(os.path.join(self.new_dir, name), path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def load(self, path):
+        """
+        Read a spooled message
+
+        :param path: path of the claimed message
+        :type path: str
+        :return: peer, mailfrom, rcpttos and data
+        :rtype: tuple
+        """
+        with open(path, "rb") as f:
+            envelope = json.loads(f.readline().decode())
+            data = f.read()
+        peer = envelope['peer']
+        if isinstance(peer, list):
+            peer = tuple(peer)
+        return peer, envelope['mailfrom'], envelope['rcpttos'], data
+
+    def done(self, path):
+        """
+        Remove a processed message
+
+        :param path: path of the claimed message
+        :type path: str
+        :rtype: None
+        """
+        os.remove(path)
+
+    def release(self, path):
+        """
+        Return a claimed message to new/ to be processed again
+
+        :param path: path of the claimed message
+        :type path: str
+        :rtype: None
+        """
+        name = os.path.basename(path).rpartition(":")[0]
+        os.rename(path, os.path.join(self.new_dir, name))
+
+    def fail(self, path):
+        """
+        Put aside a message which failed to be processed
+
+        :param path: path of the claimed message
+        :type path: str
+        :rtype: None
+        """
+        name = os.path.basename(path).rpartition(":")[0]
+        os.rename(path, os.path.join(self.failed_dir, name))
+
+
+class Workers(object):
+    """
+    Threads which process spooled messages with process(peer, mailfrom,
+    rcpttos, data). Messages left in the spool are picked up on start.
+    A message which raised one of transient errors is retried with
+    exponential backoff until max_attempts is reached; other errors put
+    it aside at once. Attempts are counted in memory, so they start over
+    when the process restarts.
+    """
+
+    def __init__(self, spool, process, size=WORKERS,
+                 retry_interval=RETRY_INTERVAL,
+                 max_retry_interval=MAX_RETRY_INTERVAL,
+                 max_attempts=MAX_ATTEMPTS, transient=TRANSIENT_ERRORS):
+        self.spool = spool
+        self.process = process
+        self.size = size
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self.transient = transient
+        self._queue = queue.Queue()
+        self._threads = []
+        self._stopped = False
+        self._lock = threading.Lock()
+        # (due time, name) of messages waiting for a retry
+        self._deferred = []
+        self._attempts = {}
+
+    def start(self, recover=True):
+        """
+        Start worker threads and queue messages left in the spool
+
+        :keyword recover: recover messages of crashed processes too; pass
+                          False when other processes share the spool
+        :type recover: bool
+        :rtype: None
+        """
+        self._stopped = False
+        if recover:
+            names = self.spool.recover()
+        else:
+            names = self.spool.pending()
+        for name in names:
+            self.submit(name)
+        for i in range(self.size):
+            thread = threading.Thread(target=self._run,
+                                      name="spool-worker-%d" % i,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, name):
+        """
+        Queue a spooled message for processing
+
+        :param name: name of the spooled message
+        :type name: str
+        :rtype: None
+        """
+        self._queue.put(name)
+
+    def defer(self, name, attempts):
+        """
+        Schedule a retry of a spooled message. The interval doubles on
+        each attempt.
+
+        :param name: name of the spooled message
+        :type name: str
+        :param attempts: number of attempts made so far
+        :type attempts: int
+        :return: seconds until the retry
+        :rtype: float
+        """
+        interval = min(self.retry_interval * 2 ** (attempts - 1),
+                       self.max_retry_interval)
+        with self._lock:
+            heapq.heappush(self._deferred, (time.monotonic() + interval,
+                                            name))
+        return interval
+
+    def _queue_due(self):
+        # Queue deferred messages which are due; return seconds until the
+        # next one
+        with self._lock:
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                self._queue.put(heapq.heappop(self._deferred)[1])
+            if self._deferred:
+                return self._deferred[0][0] - now
+        return None
+
+    def backlog(self):
+        """
+        Aquire the number of messages waiting for a worker thread or a
+        retry
+
+        :rtype: int
+        """
+        return self._queue.qsize() + len(self._deferred)
+
+    def stop(self, timeout=None):
+        """
+        Stop worker threads after their current messages. Queued and
+        deferred messages stay in the spool and are processed on the next
+        start, as well as the ones not finished in time, which are
+        recovered then.
+
+        :keyword timeout: seconds to wait for the current messages; no
+                          limit if None
+        :type timeout: float
+        :rtype: None
+        """
+        self._stopped = True
+        for thread in self._threads:
+            self._queue.put(None)
+        _join(self._threads, timeout,
+              "%s didn't finish in time; its message is left in the spool")
+        self._threads = []
+        with self._lock:
+            self._deferred = []
+        self._attempts.clear()
+
+    def _run(self):
+        while True:
+            timeout = self._queue_due()
+            try:
+                name = self._queue.get(timeout=min(
+                    timeout or POLL_INTERVAL, POLL_INTERVAL))
+            except queue.Empty:
+                continue
+            if name is None or self._stopped:
+                return
+            self.handle(name)
+
+    def handle(self, name):
+        """
+        Process a spooled message
+
+        :param name: name of the spooled message
+        :type name: str
+        :rtype: None
+        """
+        path = self.spool.claim(name)
+        if path is None:
+            return
+        try:
+            ret = self.process(*self.spool.load(path))
+        except self.transient as e:
+            attempts = self._attempts.get(name, 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[name] = attempts
+                self.spool.release(path)
+                interval = self.defer(name, attempts)
+                logging.warning("Deferred a spooled message: name=%s|"
+                                "attempts=%d|retry_in=%d|error=%r|",
+                                name, attempts, interval, e)
+                return
+            logging.exception("Gave up a spooled message: %s", name)
+            self._attempts.pop(name, None)
+            self.spool.fail(path)
+            return
+        except Exception:
+            logging.exception("Failed to process a spooled message: %s",
+                              name)
+            self._attempts.pop(name, None)
+            self.spool.fail(path)
+            return
+        self._attempts.pop(name, None)
+        if ret:
+            # The message was checked before being spooled; the ML has
+            # changed since then
+            logging.error("Spooled message %s rejected: %s", name, ret)
+        self.spool.done(path)
@@ -0,0 +1,310 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Compiled template cache for tenant messages
+"""
+
+import copy
+from email.mime.text import MIMEText
+import hashlib
+import logging
+import os
+
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache
+from jinja2 import meta
+from jinja2 import TemplateNotFound
+
+from amane import cache
+
+
+TEMPLATE_KEYS = [
+    "welcome_msg",
+    "readme_msg",
+    "add_msg",
+    "remove_msg",
+    "reopen_msg",
+    "goodbye_msg",
+    "report_msg",
+    "orphaned_msg",
+    "closed_msg",
+]
+CACHE_SIZE = 1000
+PART_CACHE_SIZE = 10000
+# Rendered parts are keyed by their inputs; the TTL only bounds memory
+PART_CACHE_TTL = 86400
+
+
+def _name(tenant_name, template_name):
+    return "%s/%s" % (tenant_name, template_name)
+
+
+def _freeze(value):
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    return value
+
+
+class _SourceLoader(BaseLoader):
+    """
+    Loader for template sources stored in tenant configurations.
+    A compiled template is up to date while its source is unchanged.
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def get_source(self, environment, template):
+        entry = self.sources.get(template)
+        if entry is None:
+            raise TemplateNotFound(template)
+        return entry[0], None, lambda: self.sources.get(template) is entry
+
+
+class TemplateCache(object):
+    """
+    Shared Jinja environment which compiles each tenant template once.
+    Templates are keyed by tenant and template name and recompiled when
+    their source changes. Compiled bytecode is optionally stored in
+    bytecode_dir to survive restarts.
+    Rendered attachments are kept per ML as well, see render_part().
+    """
+
+    def __init__(self, bytecode_dir=None, size=CACHE_SIZE,
+                 part_cache_size=PART_CACHE_SIZE):
+        self.bytecode_dir = bytecode_dir
+        # Variables referred by each template; name => (source, names)
+        self.variables = {}
+        # ML ID => {template name: (key, part)}
+        self.parts = cache.TTLCache(ttl=PART_CACHE_TTL, size=part_cache_size)
+        bytecode_cache = None
+        if bytecode_dir:
+            os.makedirs(bytecode_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+        self.loader = _SourceLoader()
+        self.env = Environment(newline_sequence='\r\n', loader=self.loader,
+                               bytecode_cache=bytecode_cache,
+                               cache_size=size)
+
+    def get(self, tenant_name, template_name, source):
+        """
+        Aquire a compiled template
+
+        :param tenant_name: Tenant ID
+        :type tenant_name: str
+        :param template_name: template key in the tenant configuration
+        :type template_name: str
+        :param source: template source
+        :type source: str
+        :rtype: jinja2.Template
+        """
+        name = _name(tenant_name, template_name)
+        entry = self.loader.sources.get(name)
+        if entry is None or entry[0] != source:
+            self.loader.sources[name] = (source,)
+        return self.env.get_template(name)
+
+    def render(self, tenant_name, template_name, source, params):
+        """
+        Render a tenant template
+
+        :param tenant_name: Tenant ID
+        :type tenant_name: str
+        :param template_name: template key in the tenant configuration
+        :type template_name: str
+        :param source: template source
+        :type source: str
+        :param params: template variables
+        :type params: dict
+        :rtype: str
+        """
+        if not source:
+            return ""
+        return self.get(tenant_name, template_name, source).render(params)
+
+    def _fingerprint(self, tenant_name, template_name, source, params):
+        # Hash of the source and the variables which the template refers
+        # to, so that a sender's address doesn't make a new entry unless
+        # it's rendered
+        name = _name(tenant_name, template_name)
+        entry = self.variables.get(name)
+        if entry is None or entry[0] != source:
+            names = sorted(meta.find_undeclared_variables(
+                self.env.parse(source or "")))
+            entry = self.variables[name] = (source, names)
+        values = [source] + [(_, _freeze(params.get(_))) for _ in entry[1]]
+        return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+    def render_part(self, tenant_name, template_name, source, params,
+                    ml_name, filename, version=None, charset="utf-8"):
+        """
+        Render a tenant template into an encoded text attachment. The part
+        is reused for the ML while the tenant version, the template and
+        the variables it refers to, e.g. members, are unchanged.
+
+        :param tenant_name: Tenant ID
+        :type tenant_name: str
+        :param template_name: template key in the tenant configuration
+        :type template_name: str
+        :param source: template source
+        :type source: str
+        :param params: template variables
+        :type params: dict
+        :param ml_name: mailing list ID
+        :type ml_name: str
+        :param filename: file name of the attachment
+        :type filename: str
+        :keyword version: version of the tenant, e.g. last updated time
+        :keyword charset: Character encoding
+        :type charset: str
+        :rtype: email.mime.text.MIMEText
+        """
+        key = (tenant_name, version, filename, charset,
+               self._fingerprint(tenant_name, template_name, source, params))
+        parts = self.parts.get(ml_name, {})
+        entry = parts.get(template_name)
+        if entry is None or entry[0] != key:
+            content = self.render(tenant_name, template_name, source, params)
+            part = MIMEText(content, _charset=charset)
+            part.set_param('name', filename)
+            entry = (key, part)
+            # Copy on write; readers in other threads keep the old dict
+            parts = dict(parts)
+            parts[template_name] = entry
+            self.parts.put(ml_name, parts)
+        return copy.deepcopy(entry[1])
+
+    def invalidate_ml(self, ml_name):
+        """
+        Discard rendered attachments of a ML
+
+        :param ml_name: mailing list ID
+        :type ml_name: str
+        :rtype: None
+        """
+        self.parts.discard(ml_name)
+
+    def invalidate(self, tenant_name):
+        """
+        Discard compiled templates of a tenant. Rendered attachments of
+        all MLs are discarded too since they aren't indexed by tenant.
+
+        :param tenant_name: Tenant ID
+        :type tenant_name: str
+        :rtype: None
+        """
+        for template_name in TEMPLATE_KEYS:
+            name = _name(tenant_name, template_name)
+            self.loader.sources.pop(name, None)
+            bytecode_cache = self.env.bytecode_cache
+            if bytecode_cache is None:
+                continue
+            key = bytecode_cache.get_cache_key(name)
+            path = os.path.join(self.bytecode_dir,
+                                bytecode_cache.pattern % key)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.parts.clear()
+        logging.debug("templates of %s invalidated", tenant_name)
+
+
+CACHE = TemplateCache()
+
+
+def setup(template_cache_dir=None, part_cache_size=PART_CACHE_SIZE,
+          **kwargs):
+    """
+    Set up the shared template cache from amane.conf parameters
+
+    :keyword template_cache_dir: directory to store compiled bytecode
+    :type template_cache_dir: str
+    :keyword part_cache_size: number of MLs to keep rendered attachments
+    :type part_cache_size: int
+    :rtype: None
+    """
+    global CACHE
+    CACHE = TemplateCache(bytecode_dir=template_cache_dir,
+                          part_cache_size=part_cache_size)
+
+
+def render(tenant_name, template_name, source, params):
+    """
+    Render a tenant template with the shared template cache
+
+    :param tenant_name: Tenant ID
+    :type tenant_name: str
+    :param template_name: template key in the tenant configuration
+    :type template_name: str
+    :param source: template source
+    :type source: str
+    :param params: template variables
+    :type params: dict
+    :rtype: str
+    """
+    return CACHE.render(tenant_name, template_name, source, params)
+
+
+def invalidate(tenant_name):
+    """
+    Discard compiled templates of a tenant from the shared template cache
+
+    :param tenant_name: Tenant ID
+    :type tenant_name: str
+    :rtype: None
+    """
+    CACHE.invalidate(tenant_name)
+
+
+def render_part(tenant_name, template_name, source, params, ml_name,
+                filename, version=None, charset="utf-8"):
+    """
+    Render a tenant template into an attachment with the shared template
+    cache
+
+    :param tenant_name: Tenant ID
+    :type tenant_name: str
+    :param template_name: template key in the tenant configuration
+    :type template_name: str
+    :param source: template source
+    :type source: str
+    :param params: template variables
+    :type params: dict
+    :param ml_name: mailing list ID
+    :type ml_name: str
+    :param filename: file name of the attachment
+    :type filename: str
+    :keyword version: version of the tenant, e.g. last updated time
+    :keyword charset: Character encoding
+    :type charset: str
+    :rtype: email.mime.text.MIMEText
+    """
+    return CACHE.render_part(tenant_name, template_name, source, params,
+                             ml_name, filename, version=version,
+                             charset=charset)
+
+
+def invalidate_ml(ml_name):
+    """
+    Discard rendered attachments of a ML from the shared template cache
+
+    :param ml_name: mailing list ID
+    :type ml_name: str
+    :rtype: None
+    """
+    CACHE.invalidate_ml(ml_name)
@@ -18,19 +18,26 @@ Database handler
 """
 
 import copy
-from datetime import datetime
+from datetime import datetime, timedelta
+import itertools
 import logging
+import re
 import time
 
 from amane import const
 
 
 DB = None
+TRANSIENT_ERRORS = ()
 MLS = {}
+LOGS = {}
 TENANTS = {}
+MAILS = {}
+BOUNCES = {}
+MAIL_IDS = itertools.count(1)
 
 
-def init_db(db_url, db_name):
+def init_db(db_url, db_name, create_indexes=True):
     """
     Initialize DB object and create a counter if missing
 
@@ -38,11 +45,42 @@ def init_db(db_url, db_name):
     :type db_url: str
     :param db_name: Database name to use
     :type db_name: str
+    :keyword create_indexes: Create missing indexes or not
+    :type create_indexes: bool
     :rtype: None
     """
     logging.debug("fake_db: init_db")
 
 
+def ensure_indexes():
+    """
+    Create indexes declared in INDEXES if missing
+    This is an idempotent operation.
+
+    :return: names of indexes per collection
+    :rtype: dict
+    """
+    logging.debug("fake_db: ensure_indexes")
+    return {
+        "ml": ["ml_name"],
+        "tenant": ["tenant_name"],
+    }
+
+
+def explain_queries():
+    """
+    Show indexes used by typical queries of this module
+
+    :return: index names (or COLLSCAN) keyed by query name
+    :rtype: dict
+    """
+    logging.debug("fake_db: explain_queries")
+    return {
+        "get_ml": ["ml_name"],
+        "get_tenant": ["tenant_name"],
+    }
+
+
 def clear_db():
     """
     Initialize DB object and create a counter if missing
@@ -55,9 +93,20 @@ def clear_db():
     """
     logging.debug("fake_db: clear_db")
     global MLS
+    global LOGS
     global TENANTS
+    global MAILS
+    global BOUNCES
     MLS = {}
+    LOGS = {}
     TENANTS = {}
+    MAILS = {}
+    BOUNCES = {}
+
+
+def _log(ml_name, log_dict):
+    log_dict = dict(log_dict, time=datetime.now())
+    LOGS.setdefault(ml_name, []).append(log_dict)
 
 
 def increase_counter(tenant_name):
@@ -131,6 +180,7 @@ def create_tenant(tenant_name, by, config):
         "orphaned_msg": config["orphaned_msg"],
         "closed_subject": config["closed_subject"],
         "closed_msg": config["closed_msg"],
+        "rate_limits": config.get("rate_limits", {}),
     }
     TENANTS[tenant_name] = tenant_dict
     logging.debug("Tenant %s created: %s", tenant_name, config)
@@ -177,13 +227,15 @@ def update_tenant(tenant_name, by, **config):
         "by": by,
     }
 
+    tenant = dict(tenant)
     for key, value in config.items():
         if key in ["tenant_name", "by", "created", "updated", "logs"]:
             continue
-        if key not in tenant:
+        if key not in tenant and key not in const.TENANT_OPTIONAL_KEYS:
             continue
         tenant[key] = value
     tenant["updated"] = datetime.now()
+    TENANTS[tenant_name] = tenant
 
     if logging.root.level == logging.DEBUG:
         logging.debug("after: %s", TENANTS[tenant_name])
@@ -221,7 +273,7 @@ def get_tenant(tenant_name):
     return TENANTS.get(tenant_name)
 
 
-def find_tenants(cond, sortkey=None, reverse=False):
+def find_tenants(cond, sortkey=None, reverse=False, projection=None):
     """
     Aquire tenants with conditions
     This is an atomic operation.
@@ -232,14 +284,18 @@ def find_tenants(cond, sortkey=None, reverse=False):
     :type sortkey: str
     :keyword reverse: Reverse sort or not
     :type reverse: bool
+    :keyword projection: fields to include or exclude (ignored)
+    :type projection: dict
     :return: tenant objects
     :rtype: [dict]
     """
-    result = TENANTS.values()
+    result = list(TENANTS.values())
     for key, value in cond.items():
         if isinstance(value, dict):
             for k, v in value.items():
-                if k == '$gt':
+                if k == '$in':
+                    result = [_ for _ in result if _[key] in v]
+                elif k == '$gt':
                     result = [_ for _ in result if _[key] > v]
                 elif k == '$gte':
                     result = [_ for _ in result if _[key] >= v]
@@ -257,6 +313,33 @@ def find_tenants(cond, sortkey=None, reverse=False):
     return result
 
 
+def get_tenant_versions(cond):
+    """
+    Aquire last updated times of tenants with conditions
+    This is an atomic operation.
+
+    :param cond: Conditions
+    :type cond: dict
+    :return: last updated times keyed by tenant ID
+    :rtype: dict
+    """
+    return {name: _['updated'] for name, _ in TENANTS.items()
+            if all(_[k] == v for k, v in cond.items())}
+
+
+def get_tenant_counters(cond):
+    """
+    Aquire current counters of tenants with conditions
+
+    :param cond: Conditions
+    :type cond: dict
+    :return: counters keyed by tenant ID
+    :rtype: dict
+    """
+    return {name: _['counter'] for name, _ in TENANTS.items()
+            if all(_[k] == v for k, v in cond.items())}
+
+
 def create_ml(tenant_name, ml_name, subject, members, by):
     """
     Create a new ML and register members into it
@@ -290,20 +373,28 @@ def create_ml(tenant_name, ml_name, subject, members, by):
         "updated": datetime.now(),
         "status": const.STATUS_NEW,
         "by": by,
-        "logs": [log_dict],
     }
     global MLS
     MLS[ml_name] = ml_dict
+    _log(ml_name, log_dict)
+    # ML names are numbered by the tenant counter; keep it beyond the MLs
+    # which tests create with arbitrary names
+    number = re.search(r"[0-9]+$", ml_name)
+    if tenant_name in TENANTS and number:
+        TENANTS[tenant_name]['counter'] = max(
+            TENANTS[tenant_name]['counter'], int(number.group()))
     logging.debug("after: %s", ml_dict)
 
 
-def get_ml(ml_name):
+def get_ml(ml_name, projection=None):
     """
     Aquire a ML
     This is an atomic operation.
 
     :param ml_name: ML ID
     :type ml_name: str
+    :keyword projection: fields to return (ignored)
+    :type projection: dict
     :return: ML object
     :rtype: dict
     """
@@ -371,7 +462,7 @@ def mark_mls_orphaned(last_updated, by):
             data['status'] = const.STATUS_ORPHANED
             data['updated'] = datetime.now()
             data['by'] = by
-            data['logs'].append(log_dict)
+            _log(ml_name, log_dict)
 
 
 def mark_mls_closed(last_updated, by):
@@ -398,7 +489,7 @@ def mark_mls_closed(last_updated, by):
             data['status'] = const.STATUS_CLOSED
             data['updated'] = datetime.now()
             data['by'] = by
-            data['logs'].append(log_dict)
+            _log(ml_name, log_dict)
 
 
 def change_ml_status(ml_name, status, by):
@@ -426,14 +517,14 @@ def change_ml_status(ml_name, status, by):
     ml['status'] = status
     ml['updated'] = datetime.now()
     ml['by'] = by
-    ml['logs'].append(log_dict)
+    _log(ml_name, log_dict)
     logging.debug("after: %s", ml)
 
 
 def add_members(ml_name, members, by):
     """
     Add e-mail addresses of new members into a ML
-    This ISN'T an atomic operation.
+    This is an atomic operation.
 
     :param ml_name: mailing list ID
     :type ml_name: str
@@ -441,7 +532,8 @@ def add_members(ml_name, members, by):
     :type members: set(str)
     :param by: sender's e-mail address
     :type by: str
-    :rtype: None
+    :return: members after the operation
+    :rtype: set(str)
     """
     logging.debug("fake_db: add_members")
     global MLS
@@ -455,14 +547,15 @@ def add_members(ml_name, members, by):
     ml['members'] |= members
     ml['updated'] = datetime.now()
     ml['by'] = by
-    ml['logs'].append(log_dict)
+    _log(ml_name, log_dict)
     logging.debug("after: %s", ml)
+    return set(ml['members'])
 
 
 def del_members(ml_name, members, by):
     """
     Remove e-mail addresses of members from a ML
-    This ISN'T an atomic operation.
+    This is an atomic operation.
 
     :param ml_name: mailing list ID
     :type ml_name: str
@@ -470,7 +563,8 @@ def del_members(ml_name, members, by):
     :type members: set(str)
     :param by: sender's e-mail address
     :type by: str
-    :rtype: None
+    :return: members after the operation
+    :rtype: set(str)
     """
     logging.warning("fake_db: del_members: %s", members)
     global MLS
@@ -484,8 +578,9 @@ def del_members(ml_name, members, by):
     ml['members'] -= members
     ml['updated'] = datetime.now()
     ml['by'] = by
-    ml['logs'].append(log_dict)
+    _log(ml_name, log_dict)
     logging.warning("after: %s", ml)
+    return set(ml['members'])
 
 
 def get_members(ml_name):
@@ -504,7 +599,7 @@ def get_members(ml_name):
     return MLS[ml_name]['members']
 
 
-def log_post(ml_name, members, by):
+def log_post(ml_name, members, by, delivery=None):
     """
     Append a log about sending a post to a ML
     This is an atomic operation.
@@ -515,6 +610,8 @@ def log_post(ml_name, members, by):
     :type members: set(str)
     :param by: sender's e-mail address
     :type by: str
+    :keyword delivery: numbers of recipients keyed by delivery status
+    :type delivery: dict
     :rtype: None
     """
     log_dict = {
@@ -522,21 +619,286 @@ def log_post(ml_name, members, by):
         "by": by,
         "members": members,
     }
-    global MLS
-    MLS[ml_name]['logs'].append(log_dict)
+    if delivery:
+        log_dict['delivery'] = delivery
+    _log(ml_name, log_dict)
 
 
-def get_logs(ml_name):
+def update_ml(ml_name, by, status=None, add=None, delete=None, logs=None):
     """
-    Show operation logs of a ML
+    Apply changes made while processing a message to a ML at once.
+
+    :param ml_name: mailing list ID
+    :type ml_name: str
+    :param by: sender's e-mail address
+    :type by: str
+    :keyword status: new status or None to keep it
+    :type status: str
+    :keyword add: e-mail addresses to add
+    :type add: set(str)
+    :keyword delete: e-mail addresses to remove
+    :type delete: set(str)
+    :keyword logs: operation logs to append
+    :type logs: [dict]
+    :rtype: None
+    """
+    logging.debug("fake_db: update_ml")
+    if add and delete:
+        raise ValueError("can't add and remove members at once")
+    ml = MLS[ml_name]
+    if status is not None:
+        ml['status'] = status
+    if add:
+        ml['members'] |= add
+    if delete:
+        ml['members'] -= delete
+    ml['updated'] = datetime.now()
+    ml['by'] = by
+    for log_dict in logs or []:
+        _log(ml_name, log_dict)
+    logging.debug("after: %s", ml)
+
+
+def get_logs(ml_name, skip=0, limit=0):
+    """
+    Show operation logs of a ML in chronological order
     This is an atomic operation.
 
     :param ml_name: mailing list ID
     :type ml_name: str
+    :keyword skip: number of logs to skip
+    :type skip: int
+    :keyword limit: maximum number of logs to return; 0 means no limit
+    :type limit: int
     :return: operation logs
     :rtype: list[dict]
     """
-    ml = MLS.get(ml_name)
-    if ml is None:
+    if ml_name not in MLS:
         return None
-    return ml['logs']
+    logs = LOGS.get(ml_name, [])[skip:]
+    if limit:
+        logs = logs[:limit]
+    return logs
+
+
+def migrate_logs():
+    """
+    Move operation logs embedded in ML objects to the ml_log collection.
+
+    :return: number of migrated MLs
+    :rtype: int
+    """
+    logging.debug("fake_db: migrate_logs")
+    return 0
+
+
+def enqueue_mail(ml_name, mailfrom, rcpttos, message,
+                 status=const.MAIL_STATUS_QUEUED, error=None, next_try=None):
+    """
+    Store an outbound message into the delivery queue
+
+    :param ml_name: mailing list ID
+    :type ml_name: str
+    :param mailfrom: envelope sender
+    :type mailfrom: str
+    :param rcpttos: envelope recipients
+    :type rcpttos: set(str)
+    :param message: message to send
+    :type message: str
+    :keyword status: initial status; 'queued', 'deferred' or 'failed'
+    :type status: str
+    :keyword error: last delivery error
+    :type error: str
+    :keyword next_try: time to try delivery; now if omitted
+    :type next_try: datetime
+    :return: mail ID
+    :rtype: int
+    """
+    logging.debug("fake_db: enqueue_mail")
+    now = datetime.now()
+    mail_id = next(MAIL_IDS)
+    MAILS[mail_id] = {
+        "_id": mail_id,
+        "ml_name": ml_name,
+        "mailfrom": mailfrom,
+        "rcpttos": sorted(rcpttos),
+        "message": message,
+        "status": status,
+        "attempts": 0 if status == const.MAIL_STATUS_QUEUED else 1,
+        "error": error,
+        "next_try": next_try or now,
+        "created": now,
+        "updated": now,
+    }
+    return mail_id
+
+
+def claim_mail(lease):
+    """
+    Take the next outbound message to deliver
+
+    :param lease: seconds to reserve the message
+    :type lease: int
+    :return: mail object or None
+    :rtype: dict
+    """
+    logging.debug("fake_db: claim_mail")
+    now = datetime.now()
+    mails = [_ for _ in MAILS.values()
+             if _['status'] in (const.MAIL_STATUS_QUEUED,
+                                const.MAIL_STATUS_DEFERRED,
+                                const.MAIL_STATUS_SENDING) and
+             _['next_try'] <= now]
+    if not mails:
+        return None
+    mail = min(mails, key=lambda _: _['next_try'])
+    mail['status'] = const.MAIL_STATUS_SENDING
+    mail['next_try'] = now + timedelta(seconds=lease)
+    mail['updated'] = now
+    return copy.deepcopy(mail)
+
+
+def finish_mail(mail_id, status, rcpttos=None, error=None, next_try=None):
+    """
+    Record the result of a delivery attempt
+
+    :param mail_id: mail ID
+    :type mail_id: int
+    :param status: 'sent', 'deferred' or 'failed'
+    :type status: str
+    :keyword rcpttos: recipients left to retry
+    :type rcpttos: [str]
+    :keyword error: delivery error
+    :type error: str
+    :keyword next_try: time of the next attempt
+    :type next_try: datetime
+    :rtype: None
+    """
+    logging.debug("fake_db: finish_mail")
+    mail = MAILS[mail_id]
+    mail['status'] = status
+    mail['error'] = error
+    mail['updated'] = datetime.now()
+    mail['attempts'] += 1
+    if rcpttos is not None:
+        mail['rcpttos'] = sorted(rcpttos)
+    if next_try is not None:
+        mail['next_try'] = next_try
+    if status == const.MAIL_STATUS_SENT:
+        mail.pop('message', None)
+
+
+def find_mails(cond, sortkey=None, reverse=False):
+    """
+    Aquire outbound messages without their bodies
+
+    :param cond: Conditions
+    :type cond: dict
+    :keyword sortkey: sort pattern
+    :type sortkey: str
+    :keyword reverse: Reverse sort or not
+    :type reverse: bool
+    :return: mail objects
+    :rtype: [dict]
+    """
+    logging.debug("fake_db: find_mails")
+    result = []
+    for mail in MAILS.values():
+        for key, value in cond.items():
+            if isinstance(value, dict) and '$in' in value:
+                if mail.get(key) not in value['$in']:
+                    break
+            elif mail.get(key) != value:
+                break
+        else:
+            mail = dict(mail)
+            mail.pop('message', None)
+            result.append(mail)
+    if sortkey:
+        result.sort(key=lambda _: _[sortkey], reverse=reverse)
+    return result
+
+
+def count_mails(cond):
+    """
+    Count mails in the outbox with conditions
+
+    :param cond: Conditions
+    :type cond: dict
+    :return: number of mails
+    :rtype: int
+    """
+    return len(find_mails(cond))
+
+
+def get_bounce(address):
+    """
+    Aquire the bounce record of an e-mail address
+
+    :param address: e-mail address
+    :type address: str
+    :return: bounce object or None
+    :rtype: dict
+    """
+    logging.debug("fake_db: get_bounce")
+    bounce = BOUNCES.get(address)
+    return copy.deepcopy(bounce)
+
+
+def update_bounce(address, ml_name, score, status, removed=False):
+    """
+    Store the bounce score of an e-mail address
+
+    :param address: e-mail address
+    :type address: str
+    :param ml_name: mailing list ID the bounce came for
+    :type ml_name: str
+    :param score: new score
+    :type score: float
+    :param status: delivery status of the bounce
+    :type status: str
+    :keyword removed: the address is removed from the ML or not
+    :type removed: bool
+    :rtype: None
+    """
+    logging.debug("fake_db: update_bounce")
+    bounce = BOUNCES.setdefault(address, {
+        "address": address, "count": 0, "ml_names": [], "removed": []})
+    bounce['score'] = score
+    bounce['status'] = status
+    bounce['updated'] = datetime.now()
+    bounce['count'] += 1
+    if ml_name not in bounce['ml_names']:
+        bounce['ml_names'].append(ml_name)
+    if removed and ml_name not in bounce['removed']:
+        bounce['removed'].append(ml_name)
+
+
+def find_bounces(cond, sortkey=None, reverse=False):
+    """
+    Aquire bounce records with conditions
+
+    :param cond: Conditions
+    :type cond: dict
+    :keyword sortkey: sort pattern
+    :type sortkey: str
+    :keyword reverse: Reverse sort or not
+    :type reverse: bool
+    :return: bounce objects
+    :rtype: [dict]
+    """
+    logging.debug("fake_db: find_bounces")
+    result = []
+    for bounce in BOUNCES.values():
+        for key, value in cond.items():
+            field = bounce.get(key)
+            if isinstance(field, list):
+                if value not in field:
+                    break
+            elif field != value:
+                break
+        else:
+            result.append(copy.deepcopy(bounce))
+    if sortkey:
+        result.sort(key=lambda _: _[sortkey], reverse=reverse)
+    return result
@@ -0,0 +1,50 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for e-mail address normalization (amane.addresses)
+"""
+
+import unittest
+from unittest import mock
+
+from amane import addresses
+
+
+class AddressesTest(unittest.TestCase):
+    """addresses tests"""
+
+    def setUp(self):
+        addresses._normalize.cache_clear()
+
+    def test_normalize(self):
+        ret = addresses.normalize(["Test1 <Test1@Example.com>",
+                                   "test2@example.com", "invalid", ""])
+        self.assertEqual(ret, {"test1@example.com", "test2@example.com"})
+
+    def test_cached(self):
+        with mock.patch('amane.addresses.email_normalize.normalize',
+                        wraps=addresses.email_normalize.normalize) as m:
+            for i in range(3):
+                addresses.normalize(["test1@example.com"])
+            self.assertEqual(m.call_count, 1)
+
+    def test_parse(self):
+        ret = addresses.parse('"Doe, John" <john@example.com>, '
+                              'Test2 <test2@example.com>,'
+                              'test3@example.com')
+        self.assertEqual(ret, {"john@example.com", "test2@example.com",
+                               "test3@example.com"})
+        self.assertEqual(addresses.parse(""), set())
@@ -0,0 +1,116 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for bounce tracking (amane.bounce)
+"""
+
+from datetime import datetime, timedelta
+import email
+import unittest
+from unittest import mock
+
+from amane.tests import fake_db
+
+
+DSN = b'From: MAILER-DAEMON <daemon@example.com>\n' \
+      b'To: ml-000010-error <ml-000010-error@example.net>\n' \
+      b'Content-Type: multipart/report; report-type=delivery-status;\n' \
+      b' boundary="b"\n' \
+      b'\n' \
+      b'--b\n' \
+      b'Content-Type: text/plain\n' \
+      b'\n' \
+      b'Failed\n' \
+      b'--b\n' \
+      b'Content-Type: message/delivery-status\n' \
+      b'\n' \
+      b'Reporting-MTA: dns; mx.example.com\n' \
+      b'\n' \
+      b'Final-Recipient: rfc822; a@example.com\n' \
+      b'Action: failed\n' \
+      b'Status: 5.1.1\n' \
+      b'\n' \
+      b'Original-Recipient: rfc822;<b@example.com>\n' \
+      b'Final-Recipient: rfc822; c@example.com\n' \
+      b'Action: delayed\n' \
+      b'Status: 4.4.1\n' \
+      b'\n' \
+      b'Final-Recipient: rfc822; d@example.com\n' \
+      b'Action: delivered\n' \
+      b'Status: 2.0.0\n' \
+      b'--b--\n'
+
+
+class BounceTest(unittest.TestCase):
+    """bounce tests"""
+
+    @mock.patch('amane.db', fake_db)
+    def setUp(self):
+        from amane import bounce
+        self.bounce = bounce
+
+    def tearDown(self):
+        fake_db.clear_db()
+
+    def test_parse_dsn(self):
+        message = email.message_from_bytes(DSN)
+        self.assertEqual(self.bounce.parse_dsn(message), [
+            ("a@example.com", "failed", "5.1.1"),
+            ("b@example.com", "delayed", "4.4.1"),
+        ])
+
+    def test_parse_legacy(self):
+        message = email.message_from_string(
+            'To: ml-000010-error <ml-000010-error@example.net>\n'
+            'Original-Recipient: rfc822;a@example.com\n'
+            '\n'
+            'Failed\n')
+        self.assertEqual(self.bounce.parse_dsn(message),
+                         [("a@example.com", "failed", "")])
+
+    def test_weight(self):
+        self.assertEqual(self.bounce.weight("failed", "5.1.1"),
+                         self.bounce.HARD)
+        self.assertEqual(self.bounce.weight("failed", "4.4.7"),
+                         self.bounce.SOFT)
+        self.assertEqual(self.bounce.weight("delayed", "4.4.1"),
+                         self.bounce.SOFT)
+
+    def test_decay(self):
+        now = datetime.now()
+        self.assertEqual(self.bounce.decay(2.0, now, now), 2.0)
+        self.assertAlmostEqual(
+            self.bounce.decay(2.0, now - timedelta(days=7), now,
+                              half_life=7), 1.0)
+
+    def test_record(self):
+        for i in range(2):
+            self.assertFalse(self.bounce.record(
+                "a@example.com", "ml-000010", "failed", "5.1.1"))
+        self.assertTrue(self.bounce.record(
+            "a@example.com", "ml-000010", "failed", "5.1.1"))
+        bounce = fake_db.get_bounce("a@example.com")
+        self.assertEqual(bounce['count'], 3)
+        self.assertEqual(bounce['removed'], ["ml-000010"])
+
+    def test_record_decayed(self):
+        self.bounce.record("a@example.com", "ml-000010", "failed", "5.1.1")
+        self.bounce.record("a@example.com", "ml-000010", "failed", "5.1.1")
+        fake_db.BOUNCES["a@example.com"]['updated'] -= timedelta(days=7)
+        self.assertFalse(self.bounce.record(
+            "a@example.com", "ml-000010", "failed", "5.1.1", half_life=7))
+        self.assertAlmostEqual(fake_db.get_bounce("a@example.com")['score'],
+                               2.0, places=3)
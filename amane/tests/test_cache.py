@@ -0,0 +1,61 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for in-process caches (amane.cache)
+"""
+
+import unittest
+from unittest import mock
+
+from amane import cache
+
+
+class TTLCacheTest(unittest.TestCase):
+    """TTLCache tests"""
+
+    def test_get_put(self):
+        _cache = cache.TTLCache()
+        self.assertIsNone(_cache.get("a"))
+        self.assertEqual(_cache.get("a", 1), 1)
+        _cache.put("a", 2)
+        self.assertEqual(_cache.get("a"), 2)
+        self.assertIn("a", _cache)
+        _cache.put("b")
+        self.assertIn("b", _cache)
+        _cache.discard("a")
+        self.assertNotIn("a", _cache)
+        _cache.clear()
+        self.assertEqual(len(_cache), 0)
+
+    def test_expire(self):
+        _cache = cache.TTLCache(ttl=10)
+        with mock.patch('time.monotonic', return_value=100):
+            _cache.put("a")
+        with mock.patch('time.monotonic', return_value=109):
+            self.assertIn("a", _cache)
+        with mock.patch('time.monotonic', return_value=110):
+            self.assertNotIn("a", _cache)
+        self.assertEqual(len(_cache), 0)
+
+    def test_size(self):
+        _cache = cache.TTLCache(size=2)
+        _cache.put("a")
+        _cache.put("b")
+        _cache.put("a")
+        _cache.put("c")
+        self.assertNotIn("b", _cache)
+        self.assertIn("a", _cache)
+        self.assertIn("c", _cache)
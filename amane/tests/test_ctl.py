@@ -122,7 +122,7 @@ class NotifyTest(unittest.TestCase):
             "--config-file", "sample/amane.conf", "tenant", "show",
             self.tenant_name)
         self.assertEqual(result.exit_code, 0)
-        config = yaml.load(result.output)
+        config = yaml.safe_load(result.output)
         for key, value in TENANT_CONFIG.items():
             self.assertEqual(config[key], value)
 
@@ -227,6 +227,25 @@ class NotifyTest(unittest.TestCase):
         for key, value in TENANT_CONFIG.items():
             self.assertEqual(config[key], value)
 
+    def test_update_tenant_rate_limits(self):
+        with tempfile.NamedTemporaryFile(mode="wt") as t:
+            yaml.dump({"rate_limits": {"sender": {"rate": 10}}}, t)
+            result = self.tester(
+                "--config-file", "sample/amane.conf", "tenant", "update",
+                self.tenant_name, "--yamlfile", t.name)
+        self.assertEqual(result.exit_code, 0)
+        config = fake_db.get_tenant(self.tenant_name)
+        self.assertEqual(config["rate_limits"], {"sender": {"rate": 10}})
+
+        with tempfile.NamedTemporaryFile(mode="wt") as t:
+            yaml.dump({"rate_limits": {"domain": {"rate": 10}}}, t)
+            result = self.tester(
+                "--config-file", "sample/amane.conf", "tenant", "update",
+                self.tenant_name, "--yamlfile", t.name)
+        self.assertEqual(result.exit_code, 1)
+        config = fake_db.get_tenant(self.tenant_name)
+        self.assertEqual(config["rate_limits"], {"sender": {"rate": 10}})
+
     def test_update_tenant_by_opt(self):
         with tempfile.NamedTemporaryFile(mode="wt") as t1, \
                 tempfile.NamedTemporaryFile(mode="wt") as t2, \
@@ -290,3 +309,64 @@ class NotifyTest(unittest.TestCase):
                 "--config-file", "sample/amane.conf", "tenant", "update",
                 "foo", "--yamlfile", t.name)
         self.assertEqual(result.exit_code, 1)
+
+    def test_ensure_indexes(self):
+        result = self.tester(
+            "--config-file", "sample/amane.conf", "db", "ensure-indexes")
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output,
+                         "ml: ml_name\n"
+                         "tenant: tenant_name\n"
+                         "get_ml => ml_name\n"
+                         "get_tenant => tenant_name\n")
+
+    def test_migrate_logs(self):
+        result = self.tester(
+            "--config-file", "sample/amane.conf", "db", "migrate-logs")
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output, "0 MLs migrated\n")
+
+    def test_list_queue(self):
+        fake_db.enqueue_mail("ml-000001", "ml-000001-error@example.net",
+                             {"b@example.com", "a@example.com"}, "msg",
+                             status=const.MAIL_STATUS_DEFERRED,
+                             error="421 busy")
+        fake_db.enqueue_mail("ml-000002", "ml-000002-error@example.net",
+                             {"c@example.com"}, "msg",
+                             status=const.MAIL_STATUS_FAILED,
+                             error="550 no")
+        result = self.tester(
+            "--config-file", "sample/amane.conf", "queue", "list")
+        self.assertEqual(result.exit_code, 0)
+        lines = result.output.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("deferred ml-000001 attempts=1", lines[0])
+        self.assertIn("error=421 busy", lines[0])
+        self.assertEqual(lines[1], "  a@example.com, b@example.com")
+
+        result = self.tester(
+            "--config-file", "sample/amane.conf", "queue", "list",
+            "--status", "failed")
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("failed ml-000002", result.output)
+
+    def test_list_bounces(self):
+        fake_db.update_bounce("a@example.com", "ml-000001", 0.25, "4.4.1")
+        fake_db.update_bounce("b@example.com", "ml-000002", 3.0, "5.1.1",
+                              removed=True)
+        result = self.tester(
+            "--config-file", "sample/amane.conf", "bounces")
+        self.assertEqual(result.exit_code, 0)
+        lines = result.output.splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertIn("b@example.com: score=3.00 count=1 status=5.1.1",
+                      lines[0])
+        self.assertEqual(lines[1], "  bounced: ml-000002")
+        self.assertEqual(lines[2], "  removed: ml-000002")
+        self.assertIn("a@example.com: score=0.25", lines[3])
+
+        result = self.tester(
+            "--config-file", "sample/amane.conf", "bounces",
+            "--ml", "ml-000001")
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(result.output.splitlines()), 2)
@@ -40,6 +40,28 @@ class DbTest(unittest.TestCase):
         db.DB._Database__client.drop_database(self.db_name)
 
 
+class IndexTest(DbTest):
+
+    def test_ensure_indexes(self):
+        ret = db.ensure_indexes()
+        self.assertIn("ml_name", ret["ml"])
+        self.assertIn("new_ml_account", ret["tenant"])
+        indexes = db.DB.ml.index_information()
+        self.assertTrue(indexes["ml_name"]["unique"])
+        indexes = db.DB.tenant.index_information()
+        self.assertTrue(indexes["tenant_name"]["unique"])
+        self.assertTrue(indexes["new_ml_account"]["unique"])
+        self.assertEqual(db.ensure_indexes(), ret)
+
+    def test_explain_queries(self):
+        ret = db.explain_queries()
+        self.assertEqual(ret["get_ml"], ["ml_name"])
+        self.assertEqual(ret["get_tenant"], ["tenant_name"])
+        self.assertEqual(ret["create_tenant"], ["new_ml_account"])
+        for name, indexes in ret.items():
+            self.assertNotIn("COLLSCAN", indexes)
+
+
 class TenantTest(DbTest):
 
     config = {
@@ -75,6 +97,17 @@ class TenantTest(DbTest):
         tenant = db.get_tenant(tenant_name)
         self.assertEqual(tenant["ml_name_format"], "ml2-%06d")
         self.assertEqual(tenant["new_ml_account"], "ml2-new")
+        self.assertEqual(tenant["rate_limits"], {})
+
+        # Tenants created before rate_limits was introduced
+        db.DB.tenant.update_one({"tenant_name": tenant_name},
+                                {"$unset": {"rate_limits": ""}})
+        rate_limits = {"sender": {"rate": 10}}
+        db.update_tenant(tenant_name, "hoge", rate_limits=rate_limits,
+                         unknown_key=1)
+        tenant = db.get_tenant(tenant_name)
+        self.assertEqual(tenant["rate_limits"], rate_limits)
+        self.assertNotIn("unknown_key", tenant)
         db.delete_tenant(tenant_name)
         self.assertEqual(db.get_tenant(tenant_name), None)
 
@@ -131,6 +164,30 @@ class TenantTest(DbTest):
         self.assertEqual([_['tenant_name'] for _ in ret],
                          ["tenant3", "tenant2", "tenant1"])
 
+    def test_get_tenant_versions(self):
+        for tenant_name in ["tenant1", "tenant2"]:
+            self.config['new_ml_account'] = tenant_name
+            db.create_tenant(tenant_name, "hoge", self.config)
+        db.update_tenant("tenant2", "hoge",
+                         status=const.TENANT_STATUS_DISABLED)
+
+        ret = db.get_tenant_versions({"status": const.TENANT_STATUS_ENABLED})
+        self.assertEqual(list(ret.keys()), ["tenant1"])
+        tenant = db.get_tenant("tenant1")
+        self.assertEqual(ret["tenant1"], tenant["updated"])
+
+        ret = db.find_tenants({}, projection={"logs": 0})
+        self.assertEqual(len(ret), 2)
+        for tenant in ret:
+            self.assertNotIn("logs", tenant)
+
+    def test_get_tenant_counters(self):
+        self.config['new_ml_account'] = "tenant1"
+        db.create_tenant("tenant1", "hoge", self.config)
+        self.assertEqual(db.get_tenant_counters({}), {"tenant1": 1})
+        db.increase_counter("tenant1")
+        self.assertEqual(db.get_tenant_counters({}), {"tenant1": 2})
+
 
 class MlTest(DbTest):
 
@@ -159,6 +216,12 @@ class MlTest(DbTest):
         }
         db.create_tenant(self.tenant_name, "hoge", config)
 
+    def _get_logs(self, ml_name, **kwargs):
+        logs = db.get_logs(ml_name, **kwargs)
+        for log in logs:
+            self.assertIsInstance(log.pop('time'), datetime)
+        return logs
+
     def test_counter(self):
         ml_id = db.increase_counter(self.tenant_name)
         self.assertEqual(ml_id, 1)
@@ -179,12 +242,13 @@ class MlTest(DbTest):
             self.assertEqual(ml['members'], members)
             self.assertEqual(ml['by'], by)
             self.assertEqual(ml['status'], const.STATUS_NEW)
+            self.assertNotIn('logs', ml)
             logs = [{
                 'op': const.OP_CREATE,
                 'by': by,
-                'members': members,
+                'members': set(members),
             }]
-            self.assertEqual(ml['logs'], logs)
+            self.assertEqual(self._get_logs(ml_name), logs)
 
     def test_mark_mls_orphaned_and_closed(self):
         ml1_name = ML_NAME % db.increase_counter(self.tenant_name)
@@ -224,7 +288,7 @@ class MlTest(DbTest):
             {
                 'op': const.OP_CREATE,
                 'by': "xyz",
-                'members': [],
+                'members': set(),
             },
             {
                 'op': const.OP_REOPEN,
@@ -239,24 +303,29 @@ class MlTest(DbTest):
                 'by': "XYZ",
             },
         ]
-        self.assertEqual(ml2['logs'], logs)
+        self.assertEqual(self._get_logs(ml2_name), logs)
 
     def test_add_and_del_members(self):
         ml_name = ML_NAME % db.increase_counter(self.tenant_name)
         db.create_ml(self.tenant_name, ml_name, "hoge", set(), "xyz")
         self.assertEqual(db.get_members(ml_name), set())
 
-        db.add_members(ml_name, {"abc", "def"}, "xyz")
+        ret = db.add_members(ml_name, {"abc", "def"}, "xyz")
+        self.assertEqual(ret, {"abc", "def"})
         self.assertEqual(db.get_members(ml_name), {"abc", "def"})
 
-        db.add_members(ml_name, {"abc", "ghi"}, "xyz")
+        ret = db.add_members(ml_name, {"abc", "ghi"}, "xyz")
+        self.assertEqual(ret, {"abc", "def", "ghi"})
         self.assertEqual(db.get_members(ml_name), {"abc", "def", "ghi"})
 
-        db.del_members(ml_name, {"abc", "ghi"}, "xyz")
+        ret = db.del_members(ml_name, {"abc", "ghi"}, "xyz")
+        self.assertEqual(ret, {"def"})
         self.assertEqual(db.get_members(ml_name), {"def"})
 
-        db.del_members(ml_name, {"abc", "def"}, "xyz")
+        ret = db.del_members(ml_name, {"abc", "def"}, "xyz")
+        self.assertEqual(ret, set())
         self.assertEqual(db.get_members(ml_name), set())
+        self.assertIsNone(db.add_members("nonexistent", {"abc"}, "xyz"))
         logs = [
             {
                 'op': const.OP_CREATE,
@@ -284,7 +353,10 @@ class MlTest(DbTest):
                 'members': {"abc", "def"},
             },
         ]
-        self.assertEqual(db.get_logs(ml_name), logs)
+        self.assertEqual(self._get_logs(ml_name), logs)
+        self.assertEqual(self._get_logs(ml_name, skip=1, limit=2), logs[1:3])
+        self.assertEqual(self._get_logs(ml_name, skip=4), logs[4:])
+        self.assertIsNone(db.get_logs("nonexistent"))
 
     def test_change_ml_status(self):
         ml_name = ML_NAME % db.increase_counter(self.tenant_name)
@@ -294,17 +366,44 @@ class MlTest(DbTest):
         db.change_ml_status(ml_name, const.STATUS_ORPHANED, "xxx")
         ml = db.get_ml(ml_name)
         self.assertEqual(ml['status'], const.STATUS_ORPHANED)
-        self.assertEqual(ml['logs'][-1]['op'], const.OP_ORPHAN)
+        self.assertEqual(db.get_logs(ml_name)[-1]['op'], const.OP_ORPHAN)
 
         db.change_ml_status(ml_name, const.STATUS_CLOSED, "xxx")
         ml = db.get_ml(ml_name)
         self.assertEqual(ml['status'], const.STATUS_CLOSED)
-        self.assertEqual(ml['logs'][-1]['op'], const.OP_CLOSE)
+        self.assertEqual(db.get_logs(ml_name)[-1]['op'], const.OP_CLOSE)
 
         db.change_ml_status(ml_name, const.STATUS_OPEN, "xxx")
         ml = db.get_ml(ml_name)
         self.assertEqual(ml['status'], const.STATUS_OPEN)
-        self.assertEqual(ml['logs'][-1]['op'], const.OP_REOPEN)
+        self.assertEqual(db.get_logs(ml_name)[-1]['op'], const.OP_REOPEN)
+
+    def test_update_ml(self):
+        ml_name = ML_NAME % db.increase_counter(self.tenant_name)
+        db.create_ml(self.tenant_name, ml_name, "hoge", {"abc"}, "xyz")
+        ml = db.get_ml(ml_name, projection={'_id': 0, 'status': 1})
+        self.assertEqual(ml, {'status': const.STATUS_NEW})
+
+        logs = [
+            {"op": const.OP_REOPEN, "by": "xxx"},
+            {"op": const.OP_ADD_MEMBERS, "by": "xxx", "members": ["def"]},
+            {"op": const.OP_POST, "by": "xxx", "members": ["abc", "def"]},
+        ]
+        db.update_ml(ml_name, "xxx", status=const.STATUS_OPEN, add={"def"},
+                     logs=logs)
+        ml = db.get_ml(ml_name)
+        self.assertEqual(ml['status'], const.STATUS_OPEN)
+        self.assertEqual(ml['by'], "xxx")
+        self.assertEqual(db.get_members(ml_name), {"abc", "def"})
+        self.assertEqual([_['op'] for _ in db.get_logs(ml_name)],
+                         [const.OP_CREATE, const.OP_REOPEN,
+                          const.OP_ADD_MEMBERS, const.OP_POST])
+
+        db.update_ml(ml_name, "yyy", delete={"abc"})
+        self.assertEqual(db.get_members(ml_name), {"def"})
+        self.assertEqual(db.get_ml(ml_name)['status'], const.STATUS_OPEN)
+        self.assertRaises(ValueError, db.update_ml, ml_name, "yyy",
+                          add={"abc"}, delete={"def"})
 
     def test_find_mls(self):
         db.create_ml(self.tenant_name, "a", "hoge1", set(), "xyz")
@@ -319,3 +418,91 @@ class MlTest(DbTest):
         self.assertEqual([_['ml_name'] for _ in ret], ["a", "c"])
         ret = db.find_mls({}, sortkey='created', reverse=True)
         self.assertEqual([_['ml_name'] for _ in ret], ["c", "b", "a"])
+
+    def test_migrate_logs(self):
+        ml_name = ML_NAME % db.increase_counter(self.tenant_name)
+        db.create_ml(self.tenant_name, ml_name, "hoge", {"abc"}, "xyz")
+        embedded = [
+            {'op': const.OP_CREATE, 'by': "xyz", 'members': ["abc"]},
+            {'op': const.OP_POST, 'by': "abc", 'members': ["abc"]},
+        ]
+        db.DB.ml_log.delete_many({})
+        db.DB.ml.update_one({'ml_name': ml_name},
+                            {'$set': {'logs': embedded}})
+
+        self.assertEqual(db.migrate_logs(), 1)
+        self.assertEqual(db.migrate_logs(), 0)
+        self.assertNotIn('logs', db.get_ml(ml_name))
+        logs = self._get_logs(ml_name)
+        self.assertEqual(logs, [
+            {'op': const.OP_CREATE, 'by': "xyz", 'members': {"abc"},
+             'migrated': True},
+            {'op': const.OP_POST, 'by': "abc", 'members': {"abc"},
+             'migrated': True},
+        ])
+
+        db.log_post(ml_name, {"abc"}, "abc")
+        self.assertEqual(len(db.get_logs(ml_name)), 3)
+        self.assertNotIn('migrated', db.get_logs(ml_name)[-1])
+
+
+class OutboxTest(DbTest):
+
+    def test_enqueue_and_claim(self):
+        mail_id = db.enqueue_mail("ml1", "ml1-error", {"b", "a"}, "msg")
+        mail = db.claim_mail(60)
+        self.assertEqual(mail['_id'], mail_id)
+        self.assertEqual(mail['status'], const.MAIL_STATUS_SENDING)
+        self.assertEqual(mail['rcpttos'], ["a", "b"])
+        self.assertEqual(mail['message'], "msg")
+        self.assertIsNone(db.claim_mail(60))
+
+        db.finish_mail(mail_id, const.MAIL_STATUS_DEFERRED, rcpttos={"a"},
+                       error="421 busy", next_try=datetime.now())
+        mail = db.claim_mail(0)
+        self.assertEqual(mail['attempts'], 1)
+        self.assertEqual(mail['rcpttos'], ["a"])
+        self.assertEqual(mail['error'], "421 busy")
+
+        # An expired lease can be claimed again
+        self.assertEqual(db.claim_mail(60)['_id'], mail_id)
+
+        db.finish_mail(mail_id, const.MAIL_STATUS_SENT)
+        self.assertIsNone(db.claim_mail(60))
+        mail, = db.find_mails({'status': const.MAIL_STATUS_SENT})
+        self.assertEqual(mail['attempts'], 2)
+        self.assertNotIn('message', db.DB.outbox.find_one({'_id': mail_id}))
+
+    def test_find_mails(self):
+        db.enqueue_mail("ml1", "ml1-error", {"a"}, "msg",
+                        status=const.MAIL_STATUS_FAILED, error="550")
+        db.enqueue_mail("ml2", "ml2-error", {"a"}, "msg",
+                        status=const.MAIL_STATUS_DEFERRED, error="421")
+        ret = list(db.find_mails(
+            {'status': {'$in': [const.MAIL_STATUS_DEFERRED]}},
+            sortkey='next_try'))
+        self.assertEqual([_['ml_name'] for _ in ret], ["ml2"])
+        self.assertNotIn('message', ret[0])
+        ret = db.find_mails({}, sortkey='ml_name', reverse=True)
+        self.assertEqual([_['ml_name'] for _ in ret], ["ml2", "ml1"])
+        self.assertEqual(db.count_mails({}), 2)
+        self.assertEqual(db.count_mails(
+            {'status': const.MAIL_STATUS_DEFERRED}), 1)
+
+
+class BounceTest(DbTest):
+
+    def test_update_bounce(self):
+        self.assertIsNone(db.get_bounce("a"))
+        db.update_bounce("a", "ml1", 1.0, "5.1.1")
+        db.update_bounce("a", "ml2", 2.0, "5.1.1", removed=True)
+        db.update_bounce("b", "ml1", 0.25, "4.4.1")
+        bounce = db.get_bounce("a")
+        self.assertEqual(bounce['score'], 2.0)
+        self.assertEqual(bounce['count'], 2)
+        self.assertEqual(bounce['ml_names'], ["ml1", "ml2"])
+        self.assertEqual(bounce['removed'], ["ml2"])
+        ret = db.find_bounces({}, sortkey='score', reverse=True)
+        self.assertEqual([_['address'] for _ in ret], ["a", "b"])
+        ret = db.find_bounces({'ml_names': "ml2"})
+        self.assertEqual([_['address'] for _ in ret], ["a"])
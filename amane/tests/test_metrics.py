@@ -0,0 +1,40 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for in-process metrics (amane.metrics)
+"""
+
+import unittest
+
+from amane import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    """Metrics tests"""
+
+    def test_metrics(self):
+        _metrics = metrics.Metrics()
+        _metrics.incr("shed")
+        _metrics.incr("shed", 2)
+        _metrics.gauge("in_flight", 5)
+        _metrics.gauge("in_flight", 3)
+        self.assertEqual(_metrics.snapshot(), {"shed": 3, "in_flight": 3})
+        with self.assertLogs(level='INFO') as cm:
+            _metrics.log()
+        self.assertEqual(cm.output,
+                         ["INFO:root:Metrics: in_flight=3|shed=3|"])
+        _metrics.clear()
+        self.assertEqual(_metrics.snapshot(), {})
@@ -0,0 +1,193 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for outbound delivery queue (amane.outbox)
+"""
+
+from datetime import datetime
+import smtplib
+import threading
+import time
+import unittest
+from unittest import mock
+
+from amane import const
+from amane.tests import fake_db
+
+
+FROM = "ml-000010-error@example.net"
+RCPTTOS = {"test1@example.com", "test2@example.com"}
+
+
+class OutboxTest(unittest.TestCase):
+    """Outbox tests"""
+
+    @mock.patch('amane.db', fake_db)
+    def setUp(self):
+        from amane import outbox
+        self.relay_pool = mock.MagicMock()
+        self.relay_pool.sendmail.return_value = {}
+        self.outbox = outbox.Outbox(self.relay_pool, max_attempts=3)
+
+    def tearDown(self):
+        fake_db.clear_db()
+
+    def _mails(self, status):
+        return fake_db.find_mails({'status': status})
+
+    def test_sent(self):
+        ret = self.outbox.send("ml-000010", FROM, RCPTTOS, "msg")
+        self.assertEqual(ret, {const.MAIL_STATUS_SENT: 2})
+        self.relay_pool.sendmail.assert_called_once_with(FROM, RCPTTOS, "msg")
+        self.assertEqual(fake_db.find_mails({}), [])
+
+    def test_deferred(self):
+        self.relay_pool.sendmail.side_effect = \
+            smtplib.SMTPServerDisconnected("down")
+        ret = self.outbox.send("ml-000010", FROM, RCPTTOS, "msg")
+        self.assertEqual(ret, {const.MAIL_STATUS_DEFERRED: 2})
+        mail, = self._mails(const.MAIL_STATUS_DEFERRED)
+        self.assertEqual(mail['rcpttos'], sorted(RCPTTOS))
+        self.assertEqual(mail['attempts'], 1)
+        self.assertGreater(mail['next_try'], datetime.now())
+
+    def test_temporary_error(self):
+        self.relay_pool.sendmail.side_effect = \
+            smtplib.SMTPDataError(451, b"try again")
+        ret = self.outbox.send("ml-000010", FROM, RCPTTOS, "msg")
+        self.assertEqual(ret, {const.MAIL_STATUS_DEFERRED: 2})
+
+    def test_permanent_error(self):
+        self.relay_pool.sendmail.side_effect = \
+            smtplib.SMTPDataError(554, b"rejected")
+        ret = self.outbox.send("ml-000010", FROM, RCPTTOS, "msg")
+        self.assertEqual(ret, {const.MAIL_STATUS_FAILED: 2})
+        mail, = self._mails(const.MAIL_STATUS_FAILED)
+        self.assertEqual(mail['error'], "554 b'rejected'")
+
+    def test_partially_refused(self):
+        self.relay_pool.sendmail.return_value = {
+            "test1@example.com": (450, b"mailbox busy"),
+            "test2@example.com": (550, b"no such user"),
+        }
+        ret = self.outbox.send("ml-000010", FROM, RCPTTOS, "msg")
+        self.assertEqual(ret, {const.MAIL_STATUS_DEFERRED: 1,
+                               const.MAIL_STATUS_FAILED: 1})
+        mail, = self._mails(const.MAIL_STATUS_DEFERRED)
+        self.assertEqual(mail['rcpttos'], ["test1@example.com"])
+
+    def test_retry(self):
+        mail_id = fake_db.enqueue_mail("ml-000010", FROM, RCPTTOS, "msg")
+        self.assertEqual(self.outbox.process_queue(), 1)
+        self.assertEqual(self.outbox.process_queue(), 0)
+        mail = fake_db.MAILS[mail_id]
+        self.assertEqual(mail['status'], const.MAIL_STATUS_SENT)
+        self.assertEqual(mail['attempts'], 1)
+        self.assertNotIn('message', mail)
+
+    def test_retry_backoff(self):
+        self.relay_pool.sendmail.side_effect = ConnectionRefusedError
+        mail_id = fake_db.enqueue_mail("ml-000010", FROM, RCPTTOS, "msg")
+        self.assertEqual(self.outbox.process_queue(), 1)
+        mail = fake_db.MAILS[mail_id]
+        self.assertEqual(mail['status'], const.MAIL_STATUS_DEFERRED)
+        first = mail['next_try']
+
+        mail['next_try'] = datetime.now()
+        self.outbox.process_queue()
+        self.assertGreater((mail['next_try'] - datetime.now()).seconds,
+                           (first - datetime.now()).seconds)
+
+        mail['next_try'] = datetime.now()
+        self.outbox.process_queue()
+        self.assertEqual(mail['status'], const.MAIL_STATUS_FAILED)
+        self.assertEqual(mail['attempts'], 3)
+        self.assertEqual(self.outbox.process_queue(), 0)
+
+    def test_refresh_depth(self):
+        fake_db.enqueue_mail("ml-000010", FROM, RCPTTOS, "msg")
+        fake_db.enqueue_mail("ml-000010", FROM, RCPTTOS, "msg",
+                             status=const.MAIL_STATUS_FAILED)
+        self.assertEqual(self.outbox.depth, 0)
+        self.assertEqual(self.outbox.refresh_depth(), 1)
+        self.assertEqual(self.outbox.depth, 1)
+
+    def test_stop_timeout(self):
+        release = threading.Event()
+        self.outbox.workers = 1
+        with mock.patch.object(self.outbox, 'process_queue') as m:
+            m.side_effect = lambda: release.wait(10)
+            self.outbox.start()
+            thread, = self.outbox._threads
+            deadline = time.monotonic() + 10
+            while not m.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+            with mock.patch('logging.warning') as w:
+                self.outbox.stop(timeout=0.1)
+                self.assertEqual(w.call_count, 1)
+            release.set()
+            thread.join()
+
+    def test_from_config(self):
+        from amane import outbox
+        _outbox = outbox.from_config(self.relay_pool, outbox_workers=4,
+                                     outbox_max_attempts=5, log_file="x")
+        self.assertEqual(_outbox.workers, 4)
+        self.assertEqual(_outbox.max_attempts, 5)
+        self.assertEqual(_outbox.retry_interval, outbox.RETRY_INTERVAL)
+        self.assertEqual(_outbox.chunk_size, outbox.CHUNK_SIZE)
+
+    def test_chunk_recipients(self):
+        from amane import outbox
+        rcpttos = {"a1@a.example.com", "a2@A.example.com",
+                   "b1@b.example.com", "c1@c.example.com",
+                   "c2@c.example.com", "c3@c.example.com"}
+        self.assertEqual(outbox.chunk_recipients(rcpttos, 0),
+                         [sorted(rcpttos, key=str.lower)])
+        self.assertEqual(outbox.chunk_recipients(rcpttos, 3), [
+            ["a1@a.example.com", "a2@A.example.com", "b1@b.example.com"],
+            ["c1@c.example.com", "c2@c.example.com", "c3@c.example.com"]])
+        self.assertEqual(outbox.chunk_recipients(rcpttos, 2), [
+            ["a1@a.example.com", "a2@A.example.com"],
+            ["b1@b.example.com"],
+            ["c1@c.example.com", "c2@c.example.com"],
+            ["c3@c.example.com"]])
+        self.assertEqual(outbox.chunk_recipients(set(), 2), [])
+
+    def test_send_chunks(self):
+        rcpttos = {"test%d@example%d.com" % (i, i % 3) for i in range(10)}
+
+        def sendmail(mailfrom, rcpttos, message):
+            if "test0@example0.com" in rcpttos:
+                raise smtplib.SMTPServerDisconnected("down")
+            return {}
+
+        self.relay_pool.sendmail.side_effect = sendmail
+        self.outbox.chunk_size = 4
+        ret = self.outbox.send("ml-000010", FROM, rcpttos, "msg")
+        self.outbox.stop()
+        self.assertEqual(self.relay_pool.sendmail.call_count, 3)
+        sent = set()
+        for args, kwargs in self.relay_pool.sendmail.call_args_list:
+            self.assertLessEqual(len(args[1]), 4)
+            self.assertEqual(len({_.split("@")[1] for _ in args[1]}), 1)
+            sent |= set(args[1])
+        self.assertEqual(sent, rcpttos)
+        self.assertEqual(ret, {const.MAIL_STATUS_SENT: 6,
+                               const.MAIL_STATUS_DEFERRED: 4})
+        mail, = self._mails(const.MAIL_STATUS_DEFERRED)
+        self.assertIn("test0@example0.com", mail['rcpttos'])
+        self.assertEqual(len(mail['rcpttos']), 4)
@@ -0,0 +1,88 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for pre-fork worker process supervisor (amane.prefork)
+"""
+
+import fcntl
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from amane import prefork
+
+
+class SupervisorTest(unittest.TestCase):
+    """Supervisor tests"""
+
+    def setUp(self):
+        self.handlers = {signum: signal.getsignal(signum)
+                         for signum in (signal.SIGTERM, signal.SIGINT,
+                                        signal.SIGHUP)}
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.exited = []
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        os.remove(self.path)
+
+    def _lines(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def _target(self):
+        # The first two workers exit and the restarted ones keep running
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            count = len(f.read().splitlines())
+            f.write("%d\n" % os.getpid())
+        if count >= 2:
+            time.sleep(60)
+
+    def _stop_when(self, supervisor, count):
+        deadline = time.monotonic() + 10
+        while len(self._lines()) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        supervisor._handle_signal(signal.SIGTERM, None)
+
+    def test_restart_and_stop(self):
+        supervisor = prefork.Supervisor(self._target, 2,
+                                        on_exit=self.exited.append,
+                                        restart_delay=0)
+        thread = threading.Thread(target=self._stop_when,
+                                  args=(supervisor, 4))
+        thread.start()
+        self.assertEqual(supervisor.run(), 0)
+        thread.join()
+
+        pids = [int(_) for _ in self._lines()]
+        self.assertEqual(len(pids), 4)
+        self.assertEqual(set(self.exited), set(pids[:2]))
+        self.assertEqual(supervisor.children, {})
+
+    def test_reload(self):
+        reloaded = []
+        supervisor = prefork.Supervisor(self._target, 2,
+                                        on_reload=lambda: reloaded.append(1))
+        supervisor._handle_signal(signal.SIGHUP, None)
+        self.assertEqual(reloaded, [1])
+        self.assertFalse(supervisor.stopping)
@@ -0,0 +1,80 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for token bucket rate limiter (amane.ratelimit)
+"""
+
+import unittest
+from unittest import mock
+
+from amane import ratelimit
+
+
+class ParseLimitsTest(unittest.TestCase):
+    """parse_limits() tests"""
+
+    def test_parse_limits(self):
+        self.assertEqual(ratelimit.parse_limits(None), {})
+        self.assertEqual(ratelimit.parse_limits({
+            "sender": {"rate": 10, "burst": 20},
+            "ml": {"rate": 30},
+            "tenant": {"rate": 0}}),
+            {"sender": (10, 20), "ml": (30, 30)})
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ratelimit.parse_limits({"domain": {"rate": 10}})
+        with self.assertRaises(ValueError):
+            ratelimit.parse_limits({"ml": {"rate": 10, "burst": 0}})
+
+
+class RateLimiterTest(unittest.TestCase):
+    """RateLimiter tests"""
+
+    def setUp(self):
+        self.limiter = ratelimit.RateLimiter()
+        self.now = 1000
+        patcher = mock.patch('time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_and_refill(self):
+        limits = [("a", 60, 2)]
+        self.assertIsNone(self.limiter.acquire(limits))
+        self.assertIsNone(self.limiter.acquire(limits))
+        self.assertEqual(self.limiter.acquire(limits), "a")
+        self.now += 1
+        self.assertIsNone(self.limiter.acquire(limits))
+        self.assertEqual(self.limiter.acquire(limits), "a")
+        self.now += 60
+        self.assertIsNone(self.limiter.acquire(limits))
+        self.assertIsNone(self.limiter.acquire(limits))
+        self.assertEqual(self.limiter.acquire(limits), "a")
+
+    def test_all_or_nothing(self):
+        self.assertIsNone(self.limiter.acquire([("b", 60, 1)]))
+        self.assertEqual(self.limiter.acquire([("a", 60, 1), ("b", 60, 1)]),
+                         "b")
+        # No token was taken from "a"
+        self.assertIsNone(self.limiter.acquire([("a", 60, 1)]))
+
+    def test_size(self):
+        self.limiter.size = 2
+        for key in ("a", "b", "c"):
+            self.assertIsNone(self.limiter.acquire([(key, 60, 1)]))
+        # "a" is dropped and starts full again
+        self.assertIsNone(self.limiter.acquire([("a", 60, 1)]))
+        self.assertEqual(self.limiter.acquire([("c", 60, 1)]), "c")
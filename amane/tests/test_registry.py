@@ -0,0 +1,156 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for tenant registry (amane.registry)
+"""
+
+import unittest
+from unittest import mock
+
+from amane import const
+from amane.tests import fake_db
+
+
+TENANT_CONFIG = {
+    "admins": {"hoge@example.com"},
+    "charset": "iso-2022-jp",
+    "ml_name_format": "ml-%06d",
+    "new_ml_account": "new",
+    "days_to_close": 7,
+    "days_to_orphan": 7,
+    "welcome_msg": "welcome_msg",
+    "readme_msg": "readme_msg",
+    "add_msg": "add_msg",
+    "remove_msg": "remove_msg",
+    "reopen_msg": "reopen_msg",
+    "goodbye_msg": "goodbye_msg",
+    "report_subject": "report_subject",
+    "report_msg": "report_msg",
+    "orphaned_subject": "orphaned_subject",
+    "orphaned_msg": "orphaned_msg",
+    "closed_subject": "closed_subject",
+    "closed_msg": "closed_msg",
+}
+
+
+class TenantRegistryTest(unittest.TestCase):
+    """TenantRegistry tests"""
+
+    @mock.patch('amane.db', fake_db)
+    def setUp(self):
+        from amane import registry
+        self.registry = registry.TenantRegistry(refresh_interval=60)
+        fake_db.create_tenant("tenant1", "hoge@example.com", TENANT_CONFIG)
+
+    def tearDown(self):
+        fake_db.clear_db()
+
+    def test_get(self):
+        tenant = self.registry.get("tenant1")
+        self.assertEqual(tenant['new_ml_account'], "new")
+        self.assertIsNone(self.registry.get("tenant2"))
+
+    def test_find_by_account(self):
+        tenant = self.registry.find_by_account("new")
+        self.assertEqual(tenant['tenant_name'], "tenant1")
+        self.assertIsNone(self.registry.find_by_account("tenant1"))
+
+    def test_cached(self):
+        self.registry.get("tenant1")
+        with mock.patch.object(fake_db, 'get_tenant_versions') as m:
+            self.registry.get("tenant1")
+            self.registry.find_by_account("new")
+            m.assert_not_called()
+
+    def test_refresh_changed(self):
+        self.registry.get("tenant1")
+        config = dict(TENANT_CONFIG, new_ml_account="new2")
+        fake_db.create_tenant("tenant2", "hoge@example.com", config)
+        self.assertIsNone(self.registry.get("tenant2"))
+
+        self.registry.invalidate()
+        self.assertEqual(self.registry.get("tenant2")['tenant_name'],
+                         "tenant2")
+        with mock.patch.object(fake_db, 'find_tenants') as m:
+            self.registry.refresh(force=True)
+            m.assert_not_called()
+
+    def test_refresh_disabled(self):
+        self.registry.get("tenant1")
+        fake_db.update_tenant("tenant1", "CLI",
+                              status=const.TENANT_STATUS_DISABLED)
+        self.registry.refresh(force=True)
+        self.assertIsNone(self.registry.get("tenant1"))
+        self.assertIsNone(self.registry.find_by_account("new"))
+        self.assertEqual(self.registry.tenants(), [])
+
+    def test_on_change(self):
+        changed = []
+        self.registry.on_change = changed.append
+        self.registry.get("tenant1")
+        self.assertEqual(changed, [])
+
+        fake_db.update_tenant("tenant1", "CLI", readme_msg="hoge")
+        self.registry.refresh(force=True)
+        self.assertEqual(changed, ["tenant1"])
+        self.assertEqual(self.registry.get("tenant1")['readme_msg'], "hoge")
+
+        fake_db.delete_tenant("tenant1")
+        self.registry.refresh(force=True)
+        self.assertEqual(changed, ["tenant1", "tenant1"])
+
+    def test_name_pattern(self):
+        from amane import registry
+        pattern = registry.name_pattern("ml-%06d")
+        self.assertEqual(pattern.fullmatch("ml-000010").group(1), "000010")
+        self.assertEqual(pattern.fullmatch("ML-1234567").group(1), "1234567")
+        self.assertIsNone(pattern.fullmatch("ml-abc"))
+        self.assertIsNone(pattern.fullmatch("xml-000010"))
+        pattern = registry.name_pattern("100%%-%d.x")
+        self.assertEqual(pattern.fullmatch("100%-3.x").group(1), "3")
+        self.assertIsNone(pattern.fullmatch("100%-3-x"))
+        self.assertIsNone(registry.name_pattern("ml-%s"))
+        self.assertIsNone(registry.name_pattern("ml-%d-%d"))
+        self.assertIsNone(registry.name_pattern("ml"))
+
+    def test_compare_counter(self):
+        self.registry.counter_interval = 60
+        fake_db.TENANTS["tenant1"]['counter'] = 10
+        self.assertEqual(self.registry.compare_counter("ml-000009"),
+                         (-1, True))
+        self.assertEqual(self.registry.compare_counter("ml-000010"),
+                         (0, False))
+        self.assertEqual(self.registry.compare_counter("hoge"),
+                         (None, False))
+
+        # Counters are reloaded at most every counter_interval seconds
+        fake_db.TENANTS["tenant1"]['counter'] = 11
+        with mock.patch.object(fake_db, 'get_tenant_counters') as m:
+            self.assertEqual(self.registry.compare_counter("ml-000011"),
+                             (1, False))
+            self.assertEqual(self.registry.compare_counter("ml-999999"),
+                             (999989, False))
+            m.assert_not_called()
+        self.registry.counter_interval = 0
+        self.assertEqual(self.registry.compare_counter("ml-000011"),
+                         (0, True))
+        self.assertEqual(self.registry.compare_counter("ml-999999"),
+                         (999988, True))
+
+        self.registry.update_counter("tenant1", 12)
+        self.registry.counter_interval = 60
+        self.assertEqual(self.registry.compare_counter("ml-000012"),
+                         (0, False))
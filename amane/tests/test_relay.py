@@ -0,0 +1,97 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for relay host connection pool (amane.relay)
+"""
+
+import smtplib
+import unittest
+from unittest import mock
+
+from amane import relay
+
+
+class RelayPoolTest(unittest.TestCase):
+    """RelayPool tests"""
+
+    def setUp(self):
+        self.pool = relay.RelayPool("localhost", 1025, size=2)
+
+    @mock.patch('amane.relay.smtplib.SMTP')
+    def test_reuse(self, mock_SMTP):
+        mock_SMTP.return_value.noop.return_value = (250, b'OK')
+        self.pool.sendmail("a@example.com", {"b@example.com"}, "msg1")
+        self.pool.sendmail("a@example.com", {"c@example.com"}, "msg2")
+        mock_SMTP.assert_called_once_with('localhost', 1025, timeout=30)
+        self.assertEqual(mock_SMTP.return_value.sendmail.call_count, 2)
+        mock_SMTP.return_value.quit.assert_not_called()
+
+    @mock.patch('amane.relay.smtplib.SMTP')
+    def test_noop_failure(self, mock_SMTP):
+        mock_SMTP.return_value.noop.side_effect = \
+            smtplib.SMTPServerDisconnected
+        self.pool.sendmail("a@example.com", {"b@example.com"}, "msg1")
+        self.pool.sendmail("a@example.com", {"c@example.com"}, "msg2")
+        self.assertEqual(mock_SMTP.call_count, 2)
+
+    @mock.patch('amane.relay.smtplib.SMTP')
+    def test_idle_timeout(self, mock_SMTP):
+        self.pool.idle_timeout = -1
+        self.pool.sendmail("a@example.com", {"b@example.com"}, "msg1")
+        self.pool.sendmail("a@example.com", {"c@example.com"}, "msg2")
+        self.assertEqual(mock_SMTP.call_count, 2)
+        mock_SMTP.return_value.noop.assert_not_called()
+
+    @mock.patch('amane.relay.smtplib.SMTP')
+    def test_reconnect(self, mock_SMTP):
+        mock_SMTP.return_value.sendmail.side_effect = [
+            smtplib.SMTPServerDisconnected, {}]
+        ret = self.pool.sendmail("a@example.com", {"b@example.com"}, "msg")
+        self.assertEqual(ret, {})
+        self.assertEqual(mock_SMTP.call_count, 2)
+
+    @mock.patch('amane.relay.smtplib.SMTP')
+    def test_error(self, mock_SMTP):
+        mock_SMTP.return_value.sendmail.side_effect = \
+            smtplib.SMTPRecipientsRefused({})
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self.pool.sendmail,
+                          "a@example.com", {"b@example.com"}, "msg")
+        self.assertEqual(len(self.pool._idle), 0)
+
+    @mock.patch('amane.relay.smtplib.SMTP')
+    def test_close(self, mock_SMTP):
+        self.pool.sendmail("a@example.com", {"b@example.com"}, "msg")
+        self.pool.close()
+        mock_SMTP.return_value.quit.assert_called_once_with()
+        self.assertEqual(len(self.pool._idle), 0)
+
+    @mock.patch('amane.relay.smtplib.SMTP')
+    def test_close_in_use(self, mock_SMTP):
+        with self.pool.connection():
+            self.pool.close()
+            mock_SMTP.return_value.quit.assert_not_called()
+        mock_SMTP.return_value.quit.assert_called_once_with()
+        self.assertEqual(len(self.pool._idle), 0)
+
+    def test_from_config(self):
+        pool = relay.from_config(relay_host="localhost", relay_port=25,
+                                 relay_pool_size=8, relay_timeout=10,
+                                 relay_idle_timeout=20, log_file="x")
+        self.assertEqual(pool.relay_host, "localhost")
+        self.assertEqual(pool.relay_port, 25)
+        self.assertEqual(pool.size, 8)
+        self.assertEqual(pool.timeout, 10)
+        self.assertEqual(pool.idle_timeout, 20)
@@ -46,9 +46,12 @@ logging.basicConfig(level=logging.DEBUG)
 
 
 class DummySMTPClient(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, timeout=None):
         pass
 
+    def noop(self):
+        return (250, b'OK')
+
     def set_debuglevel(self, value):
         pass
 
@@ -58,6 +61,9 @@ class DummySMTPClient(object):
     def quit(self):
         pass
 
+    def close(self):
+        pass
+
 
 class ConvertTest(unittest.TestCase):
     """convert() tests"""
@@ -145,7 +151,7 @@ class ProcessMessageTest(unittest.TestCase):
         self.rcptto = rcptto
         self.message = email.message_from_string(message)
         self.body = self.message.get_payload()
-        self.data = yaml.load(self.body)
+        self.data = yaml.safe_load(self.body)
         print("self.data: %s" % self.data)
         for key in ['new', 'open', 'orphaned', 'closed']:
             if self.data[key] is None:
@@ -153,7 +159,7 @@ class ProcessMessageTest(unittest.TestCase):
         print(self.body)
 
     @mock.patch('amane.cmd.reporter.db', fake_db)
-    @mock.patch('amane.cmd.reporter.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def _test_report(self, new, _open, orphaned, closed):
         with mock.patch.object(DummySMTPClient, 'sendmail') as m:
             with mock.patch.object(fake_db, 'init_db') as m2:
@@ -171,14 +177,15 @@ class ProcessMessageTest(unittest.TestCase):
                                  orphaned)
                 self.assertEqual([_['ml_name'] for _ in self.data['closed']],
                                  closed)
+                m2.assert_called_with(None, None, create_indexes=False)
 
     @mock.patch('amane.cmd.reporter.db', fake_db)
-    @mock.patch('amane.cmd.reporter.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_report_without_ml(self):
         self._test_report([], [], [], [])
 
     @mock.patch('amane.cmd.reporter.db', fake_db)
-    @mock.patch('amane.cmd.reporter.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_report_with_a_new_ml(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -187,7 +194,7 @@ class ProcessMessageTest(unittest.TestCase):
         self._test_report(['ml-000010'], [], [], [])
 
     @mock.patch('amane.cmd.reporter.db', fake_db)
-    @mock.patch('amane.cmd.reporter.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_report_with_an_open_ml(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -198,7 +205,7 @@ class ProcessMessageTest(unittest.TestCase):
         self._test_report([], ['ml-000010'], [], [])
 
     @mock.patch('amane.cmd.reporter.db', fake_db)
-    @mock.patch('amane.cmd.reporter.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_report_with_an_orphaned_ml(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -209,7 +216,7 @@ class ProcessMessageTest(unittest.TestCase):
         self._test_report([], [], ['ml-000010'], [])
 
     @mock.patch('amane.cmd.reporter.db', fake_db)
-    @mock.patch('amane.cmd.reporter.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_report_with_a_closed_ml(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -220,7 +227,7 @@ class ProcessMessageTest(unittest.TestCase):
         self._test_report([], [], [], ['ml-000010'])
 
     @mock.patch('amane.cmd.reporter.db', fake_db)
-    @mock.patch('amane.cmd.reporter.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_report_with_mls(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -232,6 +239,17 @@ class ProcessMessageTest(unittest.TestCase):
                           "test1@example.com")
         self._test_report(['ml-000010', 'ml-000011', 'ml-000012'], [], [], [])
 
+    @mock.patch('amane.cmd.reporter.db', fake_db)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
+    def test_report_tenant_closes_own_pool(self):
+        with mock.patch.object(fake_db, 'init_db'), \
+                mock.patch('amane.relay.RelayPool.close') as m:
+            reporter.report_tenant_status(
+                report_subject="title", report_msg=self.report_msg,
+                days_to_close=2, charset='us-ascii', admins=["hoge"],
+                domain="example.com", tenant_name=self.tenant_name)
+            m.assert_called_once_with()
+
 
 class MainTest(unittest.TestCase):
     """main() tests"""
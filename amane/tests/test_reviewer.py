@@ -216,7 +216,7 @@ class SendPostTest(unittest.TestCase):
 
         self.reviewer.send_post('ml-000010', "subject", msg, members,
                                 "iso-2022-jp")
-        mock_SMTP.assert_called_with('localhost', 1025)
+        mock_SMTP.assert_called_with('localhost', 1025, timeout=30)
 
 
 class MainTest(unittest.TestCase):
@@ -18,33 +18,37 @@ Smoketests for SMTP handler (amane.cmd.smtpd)
 """
 
 import argparse
-import asyncore
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import email
+import functools
 from os.path import dirname, join
 import random
+import shutil
+import smtplib
+import tempfile
+import threading
 import time
-import smtpd
 import unittest
 from unittest import mock
 
 import amane
 from amane import const
+from amane import spool
 from amane.tests import fake_db
 
 
 ML_NAME = "test-%06d"
 
 
-class DummySMTPServer(object):
-    def __init__(self, localaddr, localport, **kwargs):
-        pass
-
-
 class DummySMTPClient(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, timeout=None):
         pass
 
+    def noop(self):
+        return (250, b'OK')
+
     def set_debuglevel(self, value):
         pass
 
@@ -54,18 +58,21 @@ class DummySMTPClient(object):
     def quit(self):
         pass
 
+    def close(self):
+        pass
+
 
 class ProcessMessageTest(unittest.TestCase):
     """process_message() tests"""
 
     @mock.patch('amane.db', fake_db)
-    @mock.patch('smtpd.SMTPServer', DummySMTPServer)
     def setUp(self):
         self.db_name = "test%04d" % random.randint(0, 1000)
         self.ml_name_arg = None
         self.message_arg = None
 
         from amane.cmd import smtpd
+        self.smtpd = smtpd
         self.handler = smtpd.AmaneSMTPServer(
             listen_address="127.0.0.1",
             listen_port=25,
@@ -101,7 +108,7 @@ class ProcessMessageTest(unittest.TestCase):
     def tearDown(self):
         fake_db.clear_db()
 
-    def _send_post(self, ml_name, message, mailfrom, members):
+    def _send_post(self, ml_name, message, mailfrom, members, ctx=None):
         self.ml_name_arg = ml_name
         self.message_arg = message
         self.mailfrom_arg = mailfrom
@@ -278,6 +285,137 @@ class ProcessMessageTest(unittest.TestCase):
             self.assertEqual(self.ml_name_arg, 'ml-000010')
             self.assertEqual(fake_db.get_members('ml-000010'), final_members)
 
+    def test_add_members_w_quoted_name(self):
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+        msg = 'From: Test1 <test1@example.com>\n' \
+              'To: ml-000010 <ml-000010@example.net>\n' \
+              'Cc: "Doe, John" <john@example.com>\n' \
+              'Subject: Test message\n' \
+              '\n' \
+              'Test mail\n'
+
+        with mock.patch.object(self.handler, 'send_post') as m:
+            m.side_effect = self._send_post
+            self.handler.process_message(
+                ("127.0.0.2", 1000),
+                "test1@example.com",
+                ["ml-000010@amane.net"],
+                msg)
+            self.assertEqual(fake_db.get_members('ml-000010'),
+                             {"test1@example.com", "john@example.com"})
+
+    def test_looped_post(self):
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+        msg = 'From: Test1 <test1@example.com>\n' \
+              'To: ml-000010 <ml-000010@example.net>\n' \
+              'X-Loop: ml-000010@example.net\n' \
+              'Subject: Auto reply\n' \
+              '\n' \
+              'Test mail\n'
+
+        with mock.patch.object(self.handler, 'send_post') as m:
+            ret = self.handler.process_message(
+                ("127.0.0.2", 1000),
+                "test1@example.com",
+                ["ml-000010@amane.net"],
+                msg)
+            self.assertIsNone(ret)
+            m.assert_not_called()
+
+    def test_duplicate_post(self):
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+        msg = 'From: Test1 <test1@example.com>\n' \
+              'To: ml-000010 <ml-000010@example.net>\n' \
+              'Message-ID: <1234@example.com>\n' \
+              'Subject: Test message\n' \
+              '\n' \
+              'Test mail\n'
+
+        with mock.patch.object(self.handler, 'send_post') as m:
+            for i in range(2):
+                ret = self.handler.process_message(
+                    ("127.0.0.2", 1000),
+                    "test1@example.com",
+                    ["ml-000010@amane.net"],
+                    msg)
+                self.assertIsNone(ret)
+            self.assertEqual(m.call_count, 1)
+
+    def test_retried_post(self):
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+        msg = 'From: Test1 <test1@example.com>\n' \
+              'To: ml-000010 <ml-000010@example.net>\n' \
+              'Message-ID: <1234@example.com>\n' \
+              'Subject: Test message\n' \
+              '\n' \
+              'Test mail\n'
+
+        with mock.patch.object(self.handler, 'process_post') as m:
+            m.side_effect = [const.SMTP_STATUS_TRY_AGAIN_LATER, None]
+            for expected in (const.SMTP_STATUS_TRY_AGAIN_LATER, None):
+                ret = self.handler.process_message(
+                    ("127.0.0.2", 1000),
+                    "test1@example.com",
+                    ["ml-000010@amane.net"],
+                    msg)
+                self.assertEqual(ret, expected)
+            self.assertEqual(m.call_count, 2)
+
+    def test_partly_processed_post(self):
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+        msg = 'From: Test1 <test1@example.com>\n' \
+              'To: ml-000010 <ml-000010@example.net>\n' \
+              'Message-ID: <1234@example.com>\n' \
+              'Subject: Test message\n' \
+              '\n' \
+              'Test mail\n'
+
+        # Failed before sending; retried
+        with mock.patch.object(fake_db, 'get_ml') as m:
+            m.side_effect = OSError()
+            with self.assertRaises(OSError):
+                self.handler.process_message(
+                    ("127.0.0.2", 1000), "test1@example.com",
+                    ["ml-000010@amane.net"], msg)
+
+        # Failed after sending; neither retried nor processed again
+        with mock.patch.object(self.handler.outbox, 'send') as m:
+            m.side_effect = OSError()
+            with self.assertRaises(self.smtpd.PartlyProcessed):
+                self.handler.process_message(
+                    ("127.0.0.2", 1000), "test1@example.com",
+                    ["ml-000010@amane.net"], msg)
+            self.assertIsNone(self.handler.process_message(
+                ("127.0.0.2", 1000), "test1@example.com",
+                ["ml-000010@amane.net"], msg))
+            self.assertEqual(m.call_count, 1)
+
+    def test_partly_processed_new_ml(self):
+        msg = 'From: Test1 <test1@example.com>\n' \
+              'To: new <new@example.net>\n' \
+              'Message-ID: <1234@example.com>\n' \
+              'Subject: Test message\n' \
+              '\n' \
+              'Test mail\n'
+
+        # Failed after taking the counter; not processed again
+        with mock.patch.object(self.handler, 'send_post') as m:
+            m.side_effect = OSError()
+            with self.assertRaises(self.smtpd.PartlyProcessed):
+                self.handler.process_message(
+                    ("127.0.0.2", 1000), "test1@example.com",
+                    ["new@amane.net"], msg)
+            self.assertIsNone(self.handler.process_message(
+                ("127.0.0.2", 1000), "test1@example.com",
+                ["new@amane.net"], msg))
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(list(fake_db.MLS), ["ml-000001"])
+
     def test_add_members_w_1_cc(self):
         initial_members = {"test1@example.com"}
         fake_db.create_ml("tenant1", 'ml-000010', "hoge", initial_members,
@@ -462,6 +600,59 @@ class ProcessMessageTest(unittest.TestCase):
             self.assertEqual(m.call_count, 0)
             self.assertEqual(fake_db.get_members('ml-000010'), final_members)
 
+    def _bounce(self, recipient, action, status):
+        msg = 'From: MAILER-DAEMON <daemon@example.com>\n' \
+              'To: ml-000010-error <ml-000010-error@example.net>\n' \
+              'Subject: Undelivered Mail\n' \
+              'Content-Type: multipart/report; ' \
+              'report-type=delivery-status; boundary="b"\n' \
+              '\n' \
+              '--b\n' \
+              'Content-Type: text/plain\n' \
+              '\n' \
+              'Failed\n' \
+              '--b\n' \
+              'Content-Type: message/delivery-status\n' \
+              '\n' \
+              'Reporting-MTA: dns; mx.example.com\n' \
+              '\n' \
+              'Final-Recipient: rfc822; %s\n' \
+              'Action: %s\n' \
+              'Status: %s\n' \
+              '--b--\n' % (recipient, action, status)
+        self.handler.process_message(
+            ("127.0.0.2", 1000),
+            "daemon@example.com",
+            ["ml-000010-error@amane.net"],
+            msg)
+
+    def test_hard_bounces(self):
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com", "test2@example.com"},
+                          "test1@example.com")
+        for i in range(3):
+            self._bounce("test2@example.com", "failed", "5.1.1")
+        self.assertEqual(fake_db.get_members('ml-000010'),
+                         {"test1@example.com"})
+        bounce = fake_db.get_bounce("test2@example.com")
+        self.assertEqual(bounce['count'], 3)
+        self.assertEqual(bounce['removed'], ['ml-000010'])
+
+    def test_soft_bounces(self):
+        members = {"test1@example.com", "test2@example.com"}
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge", members,
+                          "test1@example.com")
+        for i in range(3):
+            self._bounce("test2@example.com", "delayed", "4.4.1")
+        self.assertEqual(fake_db.get_members('ml-000010'), members)
+        self.assertEqual(fake_db.get_bounce("test2@example.com")['count'], 3)
+
+    def test_bounce_for_non_member(self):
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+        self._bounce("test2@example.com", "failed", "5.1.1")
+        self.assertIsNone(fake_db.get_bounce("test2@example.com"))
+
     def test_close_ml(self):
         initial_members = {"test1@example.com", "test2@example.com",
                            "test3@example.com", "test4@example.com"}
@@ -618,12 +809,52 @@ class ProcessMessageTest(unittest.TestCase):
             self.assertEqual(self.ml_name_arg, 'ml-000010')
             self.assertEqual(fake_db.get_members('ml-000010'), final_members)
 
+    def test_single_fetch_and_update(self):
+        initial_members = {"test1@example.com"}
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge", initial_members,
+                          "test1@example.com")
+        fake_db.change_ml_status('ml-000010', const.STATUS_ORPHANED,
+                                 "test1@example.com")
+        msg = 'From: Test1 <test1@example.com>\n' \
+              'To: ml-000010 <ml-000010@example.net>\n' \
+              'Cc: Test3 <test3@example.com>\n' \
+              'Subject: Test message\n' \
+              '\n' \
+              'Test mail\n'
+        final_members = {"test1@example.com", "test3@example.com"}
+
+        with mock.patch.object(self.handler.relay_pool, 'sendmail') as m, \
+                mock.patch.object(fake_db, 'get_ml',
+                                  wraps=fake_db.get_ml) as get_ml, \
+                mock.patch.object(fake_db, 'get_members') as get_members, \
+                mock.patch.object(fake_db, 'update_ml',
+                                  wraps=fake_db.update_ml) as update_ml:
+            m.return_value = {}
+            self.handler.process_message(
+                ("127.0.0.2", 1000),
+                "test1@example.com",
+                ["ml-000010@amane.net"],
+                msg)
+            self.assertEqual(get_ml.call_count, 1)
+            get_members.assert_not_called()
+            self.assertEqual(update_ml.call_count, 1)
+            self.assertEqual(m.call_args[0][1], final_members | {"hoge"})
+
+        ml = fake_db.get_ml('ml-000010')
+        self.assertEqual(ml['status'], const.STATUS_OPEN)
+        self.assertEqual(fake_db.get_members('ml-000010'), final_members)
+        ops = [_['op'] for _ in fake_db.get_logs('ml-000010')]
+        self.assertEqual(ops, [const.OP_CREATE, const.OP_ORPHAN,
+                               const.OP_REOPEN, const.OP_ADD_MEMBERS,
+                               const.OP_POST])
+        self.assertEqual(fake_db.get_logs('ml-000010')[-1]['delivery'],
+                         {const.MAIL_STATUS_SENT: 3})
+
 
 class ProcessMessageWithAdminsTest(unittest.TestCase):
     """process_message() tests"""
 
     @mock.patch('amane.db', fake_db)
-    @mock.patch('smtpd.SMTPServer', DummySMTPServer)
     def setUp(self):
         self.db_name = "test%04d" % random.randint(0, 1000)
         self.ml_name_arg = None
@@ -665,7 +896,7 @@ class ProcessMessageWithAdminsTest(unittest.TestCase):
     def tearDown(self):
         fake_db.clear_db()
 
-    def _send_post(self, ml_name, message, mailfrom, members):
+    def _send_post(self, ml_name, message, mailfrom, members, ctx=None):
         self.ml_name_arg = ml_name
         self.message_arg = message
         self.mailfrom_arg = mailfrom
@@ -988,7 +1219,6 @@ class SendPostTest(unittest.TestCase):
     """send_post() tests"""
 
     @mock.patch('amane.db', fake_db)
-    @mock.patch('smtpd.SMTPServer', DummySMTPServer)
     def setUp(self):
         self.db_name = "test%04d" % random.randint(0, 1000)
         self.members = None
@@ -1033,7 +1263,7 @@ class SendPostTest(unittest.TestCase):
         self.members = members
         self.message = message
 
-    @mock.patch('amane.cmd.smtpd.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_no_cc(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -1058,14 +1288,16 @@ class SendPostTest(unittest.TestCase):
             m.side_effect = self._sendmail
             self.handler.send_post('ml-000010', msg_obj, "xyz", members)
             self.assertEqual(self.members, members)
-            message = email.message_from_string(self.message)
+            message = email.message_from_bytes(self.message)
             self.assertEqual(message['to'], 'ml-000010@example.net')
             self.assertEqual(message['reply-to'], 'ml-000010@example.net')
             self.assertEqual(message.get('cc', ''), '')
             self.assertEqual(message['subject'],
                              '=?iso-2022-jp?b?W21sLTAwMDAxMF0gdGVzdA==?=')
+            self.assertEqual(message['x-loop'], 'ml-000010@example.net')
+            self.assertEqual(message['list-id'], '<ml-000010.example.net>')
 
-    @mock.patch('amane.cmd.smtpd.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_2_ccs(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -1091,7 +1323,7 @@ class SendPostTest(unittest.TestCase):
             m.side_effect = self._sendmail
             self.handler.send_post('ml-000010', msg_obj, "xyz", members)
             self.assertEqual(self.members, members)
-            message = email.message_from_string(self.message)
+            message = email.message_from_bytes(self.message)
             self.assertEqual(message['to'], 'ml-000010@example.net')
             self.assertEqual(message['reply-to'], 'ml-000010@example.net')
             self.assertEqual(
@@ -1100,7 +1332,7 @@ class SendPostTest(unittest.TestCase):
             self.assertEqual(message['subject'],
                              '=?iso-2022-jp?b?W21sLTAwMDAxMF0gdGVzdA==?=')
 
-    @mock.patch('amane.cmd.smtpd.smtplib.SMTP', DummySMTPClient)
+    @mock.patch('amane.relay.smtplib.SMTP', DummySMTPClient)
     def test_members(self):
         members = {"test1@example.com", "test2@example.com",
                    "test3@example.com", "test4@example.com"}
@@ -1126,7 +1358,7 @@ class SendPostTest(unittest.TestCase):
             m.side_effect = self._sendmail
             self.handler.send_post('ml-000010', msg_obj, "xyz", members)
             self.assertEqual(self.members, members)
-            message = email.message_from_string(self.message)
+            message = email.message_from_bytes(self.message)
             self.assertEqual(message['to'], 'ml-000010@example.net')
             self.assertEqual(message['reply-to'], 'ml-000010@example.net')
             self.assertEqual(
@@ -1136,6 +1368,884 @@ class SendPostTest(unittest.TestCase):
                              '=?iso-2022-jp?b?W21sLTAwMDAxMF0gdGVzdA==?=')
 
 
+class ServerTest(unittest.TestCase):
+    """Base of tests with a server, a tenant and a ML"""
+
+    @mock.patch('amane.db', fake_db)
+    def setUp(self):
+        from amane.cmd import smtpd
+        self.smtpd = smtpd
+        self.handler = smtpd.AmaneSMTPServer(
+            listen_address="127.0.0.1",
+            listen_port=25,
+            relay_host="localhost",
+            relay_port=1025,
+            db_url="mongodb://localhost",
+            db_name="test",
+            domain="example.net")
+        config = {
+            "admins": set(),
+            "charset": "iso-2022-jp",
+            "ml_name_format": "ml-%06d",
+            "new_ml_account": "new",
+            "days_to_close": 7,
+            "days_to_orphan": 7,
+            "welcome_msg": "welcome_msg",
+            "readme_msg": "readme_msg",
+            "add_msg": "add_msg",
+            "remove_msg": "remove_msg",
+            "reopen_msg": "reopen_msg",
+            "goodbye_msg": "goodbye_msg",
+            "report_subject": "report_subject",
+            "report_msg": "report_msg",
+            "orphaned_subject": "orphaned_subject",
+            "orphaned_msg": "orphaned_msg",
+            "closed_subject": "closed_subject",
+            "closed_msg": "closed_msg",
+        }
+        fake_db.create_tenant("tenant1", "hoge", config)
+        fake_db.create_ml("tenant1", 'ml-000010', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+
+    def tearDown(self):
+        fake_db.clear_db()
+
+
+class BytesPipelineTest(ServerTest):
+    """Bytes message pipeline tests"""
+
+    def _post(self, msg):
+        with mock.patch.object(self.handler.relay_pool, 'sendmail') as m:
+            self.handler.process_message(
+                ("127.0.0.2", 1000), "test1@example.com",
+                ["ml-000010@example.net"], msg)
+        self.assertEqual(m.call_count, 1)
+        return m.call_args[0][2]
+
+    def test_8bit_body(self):
+        body = "日本語のテスト\r\n".encode('utf-8')
+        msg = b'From: Test1 <test1@example.com>\r\n' \
+              b'To: ml-000010 <ml-000010@example.net>\r\n' \
+              b'Subject: test\r\n' \
+              b'X-Folded: a\r\n b\r\n' \
+              b'Content-Type: text/plain; charset=utf-8\r\n' \
+              b'Content-Transfer-Encoding: 8bit\r\n' \
+              b'\r\n' + body
+        data = self._post(msg)
+        self.assertIsInstance(data, bytes)
+        self.assertIn(b'\r\n\r\n' + body, data)
+        self.assertIn(b'X-Folded: a\r\n b\r\n', data)
+        self.assertEqual(data.count(b'Content-Type: text/plain'), 2)
+        message = email.message_from_bytes(data)
+        self.assertEqual(message.get_content_type(), "multipart/mixed")
+        part = message.get_payload(0)
+        self.assertEqual(part.get_payload(decode=True), body)
+        self.assertEqual(message['to'], 'ml-000010@example.net')
+
+    def test_8bit_address_headers(self):
+        msg = ('From: 山田 <test1@example.com>\r\n'
+               'To: メーリングリスト <ml-000010@example.net>\r\n'
+               'Cc: 鈴木 <test2@example.com>\r\n'
+               'Subject: test\r\n'
+               '\r\n'
+               'Test\r\n').encode('utf-8')
+        self.assertIsNone(self.handler.check_message(msg))
+        self.assertEqual(
+            self.handler.recipient_statuses(
+                ["ml-000010@example.net", "ml-000011@example.net"], msg,
+                const.SMTP_STATUS_OK),
+            [const.SMTP_STATUS_OK, const.SMTP_STATUS_NOT_ADDRESSED])
+        self._post(msg)
+        ml = fake_db.get_ml('ml-000010')
+        self.assertEqual(ml['members'],
+                         {"test1@example.com", "test2@example.com"})
+
+    def test_attachment(self):
+        attachment = "A" * 76 + "\r\n"
+        msg = 'From: Test1 <test1@example.com>\r\n' \
+              'To: ml-000010 <ml-000010@example.net>\r\n' \
+              'Subject: test\r\n' \
+              'Content-Type: Multipart/Mixed; boundary="hoge"\r\n' \
+              '\r\n' \
+              '--hoge\r\n' \
+              'Content-Type: application/octet-stream\r\n' \
+              'Content-Transfer-Encoding: base64\r\n' \
+              '\r\n' + attachment * 100 + \
+              '--hoge--\r\n'
+        data = self._post(msg.encode())
+        self.assertIn(('\r\n\r\n' + attachment * 100).encode(), data)
+
+    def test_ensure_multipart_default_charset(self):
+        message = email.message_from_bytes(
+            b'Subject: test\n\n\x1b$B$F$9$H\x1b(B\n')
+        message = self.smtpd.ensure_multipart(message, "iso-2022-jp")
+        part = message.get_payload(0)
+        self.assertEqual(part.get_content_charset(), "iso-2022-jp")
+        self.assertEqual(part.get_payload(), '\x1b$B$F$9$H\x1b(B\n')
+        self.assertEqual(message.get_all('Content-Type'),
+                         [message['Content-Type']])
+
+    def test_get_header(self):
+        message = email.message_from_bytes(
+            'Subject: 日本語\n\n'.encode('utf-8'))
+        self.assertEqual(self.smtpd.get_header(message, 'Subject'), "日本語")
+        message = email.message_from_bytes(
+            b'Subject: =?utf-8?b?5pel5pys6Kqe?=\n\n')
+        self.assertEqual(self.smtpd.get_header(message, 'Subject'), "日本語")
+
+
+class HeaderOnlyTest(ServerTest):
+    """Header-only parsing and rejection tests"""
+
+    def test_parse_headers(self):
+        headers = self.smtpd.parse_headers(
+            b'Subject: a\r\n b\r\nTo: x@example.net\r\n\r\n'
+            b'From: body@example.com\r\n')
+        self.assertEqual(headers['To'], "x@example.net")
+        self.assertIsNone(headers['From'])
+        self.assertEqual(headers.get_payload(), "")
+        headers = self.smtpd.parse_headers(b'To: x@example.net\n')
+        self.assertEqual(headers['To'], "x@example.net")
+
+    def _rejected_without_parsing(self, msg, status):
+        with mock.patch('email.message_from_bytes') as m:
+            ret = self.handler.process_message(
+                ("127.0.0.2", 1000), "test1@example.com",
+                ["ml-000010@example.net"], msg)
+        self.assertEqual(ret, status)
+        m.assert_not_called()
+
+    def test_header_only_rejection(self):
+        body = b'\r\n' + b'X' * 1000 + b'\r\n'
+        self._rejected_without_parsing(
+            b'From: test2@example.com\r\n'
+            b'To: ml-000010@example.net\r\n'
+            b'Subject: test\r\n' + body,
+            const.SMTP_STATUS_NOT_MEMBER)
+        self._rejected_without_parsing(
+            b'From: test1@example.com\r\n'
+            b'To: ml-000009@example.net\r\n'
+            b'Subject: test\r\n' + body,
+            const.SMTP_STATUS_NO_SUCH_ML)
+        self._rejected_without_parsing(
+            b'From: test1@example.com\r\n'
+            b'To: ml-999999@example.net\r\n'
+            b'Subject: test\r\n' + body,
+            const.SMTP_STATUS_TRY_AGAIN_LATER)
+        self._rejected_without_parsing(
+            b'From: test1@example.com\r\n'
+            b'To: ml-000010@example.net, ml-000011@example.net\r\n'
+            b'Subject: test\r\n' + body,
+            const.SMTP_STATUS_CANT_CROSS_POST)
+        fake_db.change_ml_status('ml-000010', const.STATUS_CLOSED, "xyz")
+        self._rejected_without_parsing(
+            b'From: test1@example.com\r\n'
+            b'To: ml-000010@example.net\r\n'
+            b'Subject: test\r\n' + body,
+            const.SMTP_STATUS_CLOSED_ML)
+
+
+class CheckRecipientTest(ServerTest):
+    """check_recipient() tests"""
+
+    def test_check_recipient(self):
+        check = self.handler.check_recipient
+        self.assertIsNone(check("ml-000010@example.net"))
+        self.assertIsNone(check("ML-000010@Example.NET"))
+        self.assertIsNone(check("new@example.net"))
+        self.assertIsNone(check("ml-999999-error@example.net"))
+        self.assertIsNone(check("someone@example.com"))
+        self.assertEqual(check("ml-000009@example.net"),
+                         const.SMTP_STATUS_NO_SUCH_ML)
+        # Beyond the tenant counter
+        self.assertEqual(check("ml-999999@example.net"),
+                         const.SMTP_STATUS_TRY_AGAIN_LATER)
+        fake_db.change_ml_status('ml-000010', const.STATUS_CLOSED, "xyz")
+        self.assertIsNone(check("ml-000010@example.net"))
+
+    def test_snapshots(self):
+        snapshots = {}
+        self.assertIsNone(self.handler.check_recipient(
+            "ml-000010@example.net", "test1@example.com", snapshots))
+        self.assertEqual(list(snapshots), ["ml-000010"])
+        msg = b'From: test1@example.com\r\n' \
+              b'To: ml-000010@example.net\r\n' \
+              b'Subject: test\r\n\r\nTest\r\n'
+        with mock.patch.object(fake_db, 'get_ml',
+                               wraps=fake_db.get_ml) as m, \
+                mock.patch.object(self.handler.relay_pool, 'sendmail'):
+            # The ML looked up for the recipient is reused
+            self.assertIsNone(self.handler.check_message(msg, snapshots))
+            self.assertIsNone(self.handler.process_message(
+                ("127.0.0.2", 1000), "test1@example.com",
+                ["ml-000010@example.net"], msg, snapshots))
+            m.assert_not_called()
+
+            # Stale ones are looked up again
+            taken, ml = snapshots["ml-000010"]
+            snapshots["ml-000010"] = (taken - self.smtpd.SNAPSHOT_TTL, ml)
+            self.assertIsNone(self.handler.check_message(msg, snapshots))
+            self.assertEqual(m.call_count, 1)
+
+
+class LookupMLTest(ServerTest):
+    """lookup_ml() tests"""
+
+    def test_lookup_ml_without_query(self):
+        lookup = self.handler.lookup_ml
+        with mock.patch.object(fake_db, 'get_ml',
+                               wraps=fake_db.get_ml) as m:
+            # Beyond the tenant counter just reloaded
+            self.assertEqual(lookup("ml-999999"),
+                             (None, const.SMTP_STATUS_NO_SUCH_ML))
+            # Beyond the tenant counter which may be stale
+            self.assertEqual(lookup("ml-999999"),
+                             (None, const.SMTP_STATUS_TRY_AGAIN_LATER))
+            m.assert_not_called()
+
+            # Missed names are cached
+            for i in range(3):
+                self.assertEqual(lookup("ml-000009"),
+                                 (None, const.SMTP_STATUS_NO_SUCH_ML))
+                self.assertEqual(lookup("hoge"),
+                                 (None, const.SMTP_STATUS_NO_SUCH_ML))
+            self.assertEqual(m.call_count, 2)
+
+            # Names equal to the counter may be created soon
+            self.assertIsNotNone(lookup("ml-000010")[0])
+            fake_db.TENANTS["tenant1"]['counter'] = 11
+            self.handler.tenants.update_counter("tenant1", 11)
+            self.assertEqual(lookup("ml-000011"),
+                             (None, const.SMTP_STATUS_NO_SUCH_ML))
+            self.assertEqual(lookup("ml-000011"),
+                             (None, const.SMTP_STATUS_NO_SUCH_ML))
+            self.assertEqual(m.call_count, 5)
+
+            # Guessed names are refused once the counter is reloaded
+            self.handler.tenants.counter_interval = 0
+            self.assertEqual(lookup("ml-999999"),
+                             (None, const.SMTP_STATUS_NO_SUCH_ML))
+            self.assertEqual(m.call_count, 5)
+
+    def test_ml_created_by_another_process(self):
+        self.handler.tenants.compare_counter("ml-000010")
+        # Another process creates ml-000011 after the counter was loaded
+        fake_db.TENANTS["tenant1"]['counter'] = 11
+        fake_db.create_ml("tenant1", 'ml-000011', "hoge",
+                          {"test1@example.com"}, "test1@example.com")
+        check = self.handler.check_recipient
+        self.assertEqual(check("ml-000011@example.net"),
+                         const.SMTP_STATUS_TRY_AGAIN_LATER)
+        # Accepted once the counter is reloaded
+        self.handler.tenants._counted = None
+        self.assertIsNone(check("ml-000011@example.net"))
+
+
+class LoadSheddingTest(ServerTest):
+    """Load shedding tests"""
+
+    def test_overloaded(self):
+        from amane import metrics
+        metrics.clear()
+        self.assertIsNone(self.handler.overloaded())
+        self.handler.max_in_flight = 2
+        self.handler.in_flight = 2
+        self.assertEqual(self.handler.overloaded(), "in_flight")
+        self.handler.in_flight = 1
+        self.assertIsNone(self.handler.overloaded())
+        self.handler.max_outbox_depth = 10
+        self.handler.outbox.depth = 10
+        self.assertEqual(self.handler.overloaded(), "outbox_depth")
+        self.assertEqual(self.handler.shedding, "outbox_depth")
+        self.handler.spool_workers = mock.MagicMock()
+        self.handler.spool_workers.backlog.return_value = 5
+        self.handler.max_spool_depth = 5
+        self.assertEqual(self.handler.overloaded(), "spool_depth")
+        self.assertEqual(metrics.snapshot(),
+                         {"shed": 3, "shed.in_flight": 1,
+                          "shed.outbox_depth": 1, "shed.spool_depth": 1})
+
+
+class RateLimitTest(ServerTest):
+    """Rate limit tests"""
+
+    def test_rate_limits(self):
+        self.handler.rate_limits = {"sender": (60, 2), "tenant": (60, 3)}
+        check = self.handler.check_recipient
+        self.assertIsNone(check("ml-000010@example.net",
+                                "Test1@Example.com"))
+        self.assertIsNone(check("ml-000010@example.net", "test1@example.com"))
+        self.assertEqual(
+            check("ml-000010@example.net", "test1@example.com"),
+            const.SMTP_STATUS_RATE_LIMITED)
+        self.assertIsNone(check("new@example.net", "test2@example.com"))
+        self.assertEqual(check("new@example.net", "test3@example.com"),
+                         const.SMTP_STATUS_RATE_LIMITED)
+        # Bounces and other domains aren't limited
+        self.assertIsNone(check("ml-000010-error@example.net", ""))
+        self.assertIsNone(check("someone@example.com", "test1@example.com"))
+
+    def test_tenant_rate_limits(self):
+        fake_db.update_tenant("tenant1", "CLI",
+                              rate_limits={"ml": {"rate": 60, "burst": 1}})
+        check = self.handler.check_recipient
+        self.assertIsNone(check("ml-000010@example.net", "test1@example.com"))
+        self.assertEqual(
+            check("ml-000010@example.net", "test2@example.com"),
+            const.SMTP_STATUS_RATE_LIMITED)
+
+
+class SpoolMessageTest(ServerTest):
+    """spool_message() and check_message() tests"""
+
+    def test_check_message(self):
+        check = self.handler.check_message
+        body = b'\r\nTest\r\n'
+        self.assertIsNone(check(b'From: test1@example.com\r\n'
+                                b'To: ml-000010@example.net\r\n' + body))
+        self.assertIsNone(check(b'From: test9@example.com\r\n'
+                                b'To: new@example.net\r\n' + body))
+        self.assertIsNone(check(b'From: daemon@example.com\r\n'
+                                b'To: ml-000010-error@example.net\r\n' +
+                                body))
+        self.assertEqual(check(b'From: test2@example.com\r\n'
+                               b'To: ml-000010@example.net\r\n' + body),
+                         const.SMTP_STATUS_NOT_MEMBER)
+        self.assertEqual(check(b'From: test1@example.com\r\n'
+                               b'To: someone@example.com\r\n' + body),
+                         const.SMTP_STATUS_NO_ML_SPECIFIED)
+        fake_db.change_ml_status('ml-000010', const.STATUS_CLOSED, "xyz")
+        self.assertEqual(check(b'From: test1@example.com\r\n'
+                               b'To: ml-000010@example.net\r\n'
+                               b'Subject: test\r\n' + body),
+                         const.SMTP_STATUS_CLOSED_ML)
+        self.assertIsNone(check(b'From: test1@example.com\r\n'
+                                b'To: ml-000010@example.net\r\n'
+                                b'Subject: reopen\r\n' + body))
+
+    def test_spool_message(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self.handler.spool = spool.Spool(spool_dir)
+            self.handler.spool_workers = mock.MagicMock()
+            ret = self.handler.spool_message(
+                ("127.0.0.2", 1000), "test2@example.com",
+                ["ml-000010@example.net"],
+                b'From: test2@example.com\r\n'
+                b'To: ml-000010@example.net\r\n\r\nTest\r\n')
+            self.assertEqual(ret, const.SMTP_STATUS_NOT_MEMBER)
+            self.assertEqual(self.handler.spool.pending(), [])
+            ret = self.handler.spool_message(
+                ("127.0.0.2", 1000), "test1@example.com",
+                ["ml-000010@example.net"],
+                b'From: test1@example.com\r\n'
+                b'To: ml-000010@example.net\r\n\r\nTest\r\n')
+            self.assertIsNone(ret)
+            name, = self.handler.spool.pending()
+            self.handler.spool_workers.submit.assert_called_once_with(name)
+        finally:
+            shutil.rmtree(spool_dir)
+
+
+class RecipientStatusesTest(ServerTest):
+    """recipient_statuses() tests"""
+
+    def test_recipient_statuses(self):
+        statuses = self.handler.recipient_statuses
+        rcpttos = ["ML-000010@example.net", "ml-000011@example.net",
+                   "someone@example.com"]
+        self.assertEqual(
+            statuses(rcpttos, b'To: ml-000010@example.net\r\n\r\n',
+                     const.SMTP_STATUS_OK),
+            [const.SMTP_STATUS_OK, const.SMTP_STATUS_NOT_ADDRESSED,
+             const.SMTP_STATUS_OK])
+        # Without a single ML, the status is for every recipient
+        self.assertEqual(
+            statuses(rcpttos, b'To: ml-000010@example.net\r\n'
+                     b'Cc: ml-000011@example.net\r\n\r\n',
+                     const.SMTP_STATUS_CANT_CROSS_POST),
+            [const.SMTP_STATUS_CANT_CROSS_POST] * 3)
+        self.assertEqual(
+            statuses(rcpttos, b'Subject: test\r\n\r\n',
+                     const.SMTP_STATUS_NO_ML_SPECIFIED),
+            [const.SMTP_STATUS_NO_ML_SPECIFIED] * 3)
+
+
+class ReloadTest(unittest.TestCase):
+    """reload() tests"""
+
+    CONFIG = "db_name: amane\n" \
+             "db_url: mongodb://localhost/\n" \
+             "relay_host: %s\n" \
+             "relay_port: 1025\n" \
+             "listen_address: 127.0.0.1\n" \
+             "listen_port: %d\n" \
+             "domain: %s\n" \
+             "max_in_flight: 10\n"
+
+    @mock.patch('amane.db', fake_db)
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = join(self.tmpdir, "amane.conf")
+        self._write("localhost", 25, "example.net")
+        from amane.cmd import smtpd
+        self.smtpd = smtpd
+        self.handler = smtpd.AmaneSMTPServer(
+            config_file=self.config_file,
+            **smtpd.read_config(self.config_file))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, relay_host, listen_port, domain):
+        with open(self.config_file, "w") as f:
+            f.write(self.CONFIG % (relay_host, listen_port, domain))
+
+    def test_reload(self):
+        old_pool = self.handler.relay_pool
+        self._write("relay.example.com", 2525, "example.com")
+        with mock.patch('amane.log.reopen') as m, \
+                mock.patch.object(self.handler.tenants, 'invalidate') as i, \
+                mock.patch('logging.warning') as w:
+            self.handler.reload()
+            m.assert_called_once_with(filename=None, debug=False)
+            i.assert_called_once_with()
+            w.assert_called_once_with("%s isn't changed until restarted",
+                                      "listen_port")
+        self.assertIsNot(self.handler.relay_pool, old_pool)
+        self.assertIs(self.handler.outbox.relay_pool,
+                      self.handler.relay_pool)
+        self.assertTrue(old_pool._closed)
+        self.assertEqual(self.handler.relay_pool.relay_host,
+                         "relay.example.com")
+        self.assertEqual(self.handler.at_domain, "@example.com")
+        self.assertEqual(self.handler.max_in_flight, 10)
+        self.assertEqual(self.handler.listen_port, 25)
+
+    def test_reload_in_executor(self):
+        old_pool = self.handler.relay_pool
+        executor = mock.MagicMock()
+        with mock.patch('amane.log.reopen'):
+            self.handler.reload(executor)
+        self.assertIsNot(self.handler.relay_pool, old_pool)
+        self.assertFalse(old_pool._closed)
+        executor.submit.assert_called_once_with(old_pool.close)
+
+    def test_reload_error(self):
+        old_pool = self.handler.relay_pool
+        with open(self.config_file, "w") as f:
+            f.write("rate_limits: {foo: {rate: 1}}\n")
+        self.handler.reload()
+        self.assertIs(self.handler.relay_pool, old_pool)
+        self.assertFalse(old_pool._closed)
+
+
+class HandlerTest(unittest.TestCase):
+    """AmaneHandler tests"""
+
+    def setUp(self):
+        from amane.cmd import smtpd
+        self.server = mock.MagicMock(spool=None, draining=False)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.handler = smtpd.AmaneHandler(self.server, self.executor)
+        self.session = mock.MagicMock(peer=("127.0.0.2", 1000))
+        self.envelope = mock.MagicMock(
+            mail_from="test1@example.com",
+            rcpt_tos=["ml-000010@example.net"],
+            content="Subject: test\n\nTest mail\n", snapshots={})
+
+    def tearDown(self):
+        self.handler.shutdown()
+        self.executor.shutdown()
+
+    def _handle_DATA(self):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.handler.handle_DATA(
+                None, self.session, self.envelope))
+        finally:
+            loop.close()
+
+    def test_accepted(self):
+        self.server.process_message.return_value = None
+        ret = self._handle_DATA()
+        self.assertEqual(ret, const.SMTP_STATUS_OK)
+        self.server.process_message.assert_called_with(
+            ("127.0.0.2", 1000), "test1@example.com",
+            ["ml-000010@example.net"], "Subject: test\n\nTest mail\n", {})
+
+    def test_rejected(self):
+        self.server.process_message.return_value = \
+            const.SMTP_STATUS_NO_SUCH_ML
+        ret = self._handle_DATA()
+        self.assertEqual(ret, const.SMTP_STATUS_NO_SUCH_ML)
+
+    def test_error(self):
+        self.server.process_message.side_effect = Exception
+        ret = self._handle_DATA()
+        self.assertEqual(ret, const.SMTP_STATUS_LOCAL_ERROR)
+
+    def _handle_RCPT(self, address):
+        loop = asyncio.new_event_loop()
+        envelope = mock.MagicMock(rcpt_tos=[], rcpt_options=[])
+        try:
+            ret = loop.run_until_complete(self.handler.handle_RCPT(
+                None, self.session, envelope, address, []))
+        finally:
+            loop.close()
+        return ret, envelope.rcpt_tos
+
+    def test_rcpt_accepted(self):
+        self.server.check_recipient.return_value = None
+        ret, rcpt_tos = self._handle_RCPT("ml-000010@example.net")
+        self.assertEqual(ret, const.SMTP_STATUS_OK)
+        self.assertEqual(rcpt_tos, ["ml-000010@example.net"])
+
+    def test_rcpt_refused(self):
+        self.server.check_recipient.return_value = \
+            const.SMTP_STATUS_NO_SUCH_ML
+        ret, rcpt_tos = self._handle_RCPT("ml-999999@example.net")
+        self.assertEqual(ret, const.SMTP_STATUS_NO_SUCH_ML)
+        self.assertEqual(rcpt_tos, [])
+
+    def test_rcpt_error(self):
+        self.server.check_recipient.side_effect = Exception
+        ret, rcpt_tos = self._handle_RCPT("ml-000010@example.net")
+        self.assertEqual(ret, const.SMTP_STATUS_LOCAL_ERROR)
+        self.assertEqual(rcpt_tos, [])
+
+    def test_spooled(self):
+        self.server.spool = mock.MagicMock()
+        self.server.spool_message.return_value = None
+        ret = self._handle_DATA()
+        self.assertEqual(ret, const.SMTP_STATUS_OK)
+        self.server.spool_message.assert_called_with(
+            ("127.0.0.2", 1000), "test1@example.com",
+            ["ml-000010@example.net"], "Subject: test\n\nTest mail\n", {})
+        self.server.process_message.assert_not_called()
+
+    def test_spool_rejected(self):
+        self.server.spool = mock.MagicMock()
+        self.server.spool_message.return_value = const.SMTP_STATUS_NOT_MEMBER
+        ret = self._handle_DATA()
+        self.assertEqual(ret, const.SMTP_STATUS_NOT_MEMBER)
+
+    def test_spool_error(self):
+        self.server.spool = mock.MagicMock()
+        self.server.spool_message.side_effect = OSError
+        ret = self._handle_DATA()
+        self.assertEqual(ret, const.SMTP_STATUS_LOCAL_ERROR)
+
+    def _handle_MAIL(self, address):
+        loop = asyncio.new_event_loop()
+        envelope = mock.MagicMock(mail_from=None, mail_options=[])
+        try:
+            ret = loop.run_until_complete(self.handler.handle_MAIL(
+                None, self.session, envelope, address, ["BODY=8BITMIME"]))
+        finally:
+            loop.close()
+        return ret, envelope
+
+    def test_mail_accepted(self):
+        self.server.overloaded.return_value = None
+        ret, envelope = self._handle_MAIL("test1@example.com")
+        self.assertEqual(ret, const.SMTP_STATUS_OK)
+        self.assertEqual(envelope.mail_from, "test1@example.com")
+        self.assertEqual(envelope.mail_options, ["BODY=8BITMIME"])
+
+    def test_mail_shed(self):
+        self.server.overloaded.return_value = "in_flight"
+        ret, envelope = self._handle_MAIL("test1@example.com")
+        self.assertEqual(ret, const.SMTP_STATUS_TRY_AGAIN_LATER)
+        self.assertIsNone(envelope.mail_from)
+
+    def test_mail_draining(self):
+        self.server.draining = True
+        ret, envelope = self._handle_MAIL("test1@example.com")
+        self.assertEqual(ret, const.SMTP_STATUS_SHUTTING_DOWN)
+        self.assertIsNone(envelope.mail_from)
+        self.server.overloaded.assert_not_called()
+
+    def _hook(self, name, *args):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(getattr(self.handler, name)(
+                None, self.session, self.envelope, *args))
+        finally:
+            loop.close()
+
+    def test_transactions(self):
+        self.server.overloaded.return_value = None
+        self.server.transactions = set()
+        self.server.process_message.return_value = None
+        for end in [self._handle_DATA,
+                    lambda: self._hook('handle_RSET'),
+                    lambda: self._hook('handle_QUIT'),
+                    lambda: self._hook('handle_EHLO', "client", []),
+                    lambda: self.handler.end_transaction(self.session)]:
+            self._handle_MAIL("test1@example.com")
+            self.assertEqual(self.server.transactions, {self.session})
+            end()
+            self.assertEqual(self.server.transactions, set())
+
+    def _cancelled_DATA(self):
+        # Occupy the only thread so that the job of DATA waits for it
+        release = threading.Event()
+        self.executor.submit(release.wait, 10)
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(self.handler.handle_DATA(
+                None, self.session, self.envelope))
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertEqual(self.handler.cancel_jobs(), 1)
+            return loop.run_until_complete(task)
+        finally:
+            release.set()
+            loop.close()
+
+    def test_cancelled_job(self):
+        self.assertEqual(self._cancelled_DATA(),
+                         const.SMTP_STATUS_SHUTTING_DOWN)
+        self.server.process_message.assert_not_called()
+        self.assertEqual(self.handler.jobs, set())
+
+    def test_cancelled_job_spooled(self):
+        self.server.spool = mock.MagicMock()
+        threads = []
+
+        def spool_message(*args):
+            threads.append(threading.current_thread())
+
+        self.server.spool_message.side_effect = spool_message
+        self.assertEqual(self._cancelled_DATA(), const.SMTP_STATUS_OK)
+        self.server.spool_message.assert_called_once_with(
+            ("127.0.0.2", 1000), "test1@example.com",
+            ["ml-000010@example.net"], "Subject: test\n\nTest mail\n", {})
+        # Spooled off the event loop while the only thread is busy
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_wait_jobs(self):
+        release = threading.Event()
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(self.handler.run_job(release.wait, 10))
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertEqual(loop.run_until_complete(
+                self.handler.wait_jobs(time.monotonic() + 0.1)), 1)
+            release.set()
+            self.assertEqual(loop.run_until_complete(
+                self.handler.wait_jobs()), 0)
+            self.assertTrue(loop.run_until_complete(task))
+            self.assertEqual(self.handler.jobs, set())
+        finally:
+            release.set()
+            loop.close()
+
+    def test_in_flight(self):
+        self.server.in_flight = 0
+
+        def process_message(*args):
+            self.assertEqual(self.server.in_flight, 1)
+
+        self.server.process_message.side_effect = process_message
+        self._handle_DATA()
+        self.assertEqual(self.server.in_flight, 0)
+
+    def test_lmtp(self):
+        self.server.protocol = "lmtp"
+        self.server.recipient_statuses.side_effect = \
+            lambda rcpttos, data, status: [status] * len(rcpttos)
+        self.envelope.rcpt_tos = ["ml-000010@example.net",
+                                  "ml-000010-error@example.net"]
+        self.server.process_message.return_value = None
+        ret = self._handle_DATA()
+        self.assertEqual(ret, "250 OK\r\n250 OK")
+        self.server.process_message.return_value = \
+            const.SMTP_STATUS_NOT_MEMBER
+        ret = self._handle_DATA()
+        self.assertEqual(ret, "550 Not member\r\n550 Not member")
+        self.server.recipient_statuses.assert_called_with(
+            self.envelope.rcpt_tos, self.envelope.content,
+            const.SMTP_STATUS_NOT_MEMBER)
+
+
+class LMTPTest(unittest.TestCase):
+    """LMTP over a UNIX domain socket tests"""
+
+    def setUp(self):
+        from amane.cmd import smtpd
+        self.smtpd = smtpd
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, "lmtp.sock")
+        self.server = mock.MagicMock(spool=None, protocol="lmtp",
+                                     draining=False)
+        self.server.check_recipient.side_effect = \
+            lambda address, mailfrom, snapshots: \
+            None if address.startswith("ml-") \
+            else const.SMTP_STATUS_NO_SUCH_ML
+        self.server.process_message.return_value = None
+        self.server.overloaded.return_value = None
+        self.server.at_domain = "@example.net"
+        self.server.recipient_statuses.side_effect = functools.partial(
+            smtpd.AmaneSMTPServer.recipient_statuses, self.server)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _client(self, data):
+        # smtplib reads only the first reply to DATA; read the others too
+        client = smtplib.LMTP(self.path)
+        try:
+            client.ehlo_or_helo_if_needed()
+            client.mail("test1@example.com")
+            replies = {}
+            accepted = []
+            for rcptto in ["ml-000010@example.net", "x@example.net",
+                           "ml-000010-error@example.net"]:
+                replies[rcptto] = client.rcpt(rcptto)
+                if replies[rcptto][0] == 250:
+                    accepted.append(rcptto)
+            replies[accepted[0]] = client.data(data)
+            for rcptto in accepted[1:]:
+                replies[rcptto] = client.getreply()
+            return replies
+        finally:
+            client.quit()
+
+    def _serve(self, data=b"Subject: test\r\n\r\nTest mail\r\n"):
+        from aiosmtpd.lmtp import LMTP
+        sock = self.smtpd.bind_unix_socket(self.path)
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=2)
+        handler = self.smtpd.AmaneHandler(self.server, executor)
+        try:
+            server = loop.run_until_complete(loop.create_unix_server(
+                lambda: LMTP(handler, loop=loop), sock=sock))
+            replies = loop.run_until_complete(
+                loop.run_in_executor(None, self._client, data))
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        finally:
+            executor.shutdown()
+            loop.close()
+        return replies
+
+    def test_unix_socket(self):
+        # A stale socket file is replaced
+        self.smtpd.bind_unix_socket(self.path).close()
+        replies = self._serve()
+        self.assertEqual(replies, {
+            "ml-000010@example.net": (250, b"OK"),
+            "x@example.net": (550, b"No such ML"),
+            "ml-000010-error@example.net": (250, b"OK"),
+        })
+        self.server.process_message.assert_called_once()
+        self.assertEqual(self.server.process_message.call_args[0][2],
+                         ["ml-000010@example.net",
+                          "ml-000010-error@example.net"])
+
+    def test_per_recipient_status(self):
+        # Posted to ml-000010; the bounce address isn't in the headers
+        replies = self._serve(b"From: test1@example.com\r\n"
+                              b"To: ml-000010@example.net\r\n"
+                              b"Subject: test\r\n\r\nTest mail\r\n")
+        self.assertEqual(replies["ml-000010@example.net"], (250, b"OK"))
+        self.assertEqual(replies["ml-000010-error@example.net"],
+                         (550, b"ML isn't in To: or Cc:"))
+
+    def test_per_recipient_status_rejected(self):
+        self.server.process_message.return_value = \
+            const.SMTP_STATUS_NOT_MEMBER
+        replies = self._serve(b"From: test2@example.com\r\n"
+                              b"Cc: ml-000010@example.net\r\n"
+                              b"Subject: test\r\n\r\nTest mail\r\n")
+        self.assertEqual(replies["ml-000010@example.net"],
+                         (550, b"Not member"))
+        self.assertEqual(replies["ml-000010-error@example.net"],
+                         (550, b"ML isn't in To: or Cc:"))
+
+
+class DrainTest(unittest.TestCase):
+    """Transactions of clients over TCP and draining tests"""
+
+    def setUp(self):
+        from amane.cmd import smtpd
+        self.smtpd = smtpd
+        self.server = mock.MagicMock(spool=None, draining=False,
+                                     transactions=set())
+        self.server.overloaded.return_value = None
+        self.server.wait_transactions.side_effect = functools.partial(
+            smtpd.AmaneSMTPServer.wait_transactions, self.server)
+
+    def _serve(self, client):
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=2)
+        handler = self.smtpd.AmaneHandler(self.server, executor)
+        try:
+            server = loop.run_until_complete(loop.create_server(
+                lambda: self.smtpd.AmaneSMTP(handler, loop=loop),
+                host="127.0.0.1", port=0))
+            port = server.sockets[0].getsockname()[1]
+            loop.run_until_complete(
+                loop.run_in_executor(None, client, port))
+            start = time.monotonic()
+            left = loop.run_until_complete(self.server.wait_transactions(
+                start + self.smtpd.DRAIN_TIMEOUT))
+            elapsed = time.monotonic() - start
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        finally:
+            executor.shutdown()
+            loop.close()
+        return left, elapsed
+
+    def _mail(self, port):
+        client = smtplib.SMTP("127.0.0.1", port)
+        client.ehlo("client")
+        self.assertEqual(client.mail("test1@example.com")[0], 250)
+        self.assertEqual(len(self.server.transactions), 1)
+        return client
+
+    def test_disconnected(self):
+        left, elapsed = self._serve(lambda port: self._mail(port).close())
+        self.assertEqual(left, 0)
+        self.assertLess(elapsed, 1)
+
+    def test_reset(self):
+        def client(port):
+            client = self._mail(port)
+            client.rset()
+            self.assertEqual(self.server.transactions, set())
+            client.quit()
+
+        left, _ = self._serve(client)
+        self.assertEqual(left, 0)
+
+    def test_gave_up(self):
+        clients = []
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=2)
+        handler = self.smtpd.AmaneHandler(self.server, executor)
+        try:
+            server = loop.run_until_complete(loop.create_server(
+                lambda: self.smtpd.AmaneSMTP(handler, loop=loop),
+                host="127.0.0.1", port=0))
+            port = server.sockets[0].getsockname()[1]
+            clients.append(loop.run_until_complete(
+                loop.run_in_executor(None, self._mail, port)))
+            with mock.patch('logging.warning') as m:
+                left = loop.run_until_complete(
+                    self.server.wait_transactions(time.monotonic() + 0.2))
+            self.assertEqual(left, 1)
+            m.assert_called_once_with("Gave up %d transactions", 1)
+            server.close()
+        finally:
+            for client in clients:
+                client.close()
+            executor.shutdown()
+            loop.close()
+
+
 class ZMainTest(unittest.TestCase):
     """main() tests"""
 
@@ -1143,23 +2253,49 @@ class ZMainTest(unittest.TestCase):
     def run(self, result=None):
         return super().run(result=result)
 
-    @mock.patch.object(asyncore, 'loop')
     @mock.patch.object(argparse.ArgumentParser, 'parse_args')
     @mock.patch('amane.cmd.smtpd.AmaneSMTPServer', autospec=True)
-    def test_main(self, mock_AmaneSMTPServer, mock_parse_args, mock_loop):
+    def test_main(self, mock_AmaneSMTPServer, mock_parse_args):
         mock_parse_args.return_value = \
-            mock.MagicMock(version=False, debug=False,
+            mock.MagicMock(version=False, debug=False, workers=None,
                            config_file=open('sample/amane.conf'))
+        mock_AmaneSMTPServer.return_value.serve_forever.return_value = 0
         from amane.cmd import smtpd
-        smtpd.main()
+        with mock.patch('os._exit') as m:
+            smtpd.main()
+        mock_AmaneSMTPServer.return_value.serve_forever.assert_called_with()
+        m.assert_not_called()
+
+        # Threads of abandoned jobs aren't waited for
+        mock_AmaneSMTPServer.return_value.serve_forever.return_value = 1
+        with mock.patch('os._exit') as m, mock.patch('logging.shutdown'):
+            smtpd.main()
+        m.assert_called_once_with(1)
+
+    @mock.patch.object(argparse.ArgumentParser, 'parse_args')
+    @mock.patch('amane.cmd.smtpd.AmaneSMTPServer', autospec=True)
+    @mock.patch('amane.prefork.Supervisor', autospec=True)
+    def test_main_workers(self, mock_Supervisor, mock_AmaneSMTPServer,
+                          mock_parse_args):
+        mock_parse_args.return_value = \
+            mock.MagicMock(version=False, debug=False, workers=4,
+                           spool_dir=None, listen_socket=None,
+                           config_file=open('sample/amane.conf'))
+        mock_Supervisor.return_value.run.return_value = 0
+        from amane.cmd import smtpd
+        self.assertEqual(smtpd.main(), 0)
+        mock_AmaneSMTPServer.assert_not_called()
+        target = mock_Supervisor.call_args[0][0]
+        self.assertEqual(mock_Supervisor.call_args[0][1], 4)
+        target()
+        mock_AmaneSMTPServer.return_value.serve_forever.assert_called_with(
+            reuse_port=True, recover_spool=False, sock=None)
 
-    @mock.patch.object(asyncore, 'loop')
     @mock.patch.object(argparse.ArgumentParser, 'parse_args')
     @mock.patch('amane.cmd.smtpd.AmaneSMTPServer', autospec=True)
-    def test_main_version(self, mock_AmaneSMTPServer, mock_parse_args,
-                          mock_loop):
+    def test_main_version(self, mock_AmaneSMTPServer, mock_parse_args):
         mock_parse_args.return_value = \
-            mock.MagicMock(version=True, debug=False,
+            mock.MagicMock(version=True, debug=False, workers=None,
                            config_file=open('sample/amane.conf'))
         from amane.cmd import smtpd
         smtpd.main()
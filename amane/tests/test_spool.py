@@ -0,0 +1,225 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for inbound message spool (amane.spool)
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from amane import const
+from amane import spool
+
+
+MESSAGE = b"Subject: test\n\nTest mail \xe3\n"
+
+
+class SpoolTest(unittest.TestCase):
+    """Spool tests"""
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool = spool.Spool(self.spool_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_put_and_load(self):
+        name = self.spool.put(("127.0.0.2", 1000), "test1@example.com",
+                              ["ml-000010@example.net"], MESSAGE)
+        self.assertEqual(self.spool.pending(), [name])
+        self.assertEqual(os.listdir(self.spool.tmp_dir), [])
+
+        path = self.spool.claim(name)
+        self.assertIsNone(self.spool.claim(name))
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(self.spool.load(path),
+                         (("127.0.0.2", 1000), "test1@example.com",
+                          ["ml-000010@example.net"], MESSAGE))
+
+        self.spool.done(path)
+        self.assertEqual(os.listdir(self.spool.cur_dir), [])
+
+    def test_put_str(self):
+        name = self.spool.put(None, "a", ["b"], MESSAGE.decode(
+            'utf-8', errors='surrogateescape'))
+        path = self.spool.claim(name)
+        self.assertEqual(self.spool.load(path)[3], MESSAGE)
+
+    def test_order(self):
+        names = [self.spool.put(None, "a", ["b"], MESSAGE) for i in range(3)]
+        self.assertEqual(self.spool.pending(), names)
+
+    def test_recover(self):
+        name1 = self.spool.put(None, "a", ["b"], MESSAGE)
+        name2 = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.spool.claim(name1)
+        with open(os.path.join(self.spool.tmp_dir, "partial"), "w") as f:
+            f.write("partial")
+
+        self.assertEqual(self.spool.recover(), [name1, name2])
+        self.assertEqual(os.listdir(self.spool.tmp_dir), [])
+        self.assertEqual(os.listdir(self.spool.cur_dir), [])
+
+    def test_recover_pid(self):
+        name1 = self.spool.put(None, "a", ["b"], MESSAGE)
+        name2 = self.spool.put(None, "a", ["b"], MESSAGE)
+        path = self.spool.claim(name1)
+        os.rename(path, path.replace(":%d" % os.getpid(), ":1"))
+        self.spool.claim(name2)
+        tmp_name = "%020d.%d_%d" % (time.time_ns(), 1, 0)
+        for name in (tmp_name, "partial"):
+            with open(os.path.join(self.spool.tmp_dir, name), "w") as f:
+                f.write("partial")
+
+        self.assertEqual(self.spool.recover(pid=1), [name1])
+        self.assertEqual(os.listdir(self.spool.tmp_dir), ["partial"])
+        self.assertEqual(os.listdir(self.spool.cur_dir),
+                         ["%s:%d" % (name2, os.getpid())])
+
+
+class WorkersTest(unittest.TestCase):
+    """Workers tests"""
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool = spool.Spool(self.spool_dir)
+        self.process = mock.MagicMock(return_value=None)
+        self.workers = spool.Workers(self.spool, self.process, size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_handle(self):
+        name = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.workers.handle(name)
+        self.process.assert_called_once_with(None, "a", ["b"], MESSAGE)
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(os.listdir(self.spool.cur_dir), [])
+
+    def test_handle_rejected(self):
+        self.process.return_value = const.SMTP_STATUS_NOT_MEMBER
+        name = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.workers.handle(name)
+        self.assertEqual(os.listdir(self.spool.cur_dir), [])
+        self.assertEqual(os.listdir(self.spool.failed_dir), [])
+
+    def test_handle_error(self):
+        self.process.side_effect = Exception
+        name = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.workers.handle(name)
+        self.assertEqual(os.listdir(self.spool.cur_dir), [])
+        self.assertEqual(os.listdir(self.spool.failed_dir), [name])
+
+    def test_handle_transient_error(self):
+        self.process.side_effect = OSError
+        self.workers.max_attempts = 2
+        name = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.workers.handle(name)
+        # Returned to new/ and retried later
+        self.assertEqual(self.spool.pending(), [name])
+        self.assertEqual(self.workers.backlog(), 1)
+        self.assertGreater(self.workers._queue_due(), 0)
+        self.assertEqual(self.workers._queue.qsize(), 0)
+
+        self.workers.handle(name)
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(os.listdir(self.spool.failed_dir), [name])
+
+    def test_retry(self):
+        self.process.side_effect = [OSError, None]
+        self.workers.retry_interval = 0.05
+        self.workers.size = 1
+        self.workers.submit(self.spool.put(None, "a", ["b"], MESSAGE))
+        self.workers.start(recover=False)
+        deadline = time.monotonic() + 10
+        while self.process.call_count < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.workers.stop()
+        self.assertEqual(self.process.call_count, 2)
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(os.listdir(self.spool.cur_dir), [])
+        self.assertEqual(os.listdir(self.spool.failed_dir), [])
+
+    def test_defer(self):
+        self.workers.retry_interval = 10
+        self.workers.max_retry_interval = 30
+        self.assertEqual(self.workers.defer("a", 1), 10)
+        self.assertEqual(self.workers.defer("b", 2), 20)
+        self.assertEqual(self.workers.defer("c", 3), 30)
+        self.assertEqual(self.workers.backlog(), 3)
+        self.workers.stop()
+        self.assertEqual(self.workers.backlog(), 0)
+
+    def test_start_recovers(self):
+        name = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.spool.put(None, "c", ["d"], MESSAGE)
+        self.spool.claim(name)
+
+        self.workers.size = 1
+        self.workers.start()
+        self.workers.submit(self.spool.put(None, "e", ["f"], MESSAGE))
+        deadline = time.monotonic() + 10
+        while self.process.call_count < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.workers.stop()
+        self.assertEqual([_[0][1] for _ in self.process.call_args_list],
+                         ["a", "c", "e"])
+        self.assertEqual(self.spool.pending(), [])
+
+    def test_start_without_recovery(self):
+        name = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.spool.claim(name)
+        self.workers.start(recover=False)
+        self.workers.stop()
+        self.assertEqual(len(os.listdir(self.spool.cur_dir)), 1)
+
+    def test_stop(self):
+        self.workers.start()
+        self.workers.stop()
+        name = self.spool.put(None, "a", ["b"], MESSAGE)
+        self.workers.submit(name)
+        self.process.assert_not_called()
+        self.assertEqual(self.spool.pending(), [name])
+
+    def test_stop_timeout(self):
+        release = threading.Event()
+        self.process.side_effect = lambda *args: release.wait(10)
+        self.spool.put(None, "a", ["b"], MESSAGE)
+        self.workers.size = 1
+        self.workers.start()
+        thread, = self.workers._threads
+        deadline = time.monotonic() + 10
+        while not self.process.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with mock.patch('logging.warning') as m:
+            self.workers.stop(timeout=0.1)
+            self.assertEqual(m.call_count, 1)
+        # The message stays claimed to be recovered on the next start
+        self.assertEqual(len(os.listdir(self.spool.cur_dir)), 1)
+        release.set()
+        thread.join()
+
+    def test_backlog(self):
+        self.assertEqual(self.workers.backlog(), 0)
+        self.workers.submit(self.spool.put(None, "a", ["b"], MESSAGE))
+        self.workers.submit(self.spool.put(None, "c", ["d"], MESSAGE))
+        self.assertEqual(self.workers.backlog(), 2)
@@ -0,0 +1,149 @@
+# Copyright 2017 by Akira Yoshiyama <akirayoshiyama@gmail.com>.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Smoketests for template cache (amane.template)
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from amane import template
+
+
+class TemplateCacheTest(unittest.TestCase):
+    """TemplateCache tests"""
+
+    def setUp(self):
+        self.cache = template.TemplateCache()
+
+    def test_render(self):
+        ret = self.cache.render("tenant1", "readme_msg",
+                                "Hello {{ name }}\n{{ x }}",
+                                dict(name="world", x=1))
+        self.assertEqual(ret, "Hello world\r\n1")
+        self.assertEqual(self.cache.render("tenant1", "readme_msg", "", {}),
+                         "")
+        self.assertEqual(
+            self.cache.render("tenant1", "readme_msg", None, {}), "")
+
+    def test_compiled_once(self):
+        with mock.patch.object(self.cache.env, 'compile',
+                               wraps=self.cache.env.compile) as m:
+            for i in range(3):
+                ret = self.cache.render("tenant1", "readme_msg",
+                                        "{{ i }}", dict(i=i))
+                self.assertEqual(ret, str(i))
+            self.assertEqual(m.call_count, 1)
+
+    def test_recompile_on_change(self):
+        ret = self.cache.render("tenant1", "readme_msg", "a{{ i }}",
+                                dict(i=1))
+        self.assertEqual(ret, "a1")
+        ret = self.cache.render("tenant1", "readme_msg", "b{{ i }}",
+                                dict(i=1))
+        self.assertEqual(ret, "b1")
+        ret = self.cache.render("tenant2", "readme_msg", "c{{ i }}",
+                                dict(i=1))
+        self.assertEqual(ret, "c1")
+        ret = self.cache.render("tenant1", "readme_msg", "b{{ i }}",
+                                dict(i=2))
+        self.assertEqual(ret, "b2")
+
+    def test_invalidate(self):
+        self.cache.render("tenant1", "readme_msg", "{{ i }}", dict(i=1))
+        self.cache.invalidate("tenant1")
+        with mock.patch.object(self.cache.env, 'compile',
+                               wraps=self.cache.env.compile) as m:
+            self.cache.render("tenant1", "readme_msg", "{{ i }}", dict(i=1))
+            self.assertEqual(m.call_count, 1)
+
+    def test_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = template.TemplateCache(bytecode_dir=tmpdir)
+            cache.render("tenant1", "readme_msg", "{{ i }}", dict(i=1))
+            self.assertEqual(len(os.listdir(tmpdir)), 1)
+
+            cache = template.TemplateCache(bytecode_dir=tmpdir)
+            with mock.patch.object(cache.env, 'compile') as m:
+                ret = cache.render("tenant1", "readme_msg", "{{ i }}",
+                                   dict(i=2))
+                self.assertEqual(ret, "2")
+                m.assert_not_called()
+
+            cache.invalidate("tenant1")
+            self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_setup(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache")
+            template.setup(template_cache_dir=path, log_file="x")
+            try:
+                self.assertEqual(template.CACHE.bytecode_dir, path)
+                ret = template.render("tenant1", "readme_msg", "{{ i }}",
+                                      dict(i=1))
+                self.assertEqual(ret, "1")
+                self.assertEqual(len(os.listdir(path)), 1)
+            finally:
+                template.setup()
+
+    def test_render_part(self):
+        source = "{% for m in members|sort %}{{ m }}\n{% endfor %}"
+        params = dict(members={"b", "a"}, mailfrom="a")
+        part = self.cache.render_part("tenant1", "readme_msg", source, params,
+                                      "ml-000001", "Readme.txt")
+        self.assertEqual(part.get_param('name'), "Readme.txt")
+        self.assertEqual(part.get_payload(decode=True), b"a\r\nb\r\n")
+
+        # Reused while the members are unchanged, whoever posts
+        with mock.patch.object(self.cache, 'render') as m:
+            params = dict(members={"a", "b"}, mailfrom="b")
+            part2 = self.cache.render_part("tenant1", "readme_msg", source,
+                                           params, "ml-000001", "Readme.txt")
+            self.assertEqual(m.call_count, 0)
+        self.assertIsNot(part2, part)
+        self.assertEqual(part2.as_string(), part.as_string())
+
+        params = dict(members={"a", "c"}, mailfrom="a")
+        part = self.cache.render_part("tenant1", "readme_msg", source, params,
+                                      "ml-000001", "Readme.txt")
+        self.assertEqual(part.get_payload(decode=True), b"a\r\nc\r\n")
+
+    def test_render_part_versions(self):
+        params = dict(members={"a"})
+        self.cache.render_part("tenant1", "readme_msg", "{{ members }}",
+                               params, "ml-000001", "Readme.txt", version=1)
+        with mock.patch.object(self.cache, 'render',
+                               wraps=self.cache.render) as m:
+            self.cache.render_part("tenant1", "readme_msg", "{{ members }}",
+                                   params, "ml-000001", "Readme.txt",
+                                   version=2)
+            self.cache.render_part("tenant1", "readme_msg", "{{ members }}!",
+                                   params, "ml-000001", "Readme.txt",
+                                   version=2)
+            self.assertEqual(m.call_count, 2)
+
+    def test_invalidate_parts(self):
+        params = dict(members={"a"})
+        for ml_name in ("ml-000001", "ml-000002"):
+            self.cache.render_part("tenant1", "readme_msg", "{{ members }}",
+                                   params, ml_name, "Readme.txt")
+        self.cache.invalidate_ml("ml-000001")
+        self.assertNotIn("ml-000001", self.cache.parts)
+        self.assertIn("ml-000002", self.cache.parts)
+        self.cache.invalidate("tenant1")
+        self.assertEqual(len(self.cache.parts), 0)